@@ -0,0 +1,91 @@
+# csv_benchmark.py
+#
+# Compares csv.DictReader, previously used by both providers, with the block based column reader in
+# geoipsets.utils on synthetic MaxMind blocks and dbip rows.
+#
+# usage: python benchmarks/csv_benchmark.py [count]
+
+import gzip
+import io
+import random
+import sys
+import time
+from argparse import ArgumentParser
+from csv import DictReader
+from io import TextIOWrapper
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from geoipsets import ranges, utils  # noqa: E402
+
+MAXMIND_HEADER = ('network,geoname_id,registered_country_geoname_id,represented_country_geoname_id,'
+                  'is_anonymous_proxy,is_satellite_provider\n')
+MAXMIND_COLUMNS = ('network', 'geoname_id', 'registered_country_geoname_id')
+DBIP_FIELDNAMES = ('ip_start', 'ip_end', 'country')
+
+
+def synthetic_maxmind(count: int, rng):
+    lines = [MAXMIND_HEADER]
+    for i in range(count):
+        geo_id = str(rng.randrange(1000, 1250))
+        lines.append('{0}/24,{1},{2},,0,0\n'.format(ranges.format_ipv4((i + 256) << 8), geo_id, geo_id))
+    return ''.join(lines).encode()
+
+
+def synthetic_dbip(count: int, rng):
+    lines = []
+    for i in range(count):
+        first = (i + 256) << 8
+        lines.append('{0},{1},{2}\n'.format(ranges.format_ipv4(first), ranges.format_ipv4(first + 255),
+                                            rng.choice(('CA', 'US', 'RU', 'CN', 'ZZ'))))
+    return gzip.compress(''.join(lines).encode())
+
+
+def with_dictreader(data: bytes, columns, fieldnames=None):
+    rows = 0
+    with io.BytesIO(data) as f:
+        for r in DictReader(TextIOWrapper(f), fieldnames=fieldnames):
+            tuple(r[c] for c in columns)
+            rows += 1
+    return rows
+
+
+def with_csv_columns(data: bytes, columns, fieldnames=None):
+    rows = 0
+    with io.BytesIO(data) as f:
+        for block in utils.read_csv_rows(f, columns, fieldnames):
+            rows += len(block)
+    return rows
+
+
+def report(name, func, *args):
+    start = time.perf_counter()
+    rows = func(*args)
+    elapsed = time.perf_counter() - start
+    print("  {0:<12} {1:8.3f}s  {2:12,.0f} rows/s".format(name, elapsed, rows / elapsed))
+    return elapsed
+
+
+def main():
+    parser = ArgumentParser(description="Compares csv.DictReader with the column reader of geoipsets.utils.")
+    parser.add_argument("count", nargs="?", type=int, default=500000,
+                        help="synthetic rows of each provider (default: %(default)s)")
+    count = parser.parse_args().count
+    rng = random.Random(1)
+
+    maxmind = synthetic_maxmind(count, rng)
+    print("MaxMind blocks: {0} rows".format(count))
+    baseline = report('DictReader', with_dictreader, maxmind, MAXMIND_COLUMNS)
+    elapsed = report('CsvColumns', with_csv_columns, maxmind, MAXMIND_COLUMNS)
+    print("  speedup      {0:.1f}x".format(baseline / elapsed))
+
+    dbip = synthetic_dbip(count, rng)
+    print("dbip (gzip): {0} rows".format(count))
+    baseline = report('DictReader', lambda: with_dictreader(gzip.decompress(dbip), DBIP_FIELDNAMES, DBIP_FIELDNAMES))
+    elapsed = report('CsvColumns', lambda: with_csv_columns(gzip.decompress(dbip), DBIP_FIELDNAMES, DBIP_FIELDNAMES))
+    print("  speedup      {0:.1f}x".format(baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
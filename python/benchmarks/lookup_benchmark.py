@@ -0,0 +1,77 @@
+# lookup_benchmark.py
+#
+# Measures the throughput of bulk address lookups (geoipsets lookup --stdin) against a synthetic binary index,
+# with and without NumPy.
+#
+# usage: python benchmarks/lookup_benchmark.py [count]
+
+import io
+import random
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from geoipsets import index, lookup, ranges  # noqa: E402
+
+COUNTRIES = ('CA', 'US', 'RU', 'CN', 'DE', 'FR', 'GB', 'JP', 'BR', 'IN')
+
+
+def synthetic_index(base_dir: Path, version: int, rng):
+    """
+    Writes an index of about 300k IPv4, or 150k IPv6, disjoint intervals, the size of the dbip country data.
+    """
+    bits, count = (32, 300000) if version == 4 else (128, 150000)
+    bounds = sorted({rng.getrandbits(bits) for _ in range(2 * count)})
+    country_intervals = dict()
+    for first, last in zip(bounds[::2], bounds[1::2]):
+        country_intervals.setdefault(rng.choice(COUNTRIES), []).append((first, last))
+    index.write_index(index.index_path(base_dir / 'dbip', 'ipv' + str(version)), version, country_intervals)
+
+
+def report(name, resolver, addresses):
+    in_file = io.StringIO(''.join(a + '\n' for a in addresses))
+    start = time.perf_counter()
+    resolver.lookup_stream(in_file, io.StringIO(), 'dbip')
+    elapsed = time.perf_counter() - start
+    print("  {0:<12} {1:8.3f}s  {2:12,.0f} lookups/s".format(name, elapsed, len(addresses) / elapsed))
+
+
+def main():
+    parser = ArgumentParser(description="Measures bulk address lookups against a synthetic binary index.")
+    parser.add_argument("count", nargs="?", type=int, default=1000000,
+                        help="IPv4 addresses looked up, a quarter as many IPv6 (default: %(default)s)")
+    count = parser.parse_args().count
+    rng = random.Random(1)
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        synthetic_index(Path(base_dir), 4, rng)
+        synthetic_index(Path(base_dir), 6, rng)
+
+        for version in (4, 6):
+            if version == 4:
+                addresses = [ranges.format_ipv4(rng.getrandbits(32)) for _ in range(count)]
+            else:
+                addresses = [ranges.format_ipv6(rng.getrandbits(128)) for _ in range(count // 4)]
+            print("IPv{0}: {1} addresses".format(version, len(addresses)))
+
+            with lookup.Lookup(Path(base_dir)) as resolver:
+                try:
+                    import numpy  # noqa: F401
+                    report('NumPy', resolver, addresses)
+                except ImportError:
+                    print("  NumPy is not installed")
+
+                numpy_module = sys.modules.get('numpy')
+                sys.modules['numpy'] = None  # force the pure Python path
+                try:
+                    report('bisect', resolver, addresses)
+                finally:
+                    sys.modules['numpy'] = numpy_module
+
+
+if __name__ == "__main__":
+    main()
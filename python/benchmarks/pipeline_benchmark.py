@@ -0,0 +1,295 @@
+# pipeline_benchmark.py
+#
+# Times each stage of set generation (decompress, parse, summarise, write, publish) for both providers and both
+# firewalls on synthetic data (see synthetic.py), through the providers' own methods, then a complete run of each
+# provider, and records the peak memory of each along with how busy each thread of the parsing pipeline was (see
+# pipeline.py). Every case runs in a fresh process so that peak memory is its own. Nothing is downloaded.
+#
+# Decompression overlaps with parsing, so its time is the busy time of the pipeline's decompress stage, and is also
+# part of the parse time (with --jobs, it includes waiting for the blocks parsed by the dbip worker processes).
+# Summarisation, converting the rows into the elements of each set (CIDRs for iptables), is part of parsing too, so
+# it is timed again on its own, on rows read from the data beforehand.
+#
+# Results are printed and, with --output, saved as JSON; --compare prints the change from a previous results file,
+# eg. one saved at another commit.
+#
+# usage: python benchmarks/pipeline_benchmark.py [--ipv4-rows N] [--ipv6-rows N] [--repeat N] [--jobs N]
+#                                                [--queue-depth N] [--output results.json] [--compare baseline.json]
+
+import csv
+import gzip
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+from pathlib import Path
+from types import SimpleNamespace
+from zipfile import ZipFile
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import synthetic  # noqa: E402
+from geoipsets import dbip, maxmind, pipeline, publish, ranges, utils  # noqa: E402
+
+PROVIDERS = ('maxmind', 'dbip')
+FIREWALLS = (utils.Firewall.IP_TABLES.value, utils.Firewall.NF_TABLES.value)
+STAGES = ('decompress', 'parse', 'summarise', 'write', 'publish')
+DATA_FILES = {'maxmind': 'GeoLite2-Country-CSV.zip', 'dbip': 'dbip-country-lite.csv.gz'}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def build_provider(name: str, firewall: str, output_dir: Path, options: dict):
+    # 'options' are the --jobs and --queue-depth of the run
+    families = {utils.AddressFamily.IPV4.value, utils.AddressFamily.IPV6.value}
+    if name == 'maxmind':
+        # maxmind's address families are not built in worker processes: the patched download cannot be pickled
+        return maxmind.MaxMindProvider({firewall}, families, False, 'all', str(output_dir),
+                                       {'account-id': 'benchmark', 'license-key': 'benchmark'}, use_cache=False,
+                                       queue_depth=options['queue_depth'])
+
+    return dbip.DbIpProvider({firewall}, families, False, 'all', str(output_dir), use_cache=False, **options)
+
+
+class Timer:
+    """Records the duration, and the peak memory so far, of each stage."""
+
+    def __init__(self):
+        self.stages = dict()
+
+    def stage(self, name: str, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.record(name, time.perf_counter() - start)
+        return result
+
+    def record(self, name: str, seconds: float):
+        self.stages[name] = dict(seconds=seconds, peak_rss_mb=peak_rss_mb())
+
+
+def parse(name: str, provider, data_path: Path):
+    """
+    Returns the ranges.Networks of each set, keyed by set name, as the provider parses them from 'data_path'.
+    """
+    if name == 'dbip':
+        return provider.parse_csv(str(data_path))
+
+    country_subnets = dict()
+    with ZipFile(data_path, 'r') as zip_file:
+        prefix = os.path.commonprefix(zip_file.namelist())
+        id_cc_map = provider.build_id_cc_map(zip_file, prefix)
+    for addr_fam in utils.AddressFamily:
+        country_subnets.update(provider.parse_blocks(id_cc_map, data_path, prefix, addr_fam, None, provider.metrics))
+    return country_subnets
+
+
+def read_rows(name: str, provider, data_path: Path):
+    """
+    Returns the rows of 'data_path' as (set name, IP version, first address, last address or prefix length) tuples.
+    """
+    rows = []
+    if name == 'dbip':
+        with gzip.open(data_path, 'rt') as csv_file:
+            for ip_start, ip_end, cc in csv.reader(csv_file):
+                if cc != 'ZZ':
+                    version = 6 if ':' in ip_start else 4
+                    parse_address = ranges.parse_ipv4 if version == 4 else ranges.parse_ipv6
+                    rows.append((cc + '.ipv' + str(version), version, parse_address(ip_start), parse_address(ip_end)))
+        return rows
+
+    with ZipFile(data_path, 'r') as zip_file:
+        prefix = os.path.commonprefix(zip_file.namelist())
+        id_cc_map = provider.build_id_cc_map(zip_file, prefix)
+        for version in (4, 6):
+            parse_address = ranges.parse_ipv4 if version == 4 else ranges.parse_ipv6
+            with zip_file.open(prefix + 'GeoLite2-Country-Blocks-IPv{0}.csv'.format(version)) as csv_file:
+                for network, geo_id, registered_geo_id, *_ in csv.reader(io.TextIOWrapper(csv_file)):
+                    if cc := id_cc_map.get(geo_id or registered_geo_id):
+                        address, prefix_length = network.split('/')
+                        rows.append((cc + '.ipv' + str(version), version, parse_address(address), int(prefix_length)))
+    return rows
+
+
+def summarise(name: str, firewall: str, rows: list):
+    """
+    Returns the ranges.Networks of each set built from 'rows', the way the providers build them while parsing.
+    """
+    cidrs = name == 'maxmind' or firewall == utils.Firewall.IP_TABLES.value
+    country_subnets = dict()
+    for set_name, version, first, second in rows:
+        if (networks := country_subnets.get(set_name)) is None:
+            networks = country_subnets[set_name] = ranges.Networks(version, cidrs=cidrs)
+        if name == 'maxmind':
+            networks.add_cidr(first, second)
+        elif cidrs:
+            networks.add_cidrs(ranges.range_to_cidrs(first, second, ranges.IPV4_BITS if version == 4 else
+                                                     ranges.IPV6_BITS))
+        else:
+            networks.add_range(first, second)
+    return country_subnets
+
+
+def write(name: str, provider, country_subnets: dict, staging_dir: Path):
+    if name == 'dbip':
+        provider.build_sets(country_subnets, staging_dir)
+        return
+
+    for addr_fam in utils.AddressFamily:
+        af_subnets = {k: v for k, v in country_subnets.items() if k.endswith('.' + addr_fam.value)}
+        provider.write_sets(af_subnets, addr_fam, staging_dir, provider.metrics)
+
+
+def run_stages(name: str, firewall: str, data_path: Path, work_dir: Path, options: dict):
+    """
+    Runs the stages of one provider and firewall one after the other, in this process.
+    """
+    provider = build_provider(name, firewall, work_dir, options)
+    timer = Timer()
+    country_subnets = timer.stage('parse', parse, name, provider, data_path)
+    timer.record('decompress', provider.metrics.pipeline['decompress'][0])
+
+    with publish.Publisher(provider.base_dir / name) as publisher:
+        timer.stage('write', write, name, provider, country_subnets, publisher.staging_dir)
+        timer.stage('publish', publisher.commit)
+
+    # last, so that the rows held in memory do not add to the peak memory of the other stages
+    rows = read_rows(name, provider, data_path)
+    summarised = timer.stage('summarise', summarise, name, firewall, rows)
+    assert sum(map(len, summarised.values())) == sum(map(len, country_subnets.values())), "summarised differently"
+
+    report = provider.metrics.report(name)
+    return dict(stages=timer.stages, rows=report['rows_parsed'], sets=len(country_subnets),
+                elements=sum(len(n) for n in country_subnets.values()), pipeline=report['pipeline'])
+
+
+def run_generate(name: str, firewall: str, data_path: Path, work_dir: Path, options: dict):
+    """
+    Runs a complete generate() of one provider and firewall, with the download replaced by a copy of 'data_path'.
+    """
+    provider = build_provider(name, firewall, work_dir, options)
+    download = work_dir / data_path.name
+    shutil.copyfile(data_path, download)  # generate() removes its download when done
+
+    if name == 'dbip':
+        provider.download = lambda url, cache_entry=None: str(download)
+    else:
+        provider.download = lambda url, cache_entry=None: (SimpleNamespace(name=str(download)), None)
+
+    start = time.perf_counter()
+    provider.generate()
+    return dict(seconds=time.perf_counter() - start, peak_rss_mb=peak_rss_mb())
+
+
+def run_case(function, name: str, firewall: str, data_path: Path, options: dict):
+    # the providers' progress messages would be interleaved with the results
+    with tempfile.TemporaryDirectory() as work_dir, redirect_stdout(io.StringIO()):
+        return function(name, firewall, data_path, Path(work_dir), options)
+
+
+def run_in_process(function, *args):
+    # a fresh interpreter per case, so that the peak memory of one case does not carry over to the next
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(run_case, function, *args).result()
+
+
+def best(results: list):
+    """
+    Combines repeated runs: the shortest time and the highest peak memory of each stage.
+    """
+    def combine(measures):
+        return dict(seconds=min(m['seconds'] for m in measures), peak_rss_mb=max(m['peak_rss_mb'] for m in measures))
+
+    combined = dict(results[0])
+    if 'stages' in combined:
+        combined['stages'] = {s: combine([r['stages'][s] for r in results]) for s in STAGES}
+    else:
+        combined.update(combine(results))
+    return combined
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def key(result: dict):
+    return result['provider'] + '/' + result['firewall']
+
+
+def print_results(results: list, baseline: dict = None):
+    previous = {key(r): r for r in baseline['results']} if baseline else dict()
+    for result in results:
+        print("{0}: {1:,} rows, {2} sets, {3:,} elements".format(key(result), result['rows'], result['sets'],
+                                                                 result['elements']))
+        measures = [(s, result['stages'][s]) for s in STAGES] + [('generate', result['generate'])]
+        for stage, measure in measures:
+            line = "  {0:<12} {1:8.3f}s  {2:8.1f} MB".format(stage, measure['seconds'], measure['peak_rss_mb'])
+            old = previous.get(key(result))
+            # stages of results saved before the stages were renamed are left out
+            old_measure = old and (old['generate'] if stage == 'generate' else old['stages'].get(stage))
+            if old_measure:
+                line += "  ({0:+.0%} time, {1:+.0%} memory)".format(
+                    measure['seconds'] / old_measure['seconds'] - 1,
+                    measure['peak_rss_mb'] / old_measure['peak_rss_mb'] - 1)
+            print(line)
+        print("  utilisation  " + ", ".join("{0} {1:.2f}".format(stage, measure['utilisation'])
+                                            for stage, measure in result['pipeline'].items()))
+
+
+def main():
+    parser = ArgumentParser(description="Benchmarks the stages of set generation on synthetic data.")
+    parser.add_argument("--ipv4-rows", type=int, default=400000, help="IPv4 rows per provider (default: %(default)s)")
+    parser.add_argument("--ipv6-rows", type=int, default=200000, help="IPv6 rows per provider (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each case, the best is kept (default: 1)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="worker processes parsing the dbip CSV file (default: %(default)s)")
+    parser.add_argument("--queue-depth", type=int, default=pipeline.DEPTH,
+                        help="blocks queued between the parsing threads (default: %(default)s)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="print the change from the results in this JSON file")
+    args = parser.parse_args()
+
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+    options = dict(jobs=args.jobs, queue_depth=args.queue_depth)
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = Path(data_dir)
+        synthetic.write_maxmind_zip(data_dir / DATA_FILES['maxmind'], args.ipv4_rows, args.ipv6_rows)
+        synthetic.write_dbip_gz(data_dir / DATA_FILES['dbip'], args.ipv4_rows, args.ipv6_rows)
+
+        for name in PROVIDERS:
+            for firewall in FIREWALLS:
+                data_path = data_dir / DATA_FILES[name]
+                result = best([run_in_process(run_stages, name, firewall, data_path, options)
+                               for _ in range(args.repeat)])
+                result['generate'] = best([run_in_process(run_generate, name, firewall, data_path, options)
+                                           for _ in range(args.repeat)])
+                results.append(dict(provider=name, firewall=firewall, **result))
+
+    print_results(results, baseline)
+    if args.output:
+        report = dict(commit=git_commit(), python=platform.python_version(), platform=platform.platform(),
+                      ipv4_rows=args.ipv4_rows, ipv6_rows=args.ipv6_rows, repeat=args.repeat, jobs=args.jobs,
+                      queue_depth=args.queue_depth, results=results)
+        Path(args.output).write_text(json.dumps(report, indent=2) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# ranges_benchmark.py
+#
+# Compares the ipaddress based range to CIDR conversion previously used by the dbip provider with the integer
+# engine in geoipsets.ranges, and with its NumPy batch mode if NumPy is installed.
+#
+# usage: python benchmarks/ranges_benchmark.py [count]
+
+import random
+import sys
+import time
+from argparse import ArgumentParser
+from ipaddress import ip_address, summarize_address_range
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from geoipsets import ranges  # noqa: E402
+
+
+def synthetic_ranges(count: int, version: int, seed: int = 1):
+    """
+    Returns 'count' adjacent, randomly sized ranges as (start, end) text pairs, like those in the dbip CSV.
+    Most ranges are made of whole /24 (IPv4) or /48 (IPv6) blocks, the typical allocation granularity.
+    """
+    rng = random.Random(seed)
+    if version == 4:
+        format_address, block, first = ranges.format_ipv4, 1 << 8, 1 << 24
+    else:
+        format_address, block, first = ranges.format_ipv6, 1 << 80, 1 << 125
+    rows = []
+    for _ in range(count):
+        if rng.random() < 0.1:  # odd sized
+            last = first + rng.randrange(block)
+        else:
+            last = first + block * rng.randint(1, 16) - 1
+        rows.append((format_address(first), format_address(last)))
+        first = last + 1
+    return rows
+
+
+def with_ipaddress(rows):
+    return [[n.with_prefixlen for n in summarize_address_range(ip_address(s), ip_address(e))] for s, e in rows]
+
+
+def with_ranges(rows, version):
+    parse_address = ranges.parse_ipv4 if version == 4 else ranges.parse_ipv6
+    return [ranges.summarize(parse_address(s), parse_address(e), version) for s, e in rows]
+
+
+def with_batch(rows, version):
+    # arithmetic only, text rendering is the same as for with_ranges()
+    parse_address = ranges.parse_ipv4 if version == 4 else ranges.parse_ipv6
+    if version == 4:
+        firsts = [parse_address(s) for s, _ in rows]
+        lasts = [parse_address(e) for _, e in rows]
+    else:
+        mask = (1 << 64) - 1
+        firsts = [(a >> 64, a & mask) for a in (parse_address(s) for s, _ in rows)]
+        lasts = [(a >> 64, a & mask) for a in (parse_address(e) for _, e in rows)]
+    return ranges.summarize_batch(firsts, lasts, version)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser(description="Compares range to CIDR conversion with ipaddress and with geoipsets.ranges.")
+    parser.add_argument("count", nargs="?", type=int, default=20000,
+                        help="synthetic ranges of each address family (default: %(default)s)")
+    count = parser.parse_args().count
+    try:
+        import numpy  # noqa: F401
+        have_numpy = True
+    except ImportError:
+        have_numpy = False
+
+    for version in (4, 6):
+        rows = synthetic_ranges(count, version)
+        expected, baseline = timed(with_ipaddress, rows)
+        actual, elapsed = timed(with_ranges, rows, version)
+        assert actual == expected, "integer engine output differs from ipaddress"
+        cidrs = sum(len(c) for c in expected)
+        print("IPv{0}: {1} ranges -> {2} CIDRs".format(version, count, cidrs))
+        print("  ipaddress        {0:8.3f}s".format(baseline))
+        print("  ranges           {0:8.3f}s  {1:5.1f}x".format(elapsed, baseline / elapsed))
+        if have_numpy:
+            (rows_idx, _, _), elapsed = timed(with_batch, rows, version)
+            assert len(rows_idx) == cidrs
+            print("  ranges (batch)   {0:8.3f}s  {1:5.1f}x  (excluding text rendering)".format(
+                elapsed, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
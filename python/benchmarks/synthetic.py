@@ -0,0 +1,143 @@
+# synthetic.py
+#
+# Generators of realistic synthetic provider data, so that benchmarks run offline and on inputs of any size:
+# a MaxMind GeoLite2 Country CSV zip (Locations, Blocks-IPv4, Blocks-IPv6) and a dbip country lite .csv.gz.
+#
+# usage: python benchmarks/synthetic.py OUTPUT_DIR [IPv4 rows] [IPv6 rows]
+
+import gzip
+import random
+import string
+import sys
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from geoipsets import ranges  # noqa: E402
+
+MAXMIND_DIR = 'GeoLite2-Country-CSV_20240101/'
+MAXMIND_LOCATIONS_HEADER = ('geoname_id,locale_code,continent_code,continent_name,country_iso_code,country_name,'
+                            'is_in_european_union\n')
+MAXMIND_BLOCKS_HEADER = ('network,geoname_id,registered_country_geoname_id,represented_country_geoname_id,'
+                         'is_anonymous_proxy,is_satellite_provider\n')
+CONTINENTS = (('6255146', 'AF', 'Africa'), ('6255147', 'AS', 'Asia'), ('6255148', 'EU', 'Europe'),
+              ('6255149', 'NA', 'North America'), ('6255151', 'OC', 'Oceania'), ('6255150', 'SA', 'South America'))
+
+
+def country_codes(count: int = 250):
+    """
+    Returns 'count' distinct two letter country codes, in a fixed order.
+    """
+    codes = [a + b for a in string.ascii_uppercase for b in string.ascii_uppercase]
+    return random.Random(0).sample(codes, count)
+
+
+def country_weights(count: int):
+    # a few countries hold most of the address space, as in the real data
+    return [1.0 / (rank + 1) for rank in range(count)]
+
+
+def networks(count: int, version: int, rng):
+    """
+    Yields 'count' ascending, non-overlapping (network, prefix length) pairs, with gaps, like the MaxMind blocks.
+    """
+    if version == 4:
+        bits, ip, prefixes = ranges.IPV4_BITS, 1 << 24, (18, 20, 22, 23, 24, 24, 24, 24, 24, 25, 26, 28, 29, 30, 32)
+    else:
+        bits, ip, prefixes = ranges.IPV6_BITS, 0x2001 << 112, (29, 32, 32, 36, 40, 44, 48, 48, 48, 56, 64)
+    for _ in range(count):
+        prefix = rng.choice(prefixes)
+        size = 1 << (bits - prefix)
+        ip = (ip + size - 1) & ~(size - 1)  # align
+        yield ip, prefix
+        ip += size * (1 + (rng.random() < 0.2))
+
+
+def address_ranges(count: int, version: int, rng):
+    """
+    Yields 'count' adjacent (first, last) ranges of varied size, like those in the dbip CSV.
+    Most ranges are made of whole /24 (IPv4) or /48 (IPv6) blocks, the typical allocation granularity.
+    """
+    if version == 4:
+        block, first = 1 << 8, 1 << 24
+    else:
+        block, first = 1 << 80, 0x2001 << 112
+    while count > 0:
+        if rng.random() < 0.1 and count > 1:  # a block split between two ranges, at an eighth of the block
+            split = first + rng.randrange(1, 8) * (block // 8)
+            yield first, split - 1
+            yield split, first + block - 1
+            first += block
+            count -= 2
+        else:
+            last = first + block * rng.choice((1, 1, 1, 2, 2, 3, 4, 4, 8, 16, 32, 64)) - 1
+            yield first, last
+            first = last + 1
+            count -= 1
+
+
+def write_maxmind_zip(path: Path, ipv4_rows: int, ipv6_rows: int, seed: int = 1):
+    """
+    Writes a GeoLite2 Country CSV zip with 250 countries and the given number of IPv4 and IPv6 blocks.
+    """
+    rng = random.Random(seed)
+    codes = country_codes()
+    geoname_ids = [str(1000000 + i) for i in range(len(codes))]
+    weights = country_weights(len(codes))
+
+    locations = [MAXMIND_LOCATIONS_HEADER]
+    for geoname_id, code, name in CONTINENTS:  # continents have no country code
+        locations.append('{0},en,{1},"{2}",,,0\n'.format(geoname_id, code, name))
+    for geoname_id, cc in zip(geoname_ids, codes):
+        locations.append('{0},en,EU,Europe,{1},"Country {1}",0\n'.format(geoname_id, cc))
+
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr(MAXMIND_DIR + 'LICENSE.txt', 'synthetic data\n')
+        zip_file.writestr(MAXMIND_DIR + 'GeoLite2-Country-Locations-en.csv', ''.join(locations))
+        for version, count in ((4, ipv4_rows), (6, ipv6_rows)):
+            format_address = ranges.format_ipv4 if version == 4 else ranges.format_ipv6
+            geo_ids = rng.choices(geoname_ids, weights, k=count)
+            rows = [MAXMIND_BLOCKS_HEADER]
+            for (network, prefix), geo_id in zip(networks(count, version, rng), geo_ids):
+                draw = rng.random()
+                if draw < 0.02:  # registered country only
+                    columns = (',' + geo_id, ',')
+                elif draw < 0.025:  # anonymous proxy, no country
+                    columns = (',', ',1')
+                else:
+                    columns = (geo_id + ',' + geo_id, ',0')
+                rows.append('{0}/{1},{2},{3},0\n'.format(format_address(network), prefix, *columns))
+            zip_file.writestr(MAXMIND_DIR + 'GeoLite2-Country-Blocks-IPv{0}.csv'.format(version), ''.join(rows))
+
+
+def write_dbip_gz(path: Path, ipv4_rows: int, ipv6_rows: int, seed: int = 1):
+    """
+    Writes a dbip country lite .csv.gz with the given number of IPv4 and IPv6 ranges, some of them unassigned (ZZ).
+    """
+    rng = random.Random(seed)
+    codes = country_codes()
+    weights = country_weights(len(codes))
+
+    with gzip.open(path, 'wt') as csv_file:
+        for version, count in ((4, ipv4_rows), (6, ipv6_rows)):
+            format_address = ranges.format_ipv4 if version == 4 else ranges.format_ipv6
+            country = rng.choices(codes, weights, k=count)
+            lines = []
+            for (first, last), cc in zip(address_ranges(count, version, rng), country):
+                lines.append('{0},{1},{2}\n'.format(format_address(first), format_address(last),
+                                                    'ZZ' if rng.random() < 0.01 else cc))
+            csv_file.write(''.join(lines))
+
+
+def main():
+    output_dir = Path(sys.argv[1])
+    ipv4_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 400000
+    ipv6_rows = int(sys.argv[3]) if len(sys.argv) > 3 else ipv4_rows // 2
+    output_dir.mkdir(parents=True, exist_ok=True)
+    write_maxmind_zip(output_dir / 'GeoLite2-Country-CSV.zip', ipv4_rows, ipv6_rows)
+    write_dbip_gz(output_dir / 'dbip-country-lite.csv.gz', ipv4_rows, ipv6_rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,13 @@
 # __main__.py
 
 import configparser
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from configparser import ConfigParser
 from pathlib import Path
-from sys import argv
+from sys import argv, stderr, stdin, stdout
+from traceback import print_exception
 
-from . import utils, maxmind, dbip
+from . import utils, lookup, metrics, pipeline, profiling, registry
 
 
 def get_version():
@@ -28,6 +29,34 @@ def get_config_parser(path):
         return None
 
 
+def positive_int(value):
+    """
+    argparse type for options that take a count of at least 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise ArgumentTypeError("invalid int value: '{0}'".format(value))
+    if number < 1:
+        raise ArgumentTypeError("must be at least 1: '{0}'".format(value))
+
+    return number
+
+
+def non_negative_int(value):
+    """
+    argparse type for options that take a count of at least 0.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise ArgumentTypeError("invalid int value: '{0}'".format(value))
+    if number < 0:
+        raise ArgumentTypeError("must be at least 0: '{0}'".format(value))
+
+    return number
+
+
 def get_config(cli_args=None):
     """
     Generate configuration
@@ -49,8 +78,9 @@ def get_config(cli_args=None):
                         action="extend",
                         nargs="+",
                         type=str.lower,
-                        choices={'dbip', 'maxmind'},
-                        help="dataset provider(s) (default: {0})".format('dbip'))
+                        choices=registry.Names(),
+                        metavar="PROVIDER",  # listing the choices in usage would look up installed providers
+                        help="dataset provider(s): %(choices)s (default: {0})".format('dbip'))
     parser.add_argument("-f", "--firewall",
                         action="extend",
                         nargs="+",
@@ -83,7 +113,87 @@ def get_config(cli_args=None):
                         dest="checksum",
                         action="store_false",
                         help="disable checksum validation of downloaded files")
-    parser.set_defaults(checksum=True)
+    parser.add_argument("--cache",
+                        dest="cache",
+                        action="store_true",
+                        help="""keep downloaded files under the output directory and skip the run when the upstream
+                             data has not changed (default)""")
+    parser.add_argument("--no-cache",
+                        dest="cache",
+                        action="store_false",
+                        help="always download and regenerate all sets")
+    parser.add_argument("--aggregate",
+                        action="store_true",
+                        help="""merge overlapping and adjacent networks within each set, writing minimal CIDR lists for
+                             ipset and minimal ranges for nftables""")
+    parser.add_argument("--delta",
+                        action="store_true",
+                        help="""also write, next to each set, a script of the elements added and deleted since the
+                             previous run (CC.ipvN.delta), emptied if the data is unchanged; nftables deltas update
+                             the named sets declared by --nft-batch, so they are only written with it""")
+    parser.add_argument("--ipset-swap",
+                        action="store_true",
+                        help="""write ipset files that restore into a temporary set and swap it with the live set, so
+                             existing sets are replaced atomically (with a fixed maxelem of 16777216, so sets
+                             created without it must be destroyed once)""")
+    parser.add_argument("--nft-batch",
+                        choices=('per-set', 'combined'),
+                        help="""also write 'nft -f' scripts that declare named interval sets in table 'inet geoipsets'
+                             and refresh them in a single transaction, one script per set or one per address family
+                             covering all sets""")
+    parser.add_argument("--index",
+                        action="store_true",
+                        help="""also write a binary interval index of each provider and address family
+                             (index/ipvN/geoipsets.idx) that other tools can memory-map""")
+    parser.add_argument("--low-memory",
+                        action="store_true",
+                        help="""spool the elements of each set to disk as they are parsed instead of holding the
+                             dataset in memory, eg. on firewall appliances (cannot be combined with --delta or
+                             --index)""")
+    parser.add_argument("--input-file",
+                        metavar="FILE",
+                        help="""build the sets of a single provider from an archive already downloaded to FILE, with
+                             its checksum in FILE.sha1 (dbip, of the CSV file) or FILE.sha256 (maxmind), instead of
+                             downloading it""")
+    parser.add_argument("--mirror-dir",
+                        metavar="DIR",
+                        help="""read the archives, and their checksums, from DIR/<provider>/ instead of downloading
+                             them from the providers, DIR being a local directory or an http(s) URL, eg. a mirror
+                             shared by a fleet of hosts and populated by --fetch-only""")
+    parser.add_argument("--fetch-only",
+                        action="store_true",
+                        help="""download the archives, and their checksums, into the local --mirror-dir without
+                             building any sets""")
+    parser.add_argument("--metrics",
+                        metavar="FILE",
+                        help="""write the stage durations, bytes downloaded, rows parsed, set sizes and peak memory of
+                             the run to FILE as JSON, or to standard output if FILE is '-'""")
+    parser.add_argument("--prometheus",
+                        metavar="FILE",
+                        help="""write the same metrics to FILE for the Prometheus node exporter's textfile collector,
+                             eg. /var/lib/node_exporter/textfile_collector/geoipsets.prom""")
+    parser.add_argument("--profile",
+                        metavar="DIR",
+                        help="""profile the run of each provider and write the reports to DIR: <provider>.prof and
+                             <provider>.cpu.txt (cProfile), <provider>.memory.txt (tracemalloc); implies
+                             --queue-depth 0, so that the parsing stages run on the profiled thread""")
+    parser.add_argument("--profiler",
+                        choices=profiling.PROFILERS,
+                        default='cpu',
+                        help="what --profile measures: time, allocations or both (default: %(default)s)")
+    parser.add_argument("-j", "--jobs",
+                        type=positive_int,
+                        default=1,
+                        help="""number of worker processes used to build sets concurrently, eg. one per provider
+                             and one per address family (maxmind), or parsing blocks of the CSV file (dbip)
+                             (default: %(default)s)""")
+    parser.add_argument("--queue-depth",
+                        type=non_negative_int,
+                        default=pipeline.DEPTH,
+                        metavar="N",
+                        help="""number of blocks queued between the decompress, parse and collect threads of each
+                             provider, 0 to run them one after the other on a single thread (default: %(default)s)""")
+    parser.set_defaults(checksum=True, cache=True)
 
     # set defaults
     default_options = dict()
@@ -94,6 +204,22 @@ def get_config(cli_args=None):
     default_options['address-family'] = {utils.AddressFamily.IPV4.value}
     default_options['countries'] = 'all'
     default_options['checksum'] = parser.parse_args(cli_args).checksum
+    default_options['cache'] = parser.parse_args(cli_args).cache
+    default_options['aggregate'] = parser.parse_args(cli_args).aggregate
+    default_options['jobs'] = parser.parse_args(cli_args).jobs
+    default_options['queue-depth'] = parser.parse_args(cli_args).queue_depth
+    default_options['delta'] = parser.parse_args(cli_args).delta
+    default_options['nft-batch'] = parser.parse_args(cli_args).nft_batch
+    default_options['ipset-swap'] = parser.parse_args(cli_args).ipset_swap
+    default_options['index'] = parser.parse_args(cli_args).index
+    default_options['low-memory'] = parser.parse_args(cli_args).low_memory
+    default_options['input-file'] = parser.parse_args(cli_args).input_file
+    default_options['mirror-dir'] = parser.parse_args(cli_args).mirror_dir
+    default_options['fetch-only'] = parser.parse_args(cli_args).fetch_only
+    default_options['metrics'] = parser.parse_args(cli_args).metrics
+    default_options['prometheus'] = parser.parse_args(cli_args).prometheus
+    default_options['profile'] = parser.parse_args(cli_args).profile
+    default_options['profiler'] = parser.parse_args(cli_args).profiler
     options = default_options
 
     # step 1: load a valid configuration file, if one exists
@@ -170,30 +296,201 @@ def get_config(cli_args=None):
                 provider_options = config_file[p]
                 options[p] = provider_options
 
+    # step 8: archive sources
+    if options.get('input-file') and len(options.get('provider')) > 1:
+        parser.error("--input-file requires a single provider")
+    if options.get('fetch-only') and (not options.get('mirror-dir') or utils.is_url(options.get('mirror-dir'))):
+        parser.error("--fetch-only requires a local --mirror-dir")
+
+    # step 9: profiling
+    # cProfile only traces the thread it is enabled on (before Python 3.12), so no stage runs on a thread of its own
+    if options.get('profile'):
+        options['queue-depth'] = 0
+
     return options
 
 
+def build_provider(name, opts):
+    """
+    Returns the provider called 'name', configured from 'opts'.
+    """
+    common_args = (opts.get('firewall'),
+                   opts.get('address-family'),
+                   opts.get('checksum'),
+                   opts.get('countries'),
+                   opts.get('output-dir'))
+    common_kwargs = dict(use_cache=opts.get('cache'),
+                         aggregate=opts.get('aggregate'),
+                         jobs=opts.get('jobs'),
+                         queue_depth=opts.get('queue-depth'),
+                         delta=opts.get('delta'),
+                         nft_batch=opts.get('nft-batch'),
+                         ipset_swap=opts.get('ipset-swap'),
+                         write_index=opts.get('index'),
+                         low_memory=opts.get('low-memory'),
+                         input_file=opts.get('input-file'),
+                         mirror_dir=opts.get('mirror-dir'),
+                         fetch_only=opts.get('fetch-only'))
+
+    # the provider's section of the configuration file, eg. [maxmind], holds its own options
+    return registry.load(name)(*common_args, opts.get(name), **common_kwargs)
+
+
+def generate(name, opts):
+    """
+    Builds the sets of a single provider, or only fetches its archive into the mirror, and returns its metrics report.
+    Module level so that it can be run in a worker process.
+    """
+    provider = build_provider(name, opts)
+    with profiling.profile(opts.get('profile'), name, opts.get('profiler')):
+        if opts.get('fetch-only'):
+            provider.fetch()
+        else:
+            provider.generate()
+    return provider.metrics.report(name)
+
+
+def generate_concurrently(providers, opts):
+    """
+    Runs each provider in its own worker process so that one provider's download overlaps with another's parsing.
+    A failing provider does not stop the others. Returns the highest exit code of all providers, and their metrics.
+    """
+    from concurrent.futures import ProcessPoolExecutor  # only needed, and imported, with --jobs
+
+    exit_codes = dict()
+    reports = []
+    with ProcessPoolExecutor(max_workers=min(opts.get('jobs'), len(providers))) as executor:
+        futures = {name: executor.submit(generate, name, opts) for name in providers}
+        for name, future in futures.items():
+            try:
+                reports.append(future.result())
+                exit_codes[name] = 0
+            except SystemExit as e:
+                # providers exit with an error message, or an explicit exit code
+                if isinstance(e.code, int):
+                    exit_codes[name] = e.code
+                else:
+                    print(e.code, file=stderr)
+                    exit_codes[name] = 1
+            except Exception as e:
+                print_exception(e)
+                exit_codes[name] = 1
+
+    for name, exit_code in exit_codes.items():
+        print("{0}: {1}".format(name, "done" if exit_code == 0 else "failed (exit code {0})".format(exit_code)))
+
+    reports.extend(metrics.failed(name) for name, exit_code in exit_codes.items() if exit_code != 0)
+    return max(exit_codes.values()), reports
+
+
+def write_metrics(opts, reports: list):
+    """
+    Writes the metrics reports of the providers run, if requested.
+    """
+    if opts.get('metrics'):
+        metrics.write_json(opts.get('metrics'), reports)
+    if opts.get('prometheus'):
+        metrics.write_prometheus(opts.get('prometheus'), reports)
+
+
+def get_lookup_config(cli_args):
+    """
+    Generate configuration of the 'lookup' command: the addresses, providers and the directory holding the sets.
+    """
+    default_config_path = "/etc/geoipsets.conf"
+    default_output_dir = "/tmp"
+
+    parser = ArgumentParser(prog="geoipsets lookup",
+                            description="""Reports the country, and the set files, containing each IP address in the
+                            sets generated by each provider.""")
+    parser.add_argument("address",
+                        nargs="*",
+                        help="IPv4 or IPv6 address(es) to look up")
+    parser.add_argument("--stdin",
+                        action="store_true",
+                        help="""read addresses from standard input, one per line, and write 'address,country' lines
+                             using the first provider with generated sets""")
+    parser.add_argument("-p", "--provider",
+                        action="extend",
+                        nargs="+",
+                        type=str.lower,
+                        choices=registry.Names(),
+                        metavar="PROVIDER",
+                        help="dataset provider(s) to search: %(choices)s (default: all those with generated sets)")
+    parser.add_argument("-o", "--output-dir",
+                        type=str,
+                        help="directory where geoipsets were saved (default: {0})".format(default_output_dir))
+    parser.add_argument("-c", "--config-file",
+                        type=str,
+                        default=default_config_path,
+                        help="path to configuration file (default: {0})".format(default_config_path))
+    args = parser.parse_args(cli_args)
+    if not args.address and not args.stdin:
+        parser.error("an address, or --stdin, is required")
+
+    output_dir = args.output_dir
+    if output_dir is None and (config_file := get_config_parser(args.config_file)) is not None:
+        if config_file.has_section('general'):
+            output_dir = config_file['general'].get('output-dir')
+
+    return dict(address=args.address,
+                stdin=args.stdin,
+                provider=[p for p in registry.names() if args.provider is None or p in args.provider],
+                output_dir=output_dir or default_output_dir)
+
+
+def lookup_main(cli_args):
+    """
+    geoipsets lookup ADDRESS [ADDRESS ...]
+    Prints one line per address and provider: address, provider, country code (or '-') and the set files.
+    Returns 1 if an address is invalid, 0 otherwise.
+
+    geoipsets lookup --stdin
+    Streams 'address,country code' lines for the addresses read from standard input, eg. to enrich logs.
+    """
+    opts = get_lookup_config(cli_args)
+    exit_code = 0
+    with lookup.Lookup(Path(opts.get('output_dir')) / 'geoipsets', opts.get('provider')) as resolver:
+        if opts.get('stdin'):
+            if not resolver.providers:
+                raise SystemExit("ERROR: No generated sets found in '{0}'".format(resolver.base_dir))
+            resolver.lookup_stream(stdin, stdout, resolver.providers[0])
+
+        for address in opts.get('address'):
+            try:
+                results = resolver.lookup(address)
+            except ValueError as e:
+                print("ERROR: {0}".format(e), file=stderr)
+                exit_code = 1
+                continue
+
+            for provider, country_code, set_files in results:
+                print(" ".join([address, provider, country_code or '-'] + [str(f) for f in set_files]))
+
+    return exit_code
+
+
 def main():
+    if argv[1:2] == ['lookup']:
+        raise SystemExit(lookup_main(argv[2:]))
+
     opts = get_config()
-    providers = opts.get('provider')
-    print("Building geoipsets...")
-
-    if "maxmind" in providers:
-        mmp = maxmind.MaxMindProvider(opts.get('firewall'),
-                                      opts.get('address-family'),
-                                      opts.get('checksum'),
-                                      opts.get('countries'),
-                                      opts.get('output-dir'),
-                                      opts.get('maxmind'))
-        mmp.generate()
-
-    if "dbip" in providers:
-        dbipp = dbip.DbIpProvider(opts.get('firewall'),
-                                  opts.get('address-family'),
-                                  opts.get('checksum'),
-                                  opts.get('countries'),
-                                  opts.get('output-dir'))
-        dbipp.generate()
+    # preserve the historical order: maxmind first, then dbip, then any others
+    providers = [p for p in registry.names() if p in opts.get('provider')]
+    print("Fetching geoipsets data..." if opts.get('fetch-only') else "Building geoipsets...")
+
+    if opts.get('jobs') > 1 and len(providers) > 1:
+        exit_code, reports = generate_concurrently(providers, opts)
+        write_metrics(opts, reports)
+        raise SystemExit(exit_code)
+
+    reports = []
+    try:
+        for name in providers:
+            reports.append(metrics.failed(name))  # until it completes
+            reports[-1] = generate(name, opts)
+    finally:
+        write_metrics(opts, reports)
 
 
 if __name__ == "__main__":
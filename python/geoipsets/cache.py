@@ -0,0 +1,120 @@
+# cache.py
+
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+
+class CacheEntry:
+    """
+    A downloaded archive kept under the output directory, keyed by URL.
+
+    The HTTP validators (ETag, Last-Modified and the Content-Disposition filename) of the cached copy are recorded
+    alongside it so that later runs can issue a conditional request and skip the download, and the rest of the run,
+    when the upstream data has not changed.
+    """
+
+    def __init__(self, cache_dir: Path, url: str, suffix: str, require_verified: bool):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+        self.cache_dir = cache_dir
+        self.url = url
+        self.path = cache_dir / (key + suffix)
+        self.metadata_path = cache_dir / (key + '.json')
+        self.metadata = self.load(require_verified)
+        self.validators = dict()
+
+    def load(self, require_verified: bool):
+        try:
+            with open(self.metadata_path, 'r') as metadata_file:
+                metadata = json.load(metadata_file)
+        except (OSError, ValueError):
+            return dict()
+
+        # ignore stale or incomplete entries, and those never checked against a checksum if one is now required
+        if metadata.get('url') != self.url or not self.path.is_file():
+            return dict()
+        if require_verified and not metadata.get('verified'):
+            return dict()
+
+        return metadata
+
+    def save(self):
+        with NamedTemporaryFile('w', dir=self.cache_dir, suffix='.tmp', delete=False) as metadata_file:
+            json.dump(self.metadata, metadata_file)
+        os.replace(metadata_file.name, self.metadata_path)
+
+    def request_headers(self):
+        """
+        Headers that turn a GET into a conditional request for the cached copy, if there is one.
+        """
+        headers = dict()
+        if etag := self.metadata.get('etag'):
+            headers['If-None-Match'] = etag
+        if last_modified := self.metadata.get('last-modified'):
+            headers['If-Modified-Since'] = last_modified
+
+        return headers
+
+    def is_current(self, http_response):
+        """
+        Does the cached copy match the file 'http_response' would deliver?
+        Only the response headers are inspected so the body need not be read when the answer is yes.
+        """
+        self.validators = get_validators(http_response)
+        if not self.metadata:
+            return False
+
+        if http_response.status_code == 304:  # Not Modified
+            return True
+
+        # not every server honours conditional requests, so compare the validators directly
+        # the strongest validator present in both the cached metadata and the response decides
+        for validator in ('etag', 'filename', 'last-modified'):
+            if validator in self.validators and validator in self.metadata:
+                return self.validators[validator] == self.metadata[validator]
+
+        return False
+
+    def temporary_file(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        return NamedTemporaryFile(dir=self.cache_dir, suffix='.part', delete=False)
+
+    def store(self, file_name: str, verified: bool):
+        """
+        Move a completed download into the cache and record its validators.
+        Any files cached for other URLs (eg. last month's dbip release) are evicted.
+        """
+        os.replace(file_name, self.path)
+        self.metadata = dict(url=self.url, verified=verified, **self.validators)
+        self.save()
+
+        for path in self.cache_dir.iterdir():
+            if path not in (self.path, self.metadata_path):
+                path.unlink()
+
+    def is_generated(self, fingerprint: dict):
+        """
+        Were sets last generated from the cached copy using the same options?
+        """
+        return self.metadata.get('generated') == fingerprint
+
+    def set_generated(self, fingerprint: dict):
+        self.metadata['generated'] = fingerprint
+        self.save()
+
+
+def get_validators(http_response):
+    headers = http_response.headers
+    validators = dict()
+    if etag := headers.get('ETag'):
+        validators['etag'] = etag
+    if last_modified := headers.get('Last-Modified'):
+        validators['last-modified'] = last_modified
+    # eg. Content-Disposition: attachment; filename=GeoLite2-Country-CSV_20200922.zip
+    if match := re.search(r'filename="?([^";]+)"?', headers.get('Content-Disposition', '')):
+        validators['filename'] = match.group(1)
+
+    return validators
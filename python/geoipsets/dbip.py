@@ -2,25 +2,29 @@
 
 import gzip
 import hashlib
-import shutil
 import os
-from csv import DictReader
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime
-from io import TextIOWrapper
-from ipaddress import ip_address, summarize_address_range
+from multiprocessing import get_context
 from tempfile import NamedTemporaryFile
 
-import requests
 from bs4 import BeautifulSoup
 
-from . import utils
+from . import delta, ipset, nft, pipeline, publish, ranges, utils
 
 
 class DbIpProvider(utils.AbstractProvider):
     """ DBIP IP range set provider. """
 
-    def __init__(self, firewall: set, address_family: set, checksum: bool, countries: set, output_dir: str):
-        super().__init__(firewall, address_family, checksum, countries, output_dir)
+    # the checksum file holds the sha1sum of the CSV file (not the GZIP file), as published by DB-IP
+    archive_name = 'dbip-country-lite.csv.gz'
+    checksum_suffix = '.sha1'
+
+    def __init__(self, firewall: set, address_family: set, checksum: bool, countries: set, output_dir: str,
+                 provider_options: dict = None, **kwargs):
+        # DB-IP has no provider-specific options, 'provider_options' is accepted like any other provider
+        super().__init__(firewall, address_family, checksum, countries, output_dir, **kwargs)
 
     def generate(self):
         """
@@ -29,76 +33,163 @@ class DbIpProvider(utils.AbstractProvider):
 
         ip_start, ip_end, country
         """
-        gzip_ref = self.download()  # comment out for testing
-        # dictionary of subnet lists, indexed by filename
-        # filename is CC.address_family -- eg. CA.ipv4
-        country_subnets = dict()
+        url = self.download_url()
+        source = self.archive_source('dbip')
+        if local := source is not None and not utils.is_url(source):
+            # a local copy, eg. in a mirror directory shared by the fleet, is read in place and never cached
+            cache_entry = None
+            gzip_ref = source
+        else:
+            # an http(s) mirror is downloaded, and cached, like the upstream URL
+            cache_entry = self.cache_entry('dbip', source or url, '.csv.gz')
+            with self.metrics.stage('download'):
+                gzip_ref = self.download(source or url, cache_entry)  # comment out for testing
+
+        sha1_hash = None
+        downloaded = gzip_ref is not None and not local
+        if gzip_ref is None:  # the cached copy is current
+            if self.is_up_to_date('dbip', cache_entry):
+                print("DB-IP data is unchanged, skipping...")
+                self.metrics.status = 'unchanged'
+                if self.delta:  # the deltas of the previous run would now be applied twice
+                    publish.Publisher(self.base_dir / 'dbip').empty_deltas()
+                return
+            gzip_ref = cache_entry.path
+        elif self.checksum:
+            # the checksum is that of the CSV file (not the GZIP file), it is computed as the CSV file is parsed
+            sha1_hash = hashlib.sha1()
+
+        # with --low-memory elements are spooled to disk as they are parsed, instead of being held in memory
+        set_spool = self.open_spool('dbip')
+        with self.metrics.stage('parse'):
+            country_subnets = self.parse_csv(gzip_ref, set_spool, sha1_hash)
+
+        if sha1_hash:
+            # nothing is written, published or cached unless the CSV file parsed is the one published by DB-IP
+            with self.metrics.stage('checksum'):
+                self.check_checksum(sha1_hash, gzip_ref if downloaded else None, set_spool)
+
+        if downloaded and cache_entry:
+            cache_entry.store(gzip_ref, self.checksum)
+            gzip_ref = cache_entry.path
+
+        # sets are generated into a staging directory, then only the changed files are published
+        with publish.Publisher(self.base_dir / 'dbip') as publisher:
+            with self.metrics.stage('write'):
+                self.build_sets(country_subnets, publisher.staging_dir)
+            if set_spool:
+                set_spool.close()
+            with self.metrics.stage('publish'):
+                changed, removed = publisher.commit(self.disabled_outputs())
+            print("DB-IP sets published: {0} changed, {1} removed".format(len(changed), len(removed)))
+
+        if cache_entry:
+            cache_entry.set_generated(self.fingerprint())
+        elif downloaded:
+            os.remove(gzip_ref)
+
+    def fetch(self):
+        """
+        Downloads the GZIP file into the mirror directory, with the sha1sum of the CSV file it contains (--fetch-only).
+        """
+        with self.metrics.stage('download'):
+            gzip_ref = self.download(self.download_url())
+
+        # the CSV file is always hashed for the mirror's checksum file, and validated unless disabled
+        with self.metrics.stage('checksum'):
+            sha1_hash = hashlib.sha1()
+            with gzip.GzipFile(gzip_ref, 'rb') as csv_file_bytes:
+                while block := csv_file_bytes.read(utils.BLOCK_SIZE):
+                    sha1_hash.update(block)
+            if self.checksum:
+                self.check_checksum(sha1_hash, gzip_ref)
 
-        with gzip.GzipFile(gzip_ref, 'rb') as csv_file_bytes:
-            # with gzip.GzipFile('/tmp/tmphq4qgkfp.csv.gz', 'rb') as csv_file_bytes:
+        with self.metrics.stage('publish'):
+            archive = self.publish_archive('dbip', gzip_ref, sha1_hash.hexdigest())
+        print("DB-IP data fetched: {0}".format(archive))
 
-            # validate checksum of the CSV file (not the GZIP file)
-            if self.checksum:
-                self.check_checksum(csv_file_bytes)
-
-            rows = DictReader(TextIOWrapper(csv_file_bytes), fieldnames=("ip_start", "ip_end", "country"))
-            for r in rows:
-                cc = r['country']
-                # configparser forces keys to lower case by default
-                if cc != 'ZZ' and (self.countries == 'all' or cc.lower() in self.countries):
-                    ip_start = ip_address(r['ip_start'])
-                    ip_version = ip_start.version
-                    if (ip_version == 4 and self.ipv4) or (ip_version == 6 and self.ipv6):
-                        inet_suffix = 'ipv' + str(ip_version)
-                        filename_key = cc + '.' + inet_suffix
-                        ip_end = ip_address(r['ip_end'])
-                        if self.ip_tables:  # https://github.com/chr0mag/geoipsets/issues/25
-                            subnets = [nets.with_prefixlen for nets in summarize_address_range(ip_start, ip_end)]
-                            if filename_key in country_subnets:  # append
-                                country_subnets[filename_key].extend(subnets)
-                            else:  # create
-                                country_subnets[filename_key] = subnets
-                        else:  # conversion not required for nftables
-                            if ip_start == ip_end:  # nftables disallows intervals with the same start & end
-                                ip_range = r['ip_start']
-                            else:
-                                ip_range = r['ip_start'] + '-' + r['ip_end']
-                            if filename_key in country_subnets:  # append
-                                country_subnets[filename_key].append(ip_range)
-                            else:  # create
-                                country_subnets[filename_key] = [ip_range]
-
-        self.build_sets(country_subnets)
-        os.remove(gzip_ref)
-
-    def build_sets(self, dict_of_lists):
-        ipset_dir = self.base_dir / 'dbip/ipset' / utils.AddressFamily.IPV4.value
-        nftset_dir = self.base_dir / 'dbip/nftset' / utils.AddressFamily.IPV4.value
-        ip6set_dir = self.base_dir / 'dbip/ipset' / utils.AddressFamily.IPV6.value
-        nft6set_dir = self.base_dir / 'dbip/nftset' / utils.AddressFamily.IPV6.value
-
-        # remove old sets if they exist
+    def parse_csv(self, gzip_ref, set_spool=None, sha1_hash=None):
+        """
+        Returns the elements of each set, parsed from the CSV file in 'gzip_ref'.
+        If 'sha1_hash' is given, it is updated with the decompressed CSV file as it is read.
+        With --jobs the blocks of the file are parsed by that many worker processes.
+        """
+        # dictionary of compact subnet lists (ranges.Networks), indexed by filename
+        # filename is CC.address_family -- eg. CA.ipv4
+        country_subnets = dict()
+        rows_parsed = 0
+        block_args = (self.countries, self.ipv4, self.ipv6, self.ip_tables)
+
+        def collect(parsed):
+            # appends the elements of each set in a block, in file order, to those of the whole file
+            nonlocal rows_parsed
+            rows, batches = parsed.result() if isinstance(parsed, Future) else parsed
+            rows_parsed += rows
+            for filename_key, batch in batches.items():
+                if (networks := country_subnets.get(filename_key)) is None:  # create
+                    networks = (set_spool.networks(filename_key, batch.version, cidrs=self.ip_tables)
+                                if set_spool else ranges.Networks(batch.version, cidrs=self.ip_tables))
+                    country_subnets[filename_key] = networks
+                networks.extend(batch)
+
+        with ExitStack() as stack:
+            csv_file_bytes = stack.enter_context(gzip.GzipFile(gzip_ref, 'rb'))
+            # csv_file_bytes = stack.enter_context(gzip.GzipFile('/tmp/tmphq4qgkfp.csv.gz', 'rb'))
+            if sha1_hash:
+                csv_file_bytes = utils.DigestReader(csv_file_bytes, sha1_hash)
+            blocks = utils.iter_line_blocks(csv_file_bytes)
+            if self.jobs > 1:
+                # the workers are forked from a server that has imported this module, rather than from this
+                # multi-threaded process
+                context = get_context('forkserver')
+                context.set_forkserver_preload([__name__])
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=self.jobs, mp_context=context))
+
+                # blocks are parsed by the workers, up to two per worker ahead of collect(), which waits for each in
+                # turn so that the merged sets keep the order of the file (its busy time includes that wait)
+                stages = [('decompress', pipeline.submitted(executor, parse_block, blocks, 2 * self.jobs, *block_args)),
+                          ('collect', collect)]
+            else:
+                stages = [('decompress', blocks),
+                          ('parse', lambda block: parse_block(block, *block_args)),
+                          ('collect', collect)]
+
+            # decompression (and hashing) overlaps with parsing, see pipeline.py
+            self.run_pipeline(stages, self.metrics)
+
+        self.metrics.count('rows_parsed', rows_parsed)
+        return country_subnets
+
+    def build_sets(self, dict_of_lists, staging_dir):
+        # set files are written below 'staging_dir' and published by the caller
+        ipset_dir = staging_dir / 'ipset' / utils.AddressFamily.IPV4.value
+        nftset_dir = staging_dir / 'nftset' / utils.AddressFamily.IPV4.value
+        ip6set_dir = staging_dir / 'ipset' / utils.AddressFamily.IPV6.value
+        nft6set_dir = staging_dir / 'nftset' / utils.AddressFamily.IPV6.value
+
+        # staged set directories replace the published sets, old sets that are no longer generated are removed
         if self.ip_tables:
             if self.ipv4:
-                if ipset_dir.is_dir():
-                    shutil.rmtree(ipset_dir)
-                ipset_dir.mkdir(parents=True)
+                ipset_dir.mkdir(parents=True, exist_ok=True)
 
             if self.ipv6:
-                if ip6set_dir.is_dir():
-                    shutil.rmtree(ip6set_dir)
-                ip6set_dir.mkdir(parents=True)
+                ip6set_dir.mkdir(parents=True, exist_ok=True)
 
         if self.nf_tables:
             if self.ipv4:
-                if nftset_dir.is_dir():
-                    shutil.rmtree(nftset_dir)
-                nftset_dir.mkdir(parents=True)
+                nftset_dir.mkdir(parents=True, exist_ok=True)
 
             if self.ipv6:
-                if nft6set_dir.is_dir():
-                    shutil.rmtree(nft6set_dir)
-                nft6set_dir.mkdir(parents=True)
+                nft6set_dir.mkdir(parents=True, exist_ok=True)
+
+        # optionally, 'nft -f' scripts that refresh named sets in a single transaction
+        nft_batch = None
+        if self.nf_tables and self.nft_batch:
+            nft_batch = nft.BatchWriter(staging_dir / 'nftbatch', self.nft_batch == 'combined')
+            if self.ipv4:
+                nft_batch.directory(utils.AddressFamily.IPV4.value)
+            if self.ipv6:
+                nft_batch.directory(utils.AddressFamily.IPV6.value)
 
         for set_name, subnets in dict_of_lists.items():
             set_name_parts = set_name.split('.')
@@ -109,52 +200,86 @@ class DbIpProvider(utils.AbstractProvider):
             else:  # AddressFamily.IPV6
                 inet_family = 'family inet6'
 
+            # optionally merge adjacent ranges: minimal CIDRs for ipset, minimal ranges for nftables
+            ipset_subnets, nftset_subnets = self.aggregate_subnets(subnets)
+
             # write file headers
             if self.ip_tables:
-                ipset_path = self.base_dir / 'dbip/ipset' / ip_version / set_name
+                ipset_path = staging_dir / 'ipset' / ip_version / set_name
                 ipset_file = open(ipset_path, 'w')
-                maxelem = max(131072, 1 if len(subnets) == 0 else (1 << (len(subnets) - 1).bit_length()))
-                ipset_file.write("create {0} hash:net {1} maxelem {2} comment\n".format(set_name, inet_family, maxelem))
+                maxelem = max(131072, 1 if len(ipset_subnets) == 0 else (1 << (len(ipset_subnets) - 1).bit_length()))
+                restore_name = ipset.write_header(ipset_file, set_name, inet_family, maxelem, self.ipset_swap)
+
+                # write ranges to file
+                for subnet in ipset_subnets:
+                    ipset_file.write("add " + restore_name + " " + subnet + " comment " + country_code + "\n")
+
+                ipset.write_footer(ipset_file, set_name, self.ipset_swap)
+                ipset_file.close()
+                self.metrics.count_set('ipset', set_name, len(ipset_subnets))
+
+                if self.delta:  # changes since the published set
+                    delta.write_ipset_delta(ipset_path, self.base_dir / 'dbip/ipset' / ip_version / set_name, set_name,
+                                            country_code, ipset_subnets, 4 if ip_version == 'ipv4' else 6)
 
             if self.nf_tables:
-                nftset_path = self.base_dir / 'dbip/nftset' / ip_version / set_name
+                nftset_path = staging_dir / 'nftset' / ip_version / set_name
                 nftset_file = open(nftset_path, 'w')
                 nftset_file.write("define " + set_name + " = {\n")
 
-            # write ranges to file(s)
-            for subnet in subnets:
-                if self.ip_tables:
-                    ipset_file.write("add " + set_name + " " + subnet + " comment " + country_code + "\n")
-
-                if self.nf_tables:
+                # write ranges to file
+                for subnet in nftset_subnets:
                     nftset_file.write(subnet + ",\n")
 
-            if self.ip_tables:
-                ipset_file.close()
-
-            if self.nf_tables:
                 nftset_file.write("}\n")
                 nftset_file.close()
+                self.metrics.count_set('nftset', set_name, len(nftset_subnets))
+
+                if self.delta and self.nft_batch:  # the named sets are declared by the nft batch scripts
+                    delta.write_nftset_delta(nftset_path, self.base_dir / 'dbip/nftset' / ip_version / set_name,
+                                             set_name, nftset_subnets, 4 if ip_version == 'ipv4' else 6)
+
+            if nft_batch:
+                nft_batch.write(set_name, nftset_subnets, ip_version)
+
+        # optionally, a binary interval index per address family for lookups by other tools
+        if self.write_index:
+            if self.ipv4:
+                self.build_index(staging_dir, utils.AddressFamily.IPV4.value, dict_of_lists)
+            if self.ipv6:
+                self.build_index(staging_dir, utils.AddressFamily.IPV6.value, dict_of_lists)
 
-    def download(self):
+    def download_url(self):
         """
         eg. https://download.db-ip.com/free/dbip-country-lite-2020-10.csv.gz
         filename: dbip-country-lite-YYYY-MM.csv.gz
         """
-        file_suffix = '.csv.gz'
-        url = 'https://download.db-ip.com/free/dbip-country-lite-' + datetime.utcnow().strftime('%Y-%m') + file_suffix
+        return 'https://download.db-ip.com/free/dbip-country-lite-' + datetime.utcnow().strftime('%Y-%m') + '.csv.gz'
 
-        # download latest GZIP file
-        http_response = requests.get(url)
-        with NamedTemporaryFile(suffix=file_suffix, delete=False) as gzip_file:
-            gzip_file.write(http_response.content)
+    def download(self, url, cache_entry=None):
+        """
+        Returns the downloaded file name, or None if 'cache_entry' is still current.
+        """
+        headers = cache_entry.request_headers() if cache_entry else None
+
+        # stream latest GZIP file to disk
+        with utils.http_get(url, headers=headers, stream=True) as http_response:
+            if cache_entry and cache_entry.is_current(http_response):
+                return None
+
+            with (cache_entry.temporary_file() if cache_entry else
+                  NamedTemporaryFile(suffix='.csv.gz', delete=False)) as gzip_file:
+                self.metrics.count('download_bytes', utils.write_response(http_response, gzip_file))
 
         return gzip_file.name
 
     def download_checksum(self):
+        if source := self.archive_source('dbip'):
+            return utils.read_checksum(source + self.checksum_suffix)
+
         webpage = 'https://db-ip.com/db/download/ip-to-country-lite'
         # download sha1sum
-        webpage_http_response = requests.get(webpage)
+        webpage_http_response = utils.http_get(webpage)
 
         # the page section we're looking for looks like this:
         # <dl class="card-body">
@@ -182,22 +307,48 @@ class DbIpProvider(utils.AbstractProvider):
 
         return csv_sha1sum_tag[0].find_next_sibling().string
 
-    def check_checksum(self, csv_file_bytes):
+    def check_checksum(self, sha1_hash, gzip_ref=None, set_spool=None):
         expected_sha1sum = self.download_checksum()
 
-        # calculate the sha1sum of the downloaded file
-        sha1_hash = hashlib.sha1()
-        # Read and update hash in 8K chunks
-        while chunk := csv_file_bytes.read(8192):
-            sha1_hash.update(chunk)
-
+        # the sha1sum of the CSV file was computed while it was parsed
         computed_sha1sum = sha1_hash.hexdigest()
 
-        # reset position to beginning of file now that we're done
-        csv_file_bytes.seek(0)
-
         # compare downloaded sha1 hash with computed version
         if expected_sha1sum != computed_sha1sum:
+            # the download, if any, is discarded so that the next run fetches it again
+            if gzip_ref:
+                os.remove(gzip_ref)
+            if set_spool:
+                set_spool.close()
             raise SystemExit("ERROR: Computed CSV file digest '{0}' does not match expected value '{1}'".format(
                 computed_sha1sum, expected_sha1sum
             ))
+
+
+def parse_block(block: bytes, countries, ipv4: bool, ipv6: bool, ip_tables: bool):
+    """
+    Returns the number of rows in a block of lines of the CSV file, and the elements of each set found in it as
+    ranges.Networks keyed by filename, eg. CA.ipv4. Blocks are independent, so they can be parsed in worker processes.
+    """
+    fieldnames = ("ip_start", "ip_end", "country")
+    rows = utils.CsvColumns(fieldnames, fieldnames).parse(block)
+    batches = dict()
+    for ip_start, ip_end, cc in rows:
+        # configparser forces keys to lower case by default
+        if cc != 'ZZ' and (countries == 'all' or cc.lower() in countries):
+            ip_version = 6 if ':' in ip_start else 4
+            if (ip_version == 4 and ipv4) or (ip_version == 6 and ipv6):
+                inet_suffix = 'ipv' + str(ip_version)
+                filename_key = cc + '.' + inet_suffix
+                if (networks := batches.get(filename_key)) is None:
+                    # ranges are converted into subnets for iptables, nftables takes them as is
+                    networks = batches[filename_key] = ranges.Networks(ip_version, cidrs=ip_tables)
+
+                parse_address = ranges.parse_ipv4 if ip_version == 4 else ranges.parse_ipv6
+                first, last = parse_address(ip_start), parse_address(ip_end)
+                if ip_tables:  # https://github.com/chr0mag/geoipsets/issues/25
+                    bits = ranges.IPV4_BITS if ip_version == 4 else ranges.IPV6_BITS
+                    networks.add_cidrs(ranges.range_to_cidrs(first, last, bits))
+                else:  # conversion not required for nftables
+                    networks.add_range(first, last)
+    return len(rows), batches
@@ -0,0 +1,67 @@
+# delta.py
+
+from pathlib import Path
+
+from . import nft, ranges
+
+# a delta is written next to each full set, eg. nftset/ipv4/CA.ipv4.delta
+# nftables deltas update the named sets declared by nft batch scripts, so they are only written with --nft-batch
+SUFFIX = '.delta'
+
+
+def read_ipset_elements(path: Path):
+    # eg. add CA.ipv4 1.0.0.0/24 comment CA
+    with open(path, 'r') as set_file:
+        return [line.split()[2] for line in set_file if line.startswith('add ')]
+
+
+def read_nftset_elements(path: Path):
+    # one element per line between 'define CA.ipv4 = {' and '}'
+    with open(path, 'r') as set_file:
+        return [line.strip().rstrip(',') for line in set_file if not line.startswith(('define ', '}'))]
+
+
+def diff_elements(previous: list, current: list, ip_version: int):
+    """
+    Returns the elements removed from, and added to, a set since its previous version, each in ascending order.
+    """
+    def sorted_elements(elements):
+        return sorted(ranges.parse_element(e, ip_version) + (e,) for e in elements)
+
+    removed, added = ranges.diff_intervals(sorted_elements(previous), sorted_elements(current))
+    return [e[2] for e in removed], [e[2] for e in added]
+
+
+def write_ipset_delta(set_path: Path, previous_path: Path, set_name: str, country_code: str, elements: list,
+                      ip_version: int):
+    """
+    Writes an 'ipset restore' script next to 'set_path' that turns the previously published set into the current one.
+    Nothing is written if there is no previous set, it must be loaded in full.
+    """
+    if not previous_path.is_file():
+        return
+
+    removed, added = diff_elements(read_ipset_elements(previous_path), elements, ip_version)
+    with open(set_path.with_name(set_path.name + SUFFIX), 'w') as delta_file:
+        for subnet in removed:
+            delta_file.write("del " + set_name + " " + subnet + "\n")
+        for subnet in added:
+            delta_file.write("add " + set_name + " " + subnet + " comment " + country_code + "\n")
+
+
+def write_nftset_delta(set_path: Path, previous_path: Path, set_name: str, elements: list, ip_version: int):
+    """
+    Writes an 'nft -f' script next to 'set_path' that turns the previously published set into the current one.
+    Nothing is written if there is no previous set, it must be loaded in full.
+    """
+    if not previous_path.is_file():
+        return
+
+    removed, added = diff_elements(read_nftset_elements(previous_path), elements, ip_version)
+    with open(set_path.with_name(set_path.name + SUFFIX), 'w') as delta_file:
+        for statement, subnets in (('delete', removed), ('add', added)):
+            if subnets:
+                delta_file.write("{0} element {1} {2} {{\n".format(statement, nft.TABLE, set_name))
+                for subnet in subnets:
+                    delta_file.write(subnet + ",\n")
+                delta_file.write("}\n")
@@ -0,0 +1,216 @@
+# index.py
+
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from pathlib import Path
+
+from . import ranges
+
+# file layout, all integers little-endian:
+#   header            magic, format version, IP version, number of countries, number of intervals
+#   country table     2 ASCII bytes per country, padded to a multiple of 8 bytes
+#   interval starts   uint32 per interval for IPv4, for IPv6 an array of the high 64 bits then one of the low 64 bits
+#   interval ends     as the starts
+#   interval country  uint16 index into the country table, per interval
+# intervals are disjoint and sorted by start
+MAGIC = b'GEOIPIDX'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sHBxII4x')
+# the index of each address family is written to <provider>/index/<address family>/FILE_NAME
+FILE_NAME = 'geoipsets.idx'
+
+
+def index_path(provider_dir: Path, addr_fam: str):
+    return provider_dir / 'index' / addr_fam / FILE_NAME
+
+
+def padded(size: int):
+    return (size + 7) & ~7
+
+
+def write_index(path: Path, ip_version: int, country_intervals: dict):
+    """
+    Writes the binary index of 'country_intervals', a dict of (first, last) interval lists keyed by country code.
+    Each country's intervals are merged, so they may overlap or be unsorted.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as index_file:
+        dump_index(index_file, ip_version, country_intervals)
+
+
+def dump_index(index_file, ip_version: int, country_intervals: dict):
+    # see write_index()
+    countries = sorted(country_intervals)
+    intervals = sorted((first, last, i) for i, cc in enumerate(countries)
+                       for first, last in ranges.merge_intervals(country_intervals[cc]))
+
+    if ip_version == 4:
+        starts = [array('I', (first for first, _, _ in intervals))]
+        ends = [array('I', (last for _, last, _ in intervals))]
+    else:
+        mask = (1 << 64) - 1
+        starts = [array('Q', (first >> 64 for first, _, _ in intervals)),
+                  array('Q', (first & mask for first, _, _ in intervals))]
+        ends = [array('Q', (last >> 64 for _, last, _ in intervals)),
+                array('Q', (last & mask for _, last, _ in intervals))]
+    country_ids = array('H', (i for _, _, i in intervals))
+
+    if sys.byteorder == 'big':
+        for a in starts + ends + [country_ids]:
+            a.byteswap()
+
+    country_table = ''.join(countries).encode('ascii')
+    index_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, ip_version, len(countries), len(intervals)))
+    index_file.write(country_table.ljust(padded(len(country_table)), b'\0'))
+    for a in starts + ends + [country_ids]:
+        index_file.write(a.tobytes())
+
+
+class IntervalIndex:
+    """
+    Read-only view of an index file, memory-mapped so that processes share one page-cached copy and nothing is parsed.
+    An index held in memory can be read from 'data' instead.
+    """
+
+    def __init__(self, path: Path = None, data: bytes = None):
+        if path is not None:
+            with open(path, 'rb') as index_file:
+                self.mmap = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buffer = self.mmap
+        else:
+            self.mmap = None
+            self.buffer = data
+        self.numpy_arrays = None
+        name = path if path is not None else 'index data'
+
+        try:
+            magic, format_version, self.ip_version, country_count, self.count = HEADER.unpack_from(self.buffer)
+        except struct.error:
+            magic = None
+        if magic != MAGIC or format_version != FORMAT_VERSION or self.ip_version not in (4, 6):
+            self.close()
+            raise ValueError("'{0}' is not a geoipsets index file".format(name))
+
+        offset = HEADER.size
+        table = self.buffer[offset:offset + 2 * country_count].decode('ascii')
+        self.countries = [table[i:i + 2] for i in range(0, len(table), 2)]
+        offset += padded(2 * country_count)
+
+        halves = 1 if self.ip_version == 4 else 2
+        address_array = ('I', 4) if self.ip_version == 4 else ('Q', 8)
+        if offset + self.count * (2 * halves * address_array[1] + 2) > len(self.buffer):
+            self.close()
+            raise ValueError("'{0}' is truncated".format(name))
+
+        # one view per array, in file order
+        arrays = []
+        for typecode, item_size in [address_array] * (2 * halves) + [('H', 2)]:
+            arrays.append(self.view(offset, typecode, item_size))
+            offset += item_size * self.count
+
+        if halves == 1:
+            self.starts, self.ends, self.country_ids = arrays
+        else:
+            self.starts_hi, self.starts_lo, self.ends_hi, self.ends_lo, self.country_ids = arrays
+            self.starts = _Joined(self.starts_hi, self.starts_lo)
+            self.ends = _Joined(self.ends_hi, self.ends_lo)
+
+    def view(self, offset: int, typecode: str, item_size: int):
+        data = memoryview(self.buffer)[offset:offset + item_size * self.count]
+        if sys.byteorder == 'little':
+            return data.cast(typecode)
+
+        # big-endian hosts get a byte-swapped copy
+        values = array(typecode, data)
+        values.byteswap()
+        return values
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        # views of the mapping must be released before it can be closed
+        self.numpy_arrays = None
+        for name in ('starts', 'ends', 'starts_hi', 'starts_lo', 'ends_hi', 'ends_lo', 'country_ids'):
+            if isinstance(view := self.__dict__.pop(name, None), memoryview):
+                view.release()
+        if self.mmap is not None:
+            self.mmap.close()
+
+    def interval(self, i: int):
+        """
+        Returns the (first, last, country code) of the i-th interval.
+        """
+        return self.starts[i], self.ends[i], self.countries[self.country_ids[i]]
+
+    def lookup(self, ip: int):
+        """
+        Returns the country code of the interval containing 'ip', or None.
+        """
+        i = bisect_right(self.starts, ip, 0, self.count) - 1
+        if i >= 0 and ip <= self.ends[i]:
+            return self.countries[self.country_ids[i]]
+
+        return None
+
+    def lookup_batch(self, np, ips):
+        """
+        Vectorised lookup() of many addresses at once, using NumPy (passed as 'np').
+
+        'ips' is an array of integers for IPv4, or a (high, low) pair of arrays of 64 bit halves for IPv6.
+        Returns an array of indexes into 'countries', -1 where no interval contains the address.
+        """
+        if self.numpy_arrays is None:  # zero-copy views of the index arrays
+            names = ('starts', 'ends') if self.ip_version == 4 else ('starts_hi', 'starts_lo', 'ends_hi', 'ends_lo')
+            self.numpy_arrays = {name: np.asarray(getattr(self, name)) for name in names + ('country_ids',)}
+        arrays = self.numpy_arrays
+
+        country_ids = np.full(len(ips) if self.ip_version == 4 else len(ips[0]), -1, dtype=np.int64)
+        if self.count == 0:
+            return country_ids
+
+        if self.ip_version == 4:
+            # the last interval starting at or before each address
+            i = np.searchsorted(arrays['starts'], ips, side='right') - 1
+            j = np.maximum(i, 0)
+            found = (i >= 0) & (ips <= arrays['ends'][j])
+        else:
+            ips_hi, ips_lo = ips
+            left = np.searchsorted(arrays['starts_hi'], ips_hi, side='left')
+            right = np.searchsorted(arrays['starts_hi'], ips_hi, side='right')
+            # binary search the low halves of the intervals, if any, whose start shares the high half of the address
+            while (active := left < right).any():
+                middle = (left + right) // 2
+                below = active & (arrays['starts_lo'][np.minimum(middle, self.count - 1)] <= ips_lo)
+                left = np.where(below, middle + 1, left)
+                right = np.where(active & ~below, middle, right)
+            i = left - 1
+            j = np.maximum(i, 0)
+            ends_hi, ends_lo = arrays['ends_hi'][j], arrays['ends_lo'][j]
+            found = (i >= 0) & ((ips_hi < ends_hi) | ((ips_hi == ends_hi) & (ips_lo <= ends_lo)))
+
+        country_ids[found] = arrays['country_ids'][j[found]]
+        return country_ids
+
+
+class _Joined:
+    """Sequence of 128 bit integers over arrays of their high and low 64 bit halves, as needed by bisect."""
+
+    def __init__(self, high, low):
+        self.high = high
+        self.low = low
+
+    def __len__(self):
+        return len(self.high)
+
+    def __getitem__(self, i):
+        return self.high[i] << 64 | self.low[i]
@@ -0,0 +1,38 @@
+# ipset.py
+
+# elements are restored into this temporary set before it is swapped with the live one
+SWAP_SUFFIX = '-tmp'
+
+# maxelem of swapped sets: 'create -exist' fails if the live set has another maxelem, so it must not change between
+# runs with the size of the set (it is only an upper limit, memory grows with the elements actually added)
+SWAP_MAXELEM = 1 << 24
+
+
+def write_header(ipset_file, set_name: str, inet_family: str, maxelem: int, swap: bool):
+    """
+    Writes the 'create' command(s) of an 'ipset restore' file and returns the name of the set to add elements to.
+
+    With 'swap' the live set is only created if it does not yet exist. The elements are restored into an emptied
+    temporary set which write_footer() swaps with the live set, so rules referencing it are never left without data.
+    Both are created with SWAP_MAXELEM, unless 'maxelem' is larger.
+    """
+    if swap:
+        maxelem = max(maxelem, SWAP_MAXELEM)
+    create = "create {0} hash:net {1} maxelem {2} comment".format('{0}', inet_family, maxelem)
+    if not swap:
+        ipset_file.write(create.format(set_name) + "\n")
+        return set_name
+
+    # -exist: no error if the set already exists, eg. the live set, or a temporary one left by a failed restore
+    # (a set created with different options, eg. by a run without --ipset-swap, is not the same set, and still fails)
+    restore_name = set_name + SWAP_SUFFIX
+    ipset_file.write(create.format(set_name) + " -exist\n")
+    ipset_file.write(create.format(restore_name) + " -exist\n")
+    ipset_file.write("flush " + restore_name + "\n")
+    return restore_name
+
+
+def write_footer(ipset_file, set_name: str, swap: bool):
+    if swap:
+        ipset_file.write("swap " + set_name + SWAP_SUFFIX + " " + set_name + "\n")
+        ipset_file.write("destroy " + set_name + SWAP_SUFFIX + "\n")
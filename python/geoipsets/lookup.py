@@ -0,0 +1,163 @@
+# lookup.py
+
+from io import BytesIO
+from itertools import islice
+from pathlib import Path
+from socket import AF_INET, AF_INET6, inet_pton
+
+from . import delta, index, publish, ranges, utils
+
+# in the order they are reported
+PROVIDERS = ('maxmind', 'dbip')
+SET_TYPES = ('nftset', 'ipset')
+# number of addresses resolved at once by lookup_stream()
+BATCH_SIZE = 64 * 1024
+
+
+def read_set_files(provider_dir: Path, addr_fam: str):
+    """
+    Returns an in-memory index.IntervalIndex of a provider's published set files, used when no binary index was
+    written (see --index), or it does not match the set files.
+    """
+    ip_version = 4 if addr_fam == utils.AddressFamily.IPV4.value else 6
+    country_intervals = dict()
+    for set_type, read_elements in (('nftset', delta.read_nftset_elements), ('ipset', delta.read_ipset_elements)):
+        if (set_dir := provider_dir / set_type / addr_fam).is_dir():
+            for set_path in set_dir.glob('*.' + addr_fam):
+                country_intervals[set_path.name.split('.')[0]] = [ranges.parse_element(e, ip_version)
+                                                                  for e in read_elements(set_path)]
+            break  # the sets of one firewall type are enough
+
+    index_data = BytesIO()
+    index.dump_index(index_data, ip_version, country_intervals)
+    return index.IntervalIndex(data=index_data.getvalue())
+
+
+def lookup_packed(interval_index, packed: bytes):
+    """
+    Returns the country code, or None, of each address in 'packed', a concatenation of packed (network byte order)
+    addresses of the index's IP version. The index is searched for all of them at once if NumPy is available.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        # one binary search per address
+        size = 4 if interval_index.ip_version == 4 else 16
+        return [interval_index.lookup(int.from_bytes(packed[i:i + size], 'big')) for i in range(0, len(packed), size)]
+
+    if interval_index.ip_version == 4:
+        ips = np.frombuffer(packed, dtype='>u4').astype(np.uint32)
+    else:
+        halves = np.frombuffer(packed, dtype='>u8').astype(np.uint64).reshape(-1, 2)
+        ips = (np.ascontiguousarray(halves[:, 0]), np.ascontiguousarray(halves[:, 1]))
+
+    countries = interval_index.countries
+    return [countries[i] if i >= 0 else None for i in interval_index.lookup_batch(np, ips).tolist()]
+
+
+class Lookup:
+    """
+    Finds the country, and set files, containing an IP address in the sets generated by each provider below 'base_dir'.
+    The binary index of a provider and address family is used if it was published with its current set files,
+    otherwise the set files are read.
+    Either is loaded on first use and kept for later queries.
+    """
+
+    def __init__(self, base_dir: Path, providers=PROVIDERS):
+        self.base_dir = base_dir
+        self.providers = [p for p in providers if (base_dir / p).is_dir()]
+        self.indexes = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for interval_index in self.indexes.values():
+            if interval_index is not None:
+                interval_index.close()
+        self.indexes.clear()
+
+    def index(self, provider: str, addr_fam: str):
+        """
+        Returns the interval index of a provider and address family, or None if no sets were generated for it.
+        """
+        key = (provider, addr_fam)
+        if key not in self.indexes:
+            provider_dir = self.base_dir / provider
+            index_path = index.index_path(provider_dir, addr_fam)
+            if index_path.is_file() and publish.index_is_current(provider_dir, index_path, addr_fam):
+                self.indexes[key] = index.IntervalIndex(index_path)
+            elif any((provider_dir / set_type / addr_fam).is_dir() for set_type in SET_TYPES):
+                self.indexes[key] = read_set_files(provider_dir, addr_fam)
+            else:
+                self.indexes[key] = None
+
+        return self.indexes[key]
+
+    def set_files(self, provider: str, addr_fam: str, country_code: str):
+        set_files = [self.base_dir / provider / set_type / addr_fam / (country_code + '.' + addr_fam)
+                     for set_type in SET_TYPES]
+        return [f for f in set_files if f.is_file()]
+
+    def lookup(self, address: str):
+        """
+        Returns a (provider, country code, set files) tuple per provider with sets for the address family of 'address'.
+        The country code is None, and the list of set files empty, if no set contains the address.
+        """
+        try:
+            ip_version, ip = ranges.parse_address(address.strip())
+        except OSError:
+            raise ValueError("invalid IP address: '{0}'".format(address))
+        addr_fam = 'ipv' + str(ip_version)
+
+        results = []
+        for provider in self.providers:
+            if (interval_index := self.index(provider, addr_fam)) is None:
+                continue
+            if (country_code := interval_index.lookup(ip)) is None:
+                results.append((provider, None, []))
+            else:
+                results.append((provider, country_code, self.set_files(provider, addr_fam, country_code)))
+
+        return results
+
+    def lookup_many(self, addresses: list, provider: str):
+        """
+        Returns the country code of each of 'addresses' in the sets of 'provider'.
+        The country code is None if no set contains the address, or it is not a valid address.
+        """
+        country_codes = [None] * len(addresses)
+        # positions and packed values of the addresses of each IP version
+        batches = {AF_INET: ([], []), AF_INET6: ([], [])}
+        for position, address in enumerate(addresses):
+            family = AF_INET6 if ':' in address else AF_INET
+            try:
+                packed = inet_pton(family, address)
+            except OSError:
+                continue
+            positions, packed_addresses = batches[family]
+            positions.append(position)
+            packed_addresses.append(packed)
+
+        for family, (positions, packed_addresses) in batches.items():
+            addr_fam = utils.AddressFamily.IPV4.value if family == AF_INET else utils.AddressFamily.IPV6.value
+            if positions and (interval_index := self.index(provider, addr_fam)) is not None:
+                batch_country_codes = lookup_packed(interval_index, b''.join(packed_addresses))
+                for position, country_code in zip(positions, batch_country_codes):
+                    country_codes[position] = country_code
+
+        return country_codes
+
+    def lookup_stream(self, in_file, out_file, provider: str):
+        """
+        Reads one address per line from 'in_file' and writes an 'address,country code' line per address to 'out_file'.
+        The country code is left empty if unknown. Addresses are resolved BATCH_SIZE lines at a time, so memory use
+        is bounded whatever the size of the input.
+        """
+        while lines := list(islice(in_file, BATCH_SIZE)):
+            addresses = [a for line in lines if (a := line.strip())]
+            country_codes = self.lookup_many(addresses, provider)
+            out_file.write(''.join(a + ',' + (cc or '') + '\n' for a, cc in zip(addresses, country_codes)))
@@ -2,58 +2,135 @@
 
 import hashlib
 import os
-import shutil
-from csv import DictReader
-from io import TextIOWrapper
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from tempfile import NamedTemporaryFile
+from time import perf_counter
 from zipfile import ZipFile
 
-import requests
 from requests.auth import HTTPBasicAuth
 
-from . import utils
+from . import delta, ipset, metrics, nft, publish, ranges, utils
 
 
 class MaxMindProvider(utils.AbstractProvider):
     """MaxMind IP range set provider."""
 
+    archive_name = 'GeoLite2-Country-CSV.zip'
+    checksum_suffix = '.sha256'
+
     def __init__(self, firewall: set, address_family: set, checksum: bool, countries: set, output_dir: str,
-                 provider_options: dict):
+                 provider_options: dict, **kwargs):
         # 'provider_options' is a ConfigParser Section that can be treated as a dictionary.
         # Use this mechanism to introduce provider-specific options into the configuration file.
-        super().__init__(firewall, address_family, checksum, countries, output_dir)
+        super().__init__(firewall, address_family, checksum, countries, output_dir, **kwargs)
+
+        # credentials are only needed to download from MaxMind, not from a mirror or an input file
+        self.auth = None
+        if self.archive_source('maxmind') is None:
+            provider_options = provider_options or dict()
+            if not (account_id := provider_options.get('account-id')):
+                raise SystemExit("ERROR: Account ID cannot be empty")
 
-        if not (account_id := provider_options.get('account-id')):
-            raise SystemExit("ERROR: Account ID cannot be empty")
+            if not (license_key := provider_options.get('license-key')):
+                raise SystemExit("ERROR: License key cannot be empty")
 
-        if not (license_key := provider_options.get('license-key')):
-            raise SystemExit("ERROR: License key cannot be empty")
+            self.auth = HTTPBasicAuth(account_id, license_key)
 
-        self.auth = HTTPBasicAuth(account_id, license_key)
         self.base_url = 'https://download.maxmind.com/geoip/databases/GeoLite2-Country-CSV/download'
 
     def generate(self):
-        zip_file = self.download()  # comment out for testing
-
-        if self.checksum:
-            self.check_checksum(zip_file)
-
-        with ZipFile(Path(zip_file.name), 'r') as zip_ref:
+        zip_url = self.download_url()
+        source = self.archive_source('maxmind')
+        if local := source is not None and not utils.is_url(source):
+            # a local copy, eg. in a mirror directory shared by the fleet, is read in place and never cached
+            cache_entry = None
+            zip_path = Path(source)
+            if self.checksum:
+                with self.metrics.stage('checksum'):
+                    self.check_checksum(utils.file_digest(zip_path, hashlib.sha256()))
+        else:
+            # an http(s) mirror is downloaded, and cached, like the upstream URL
+            cache_entry = self.cache_entry('maxmind', source or zip_url, '.zip')
+            with self.metrics.stage('download'):
+                zip_file, sha256_hash = self.download(source or zip_url, cache_entry)  # comment out for testing
+
+            if zip_file is None:  # the cached copy is current
+                if self.is_up_to_date('maxmind', cache_entry):
+                    print("MaxMind data is unchanged, skipping...")
+                    self.metrics.status = 'unchanged'
+                    if self.delta:  # the deltas of the previous run would now be applied twice
+                        publish.Publisher(self.base_dir / 'maxmind').empty_deltas()
+                    return
+                zip_path = cache_entry.path
+            else:
+                if self.checksum:
+                    with self.metrics.stage('checksum'):
+                        self.check_checksum(sha256_hash, zip_file.name)
+
+                if cache_entry:
+                    cache_entry.store(zip_file.name, self.checksum)
+                    zip_path = cache_entry.path
+                else:
+                    zip_path = Path(zip_file.name)
+
+        with ZipFile(zip_path, 'r') as zip_ref:
             # with ZipFile(Path("/tmp/tmp23pn2bw0.zip"), 'r') as zip_ref:  # replace line above with this for testing
 
             zip_dir_prefix = os.path.commonprefix(zip_ref.namelist())
-            id_cc_map = self.build_id_cc_map(zip_ref, zip_dir_prefix)
-
-            # TODO: run each address-family concurrently?
-            if self.ipv4:
-                self.build_sets(id_cc_map, zip_ref, zip_dir_prefix, utils.AddressFamily.IPV4)
-
-            if self.ipv6:
-                self.build_sets(id_cc_map, zip_ref, zip_dir_prefix, utils.AddressFamily.IPV6)
-
-        zip_file.close()
-        os.remove(zip_file.name)
+            with self.metrics.stage('parse'):
+                id_cc_map = self.build_id_cc_map(zip_ref, zip_dir_prefix)
+
+        address_families = []
+        if self.ipv4:
+            address_families.append(utils.AddressFamily.IPV4)
+        if self.ipv6:
+            address_families.append(utils.AddressFamily.IPV6)
+
+        # sets are generated into a staging directory, then only the changed files are published
+        with publish.Publisher(self.base_dir / 'maxmind') as publisher:
+            staging_dir = publisher.staging_dir
+            if self.jobs > 1 and len(address_families) > 1:
+                # each address-family is parsed from its own CSV file, so build them in parallel worker processes
+                # the workers share the downloaded archive and receive a copy of the id -> country code map
+                with ProcessPoolExecutor(max_workers=len(address_families)) as executor:
+                    futures = [executor.submit(self.timed_build_sets, id_cc_map, zip_path, zip_dir_prefix, addr_fam,
+                                               staging_dir)
+                               for addr_fam in address_families]
+                    timings = [future.result() for future in futures]
+            else:
+                timings = [self.timed_build_sets(id_cc_map, zip_path, zip_dir_prefix, addr_fam, staging_dir)
+                           for addr_fam in address_families]
+
+            for addr_fam, (elapsed, build_metrics) in zip(address_families, timings):
+                print("MaxMind {0} sets built in {1:.2f}s".format(addr_fam.value, elapsed))
+                self.metrics.merge(build_metrics)
+
+            with self.metrics.stage('publish'):
+                changed, removed = publisher.commit(self.disabled_outputs())
+            print("MaxMind sets published: {0} changed, {1} removed".format(len(changed), len(removed)))
+
+        if cache_entry:
+            cache_entry.set_generated(self.fingerprint())
+        elif not local:
+            os.remove(zip_path)
+
+    def fetch(self):
+        """
+        Downloads the zip file, and its sha256sum, into the mirror directory (--fetch-only).
+        """
+        with self.metrics.stage('download'):
+            zip_file, sha256_hash = self.download(self.download_url())
+
+        with self.metrics.stage('checksum'):
+            if self.checksum:
+                self.check_checksum(sha256_hash, zip_file.name)
+            else:  # the mirror always gets a checksum file
+                sha256_hash = utils.file_digest(zip_file.name, hashlib.sha256())
+
+        with self.metrics.stage('publish'):
+            archive = self.publish_archive('maxmind', zip_file.name, sha256_hash.hexdigest())
+        print("MaxMind data fetched: {0}".format(archive))
 
     def build_id_cc_map(self, zip_ref: ZipFile, dir_prefix: str):
         # Build dictionary mapping geoname_ids to ISO country codes
@@ -67,65 +144,126 @@ class MaxMindProvider(utils.AbstractProvider):
         id_country_code_map = dict()
         with ZipFile(Path(zip_ref.filename), 'r') as zip_file:
             with zip_file.open(dir_prefix + locations, 'r') as csv_file_bytes:
-                rows = DictReader(TextIOWrapper(csv_file_bytes))
-                for r in rows:
-                    if cc := r['country_iso_code']:
-                        # configparser forces keys to lower case by default
-                        if self.countries == 'all' or cc.lower() in self.countries:
-                            id_country_code_map[r['geoname_id']] = cc
+                for rows in utils.read_csv_rows(csv_file_bytes, ('geoname_id', 'country_iso_code')):
+                    for geo_id, cc in rows:
+                        if cc:
+                            # configparser forces keys to lower case by default
+                            if self.countries == 'all' or cc.lower() in self.countries:
+                                id_country_code_map[geo_id] = cc
 
         return id_country_code_map
 
-    def build_sets(self, id_country_code_map: dict, zip_ref: ZipFile, dir_prefix: str, addr_fam: utils.AddressFamily):
+    def timed_build_sets(self, id_country_code_map: dict, zip_path: Path, dir_prefix: str,
+                         addr_fam: utils.AddressFamily, staging_dir: Path):
+        # returns the time taken, in seconds, to build the sets of one address-family, and the metrics of the build
+        # these are collected separately as the build may run in a worker process
+        build_metrics = metrics.Metrics()
+        start = perf_counter()
+        self.build_sets(id_country_code_map, zip_path, dir_prefix, addr_fam, staging_dir, build_metrics)
+        return perf_counter() - start, build_metrics
+
+    def build_sets(self, id_country_code_map: dict, zip_path: Path, dir_prefix: str, addr_fam: utils.AddressFamily,
+                   staging_dir: Path, build_metrics: metrics.Metrics):
+        # Builds country-specific IP range lists from the IP blocks, and writes them below 'staging_dir'.
+        # The sets are published by the caller.
+
+        # with --low-memory elements are spooled to disk as they are parsed, instead of being held in memory
+        set_spool = self.open_spool('maxmind')
+        with build_metrics.stage('parse'):
+            country_subnets = self.parse_blocks(id_country_code_map, zip_path, dir_prefix, addr_fam, set_spool,
+                                                build_metrics)
+        with build_metrics.stage('write'):
+            self.write_sets(country_subnets, addr_fam, staging_dir, build_metrics)
+        if set_spool:
+            set_spool.close()
+
+    def parse_blocks(self, id_country_code_map: dict, zip_path: Path, dir_prefix: str, addr_fam: utils.AddressFamily,
+                     set_spool, build_metrics: metrics.Metrics):
         # Iterates through IP blocks and builds country-specific IP range lists.
         # field names:
         # network,geoname_id,registered_country_geoname_id,represented_country_geoname_id,is_anonymous_proxy,is_satellite_provider
 
-        ipset_dir = self.base_dir / 'maxmind/ipset' / addr_fam.value
-        nftset_dir = self.base_dir / 'maxmind/nftset' / addr_fam.value
         if addr_fam == utils.AddressFamily.IPV4:
             ip_blocks = 'GeoLite2-Country-Blocks-IPv4.csv'
-            inet_family = 'family inet'
+            ip_version = 4
         else:  # AddressFamily.IPV6
             ip_blocks = 'GeoLite2-Country-Blocks-IPv6.csv'
-            inet_family = 'family inet6'
+            ip_version = 6
 
-        # dictionary of subnet lists, indexed by filename
+        # dictionary of compact subnet lists (ranges.Networks), indexed by filename
         # filename is CC.address_family -- eg. CA.ipv4
         country_subnets = dict()
-
-        with ZipFile(Path(zip_ref.filename), 'r') as zip_file:
+        parse_address = ranges.parse_ipv4 if ip_version == 4 else ranges.parse_ipv6
+        parser = utils.CsvColumns(('network', 'geoname_id', 'registered_country_geoname_id'))
+        rows_parsed = 0
+
+        def parse(block: bytes):
+            # returns the elements of each set in a block of lines, as ranges.Networks
+            nonlocal rows_parsed
+            rows = parser.parse(block)
+            rows_parsed += len(rows)
+            batches = dict()
+            for net, geo_id, registered_geo_id in rows:
+                if not geo_id:
+                    geo_id = registered_geo_id
+                if not geo_id:
+                    continue
+
+                try:
+                    cc = id_country_code_map[geo_id]
+                except KeyError:
+                    continue  # skip CC if not listed in the config file
+
+                filename_key = cc + '.' + addr_fam.value
+                if (networks := batches.get(filename_key)) is None:
+                    networks = batches[filename_key] = ranges.Networks(ip_version)
+
+                network, prefix = net.split('/')
+                networks.add_cidr(parse_address(network), int(prefix))
+            return batches
+
+        def collect(batches: dict):
+            # appends the elements of each set in a block to those of the whole file
+            for filename_key, batch in batches.items():
+                if (networks := country_subnets.get(filename_key)) is None:  # create
+                    networks = (set_spool.networks(filename_key, ip_version) if set_spool
+                                else ranges.Networks(ip_version))
+                    country_subnets[filename_key] = networks
+                networks.extend(batch)
+
+        with ZipFile(zip_path, 'r') as zip_file:
             with zip_file.open(dir_prefix + ip_blocks, 'r') as csv_file_bytes:
-                rows = DictReader(TextIOWrapper(csv_file_bytes))
-                for r in rows:
-                    geo_id = r['geoname_id']
-                    if not geo_id:
-                        geo_id = r['registered_country_geoname_id']
-                    if not geo_id:
-                        continue
-
-                    try:
-                        cc = id_country_code_map[geo_id]
-                    except KeyError:
-                        continue  # skip CC if not listed in the config file
-
-                    net = r['network']
-                    filename_key = cc + '.' + addr_fam.value
-
-                    if filename_key in country_subnets:  # append
-                        country_subnets[filename_key].append(net)
-                    else:  # create
-                        country_subnets[filename_key] = [net]
-
-        # remove old sets if they exist
+                # decompression overlaps with parsing, see pipeline.py
+                self.run_pipeline([('decompress', utils.iter_line_blocks(csv_file_bytes)),
+                                   ('parse', parse),
+                                   ('collect', collect)], build_metrics)
+
+        build_metrics.count('rows_parsed', rows_parsed)
+        return country_subnets
+
+    def write_sets(self, country_subnets: dict, addr_fam: utils.AddressFamily, staging_dir: Path,
+                   build_metrics: metrics.Metrics):
+        # writes the sets of one address-family below 'staging_dir'
+        ipset_dir = staging_dir / 'ipset' / addr_fam.value
+        nftset_dir = staging_dir / 'nftset' / addr_fam.value
+        if addr_fam == utils.AddressFamily.IPV4:
+            inet_family = 'family inet'
+            ip_version = 4
+        else:  # AddressFamily.IPV6
+            inet_family = 'family inet6'
+            ip_version = 6
+
+        # staged set directories replace the published sets, old sets that are no longer generated are removed
         if self.ip_tables:
-            if ipset_dir.is_dir():
-                shutil.rmtree(ipset_dir)
-            ipset_dir.mkdir(parents=True)
+            ipset_dir.mkdir(parents=True, exist_ok=True)
         if self.nf_tables:
-            if nftset_dir.is_dir():
-                shutil.rmtree(nftset_dir)
-            nftset_dir.mkdir(parents=True)
+            nftset_dir.mkdir(parents=True, exist_ok=True)
+
+        # optionally, 'nft -f' scripts that refresh named sets in a single transaction
+        nft_batch = None
+        if self.nf_tables and self.nft_batch:
+            nft_batch = nft.BatchWriter(staging_dir / 'nftbatch', self.nft_batch == 'combined')
+            nft_batch.directory(addr_fam.value)
 
         #
         # write data to disk
@@ -134,77 +272,106 @@ class MaxMindProvider(utils.AbstractProvider):
             set_name_parts = set_name.split('.')
             country_code = set_name_parts[0]
 
+            # optionally merge sibling & adjacent networks: minimal CIDRs for ipset, minimal ranges for nftables
+            ipset_subnets, nftset_subnets = self.aggregate_subnets(subnets)
+
             # write file headers
             # iptables/ipsets
             if self.ip_tables:
                 ipset_file = open(ipset_dir / set_name, 'w')
-                maxelem = max(131072, 1 if len(subnets) == 0 else (1 << (len(subnets) - 1).bit_length()))
-                ipset_file.write("create {0} hash:net {1} maxelem {2} comment\n".format(set_name,
-                                                                                        inet_family,
-                                                                                        maxelem))
+                maxelem = max(131072, 1 if len(ipset_subnets) == 0 else (1 << (len(ipset_subnets) - 1).bit_length()))
+                restore_name = ipset.write_header(ipset_file, set_name, inet_family, maxelem, self.ipset_swap)
+
+                # write ranges to file
+                for subnet in ipset_subnets:
+                    ipset_file.write("add " + restore_name + " " + subnet + " comment " + country_code + "\n")
+
+                ipset.write_footer(ipset_file, set_name, self.ipset_swap)
+                ipset_file.close()
+                build_metrics.count_set('ipset', set_name, len(ipset_subnets))
+
+                if self.delta:  # changes since the published set
+                    delta.write_ipset_delta(ipset_dir / set_name, self.base_dir / 'maxmind/ipset' / addr_fam.value /
+                                            set_name, set_name, country_code, ipset_subnets, ip_version)
 
             # nftables set
             if self.nf_tables:
                 nftset_file = open(nftset_dir / set_name, 'w')
                 nftset_file.write("define " + set_name + " = {\n")
 
-            # write ranges to file(s)
-            for subnet in subnets:
-                if self.ip_tables:
-                    ipset_file.write("add " + set_name + " " + subnet + " comment " + country_code + "\n")
-
-                if self.nf_tables:
+                # write ranges to file
+                for subnet in nftset_subnets:
                     nftset_file.write(subnet + ",\n")
 
-            if self.ip_tables:
-                ipset_file.close()
-
-            if self.nf_tables:
                 nftset_file.write("}\n")
                 nftset_file.close()
+                build_metrics.count_set('nftset', set_name, len(nftset_subnets))
+
+                if self.delta and self.nft_batch:  # the named sets are declared by the nft batch scripts
+                    delta.write_nftset_delta(nftset_dir / set_name, self.base_dir / 'maxmind/nftset' / addr_fam.value /
+                                             set_name, set_name, nftset_subnets, ip_version)
+
+            if nft_batch:
+                nft_batch.write(set_name, nftset_subnets, addr_fam.value)
 
-    def download(self):
+        # optionally, a binary interval index for lookups by other tools
+        if self.write_index:
+            self.build_index(staging_dir, addr_fam.value, country_subnets)
+
+    def download_url(self):
         # URL: https://download.maxmind.com/geoip/databases/GeoLite2-Country-CSV/download
         # CSV query string: ?suffix=zip
+        return self.base_url + '?suffix=zip'
 
+    def download(self, zip_url, cache_entry=None):
+        """
+        Returns the downloaded file and its sha256 hash, or (None, None) if 'cache_entry' is still current.
+        """
         # The downloaded filename is available in the 'Content-Disposition' HTTP response header.
         # eg. Content-Disposition: attachment; filename=GeoLite2-Country-CSV_20200922.zip
-        file_suffix = 'zip'
-        zip_url = self.base_url + '?suffix=' + file_suffix
+        # It changes with each release, so it is also used to validate the cached copy.
+        headers = cache_entry.request_headers() if cache_entry else None
+
+        # stream latest ZIP file to disk, hashing it as it arrives
+        sha256_hash = hashlib.sha256() if self.checksum else None
+        # the credentials are never sent to a mirror
+        auth = self.auth if zip_url.startswith(self.base_url) else None
+        with utils.http_get(zip_url, auth=auth, headers=headers, stream=True) as zip_http_response:
+            if cache_entry and cache_entry.is_current(zip_http_response):
+                return None, None
 
-        # download latest ZIP file
-        zip_http_response = requests.get(zip_url, auth=self.auth)
-        with NamedTemporaryFile(suffix='.' + file_suffix, delete=False) as zip_file:
-            zip_file.write(zip_http_response.content)
+            with (cache_entry.temporary_file() if cache_entry else
+                  NamedTemporaryFile(suffix='.zip', delete=False)) as zip_file:
+                self.metrics.count('download_bytes', utils.write_response(zip_http_response, zip_file, sha256_hash))
 
-        return zip_file
+        return zip_file, sha256_hash
 
     def download_checksum(self):
+        if source := self.archive_source('maxmind'):
+            return utils.read_checksum(source + self.checksum_suffix)
+
         # URL: https://download.maxmind.com/geoip/databases/GeoLite2-Country-CSV/download
         # SHA256 query string: ?suffix=zip.sha256
         file_suffix = 'zip.sha256'
         sha256_url = self.base_url + '?suffix=' + file_suffix
-        sha256_http_response = requests.get(sha256_url, auth=self.auth)
+        sha256_http_response = utils.http_get(sha256_url, auth=self.auth)
         with NamedTemporaryFile(suffix='.' + file_suffix, delete=True) as sha256_file:
             sha256_file.write(sha256_http_response.content)
             sha256_file.seek(0)
 
             return sha256_file.read().decode('utf-8').split()[0]
 
-    def check_checksum(self, zip_ref):
+    def check_checksum(self, sha256_hash, zip_file_name=None):
         expected_sha256sum = self.download_checksum()
 
-        # calculate sha256 hash
-        with open(zip_ref.name, 'rb') as raw_zip_file:
-            sha256_hash = hashlib.sha256()
-            # Read and update hash in 8K chunks
-            while chunk := raw_zip_file.read(8192):
-                sha256_hash.update(chunk)
-
-            computed_sha256sum = sha256_hash.hexdigest()
+        # the sha256 hash was computed while the zip file was downloaded
+        computed_sha256sum = sha256_hash.hexdigest()
 
         # compare downloaded sha256 hash with computed version
         if expected_sha256sum != computed_sha256sum:
+            # the download, if any, is discarded so that the next run fetches it again
+            if zip_file_name:
+                os.remove(zip_file_name)
             raise SystemExit("ERROR: Computed zip file digest '{0}' does not match expected value '{1}'".format(
                 computed_sha256sum, expected_sha256sum
             ))
@@ -0,0 +1,160 @@
+# metrics.py
+
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from . import profiling
+
+# metric names in the Prometheus textfile
+PREFIX = 'geoipsets_'
+
+
+class Metrics:
+    """
+    Measurements of a provider run: the duration of each stage (download, checksum, parse, write, publish), counters
+    such as bytes downloaded and rows parsed, and the number of elements written to each set file.
+    Stages entered more than once, eg. parsing each address family, accumulate their durations.
+    The busy time of each thread of the parsing pipelines (see pipeline.py) is also recorded.
+    """
+
+    def __init__(self):
+        self.status = 'generated'
+        self.stages = dict()
+        self.counters = dict()
+        self.sets = dict()
+        # {pipeline stage: [busy seconds, seconds the pipelines ran]}
+        self.pipeline = dict()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+            profiling.checkpoint(name)
+
+    def count(self, name: str, value: int):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def count_set(self, set_type: str, set_name: str, elements: int):
+        self.sets.setdefault(set_type, dict())[set_name] = elements
+
+    def record_pipeline(self, busy: dict, elapsed: float):
+        """
+        Adds the busy time of each stage of a pipeline run, and the time the run took, as returned by pipeline.run().
+        """
+        for name, seconds in busy.items():
+            totals = self.pipeline.setdefault(name, [0.0, 0.0])
+            totals[0] += seconds
+            totals[1] += elapsed
+
+    def merge(self, other):
+        """
+        Adds the measurements of 'other', eg. taken in a worker process.
+        """
+        for name, seconds in other.stages.items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        for name, value in other.counters.items():
+            self.count(name, value)
+        for set_type, counts in other.sets.items():
+            self.sets.setdefault(set_type, dict()).update(counts)
+        for name, (busy, elapsed) in other.pipeline.items():
+            self.record_pipeline({name: busy}, elapsed)
+
+    def report(self, provider: str):
+        """
+        Returns the measurements as a dict, with the peak memory use of this process and its finished workers.
+        """
+        report = dict(provider=provider, status=self.status, timestamp=time.time(),
+                      stages=self.stages, peak_rss_bytes=peak_rss_bytes(), **self.counters)
+        if (parse_seconds := self.stages.get('parse')) and 'rows_parsed' in self.counters:
+            report['rows_per_second'] = self.counters['rows_parsed'] / parse_seconds
+        if self.pipeline:
+            # the share of the time each stage was busy, the bottleneck being close to 1
+            report['pipeline'] = {name: dict(busy_seconds=busy, utilisation=busy / elapsed if elapsed else 0.0)
+                                  for name, (busy, elapsed) in self.pipeline.items()}
+        report['sets'] = {set_type: dict(sorted(counts.items())) for set_type, counts in sorted(self.sets.items())}
+        return report
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def failed(provider: str):
+    """
+    Returns the report of a provider whose run did not complete.
+    """
+    return dict(provider=provider, status='failed', timestamp=time.time())
+
+
+def write_json(path: str, reports: list):
+    """
+    Writes the reports of a run as a JSON document, to standard output if 'path' is '-', eg. for the journal.
+    """
+    document = json.dumps(dict(providers=reports), indent=None if path == '-' else 2)
+    if path == '-':
+        print(document)
+    else:
+        write_atomically(Path(path), document + '\n')
+
+
+def prometheus_lines(reports: list):
+    """
+    Yields the lines of the Prometheus text exposition of the reports of a run. All metrics are gauges.
+    """
+    def samples(key: str):
+        return [({}, r[key], r) for r in reports if key in r]
+
+    metrics = [
+        ('last_run_timestamp_seconds', 'Time the last run of a provider finished.', samples('timestamp')),
+        ('last_run_success', 'Whether the last run of a provider completed, with or without changes.',
+         [({}, int(r['status'] != 'failed'), r) for r in reports]),
+        ('up_to_date', 'Whether the last run found the upstream data unchanged and skipped generation.',
+         [({}, int(r['status'] == 'unchanged'), r) for r in reports]),
+        ('stage_duration_seconds', 'Duration of each stage of the last run.',
+         [({'stage': s}, seconds, r) for r in reports for s, seconds in r.get('stages', dict()).items()]),
+        ('download_bytes', 'Bytes downloaded by the last run.', samples('download_bytes')),
+        ('rows_parsed', 'CSV rows parsed by the last run.', samples('rows_parsed')),
+        ('rows_per_second', 'CSV rows parsed per second of the parse stage.', samples('rows_per_second')),
+        ('pipeline_utilisation', 'Share of the parsing time each pipeline stage was busy.',
+         [({'stage': s}, stage['utilisation'], r) for r in reports for s, stage in r.get('pipeline', dict()).items()]),
+        ('set_elements', 'Elements written to each set file by the last run.',
+         [({'type': t, 'set': s}, n, r) for r in reports for t, counts in r.get('sets', dict()).items()
+          for s, n in counts.items()]),
+        ('peak_rss_bytes', 'Peak resident memory of the last run.', samples('peak_rss_bytes')),
+    ]
+
+    for name, help_text, metric_samples in metrics:
+        if not metric_samples:
+            continue
+        yield "# HELP {0}{1} {2}".format(PREFIX, name, help_text)
+        yield "# TYPE {0}{1} gauge".format(PREFIX, name)
+        for labels, value, report in metric_samples:
+            labels = dict(provider=report['provider'], **labels)
+            label_text = ','.join('{0}="{1}"'.format(k, v) for k, v in labels.items())
+            yield "{0}{1}{{{2}}} {3}".format(PREFIX, name, label_text, value)
+
+
+def write_prometheus(path: str, reports: list):
+    """
+    Writes the reports of a run for the node exporter's textfile collector, eg. to
+    /var/lib/node_exporter/textfile_collector/geoipsets.prom
+    """
+    write_atomically(Path(path), ''.join(line + '\n' for line in prometheus_lines(reports)))
+
+
+def write_atomically(path: Path, text: str):
+    # readers, such as the textfile collector, never see a partially written file
+    temporary_path = path.with_name('.' + path.name + '.tmp')
+    temporary_path.write_text(text)
+    os.replace(temporary_path, path)
@@ -0,0 +1,55 @@
+# nft.py
+
+from pathlib import Path
+
+# named sets, eg. CA.ipv4, are held in this table
+TABLE = 'inet geoipsets'
+
+
+class BatchWriter:
+    """
+    Writes 'nft -f' scripts that declare named interval sets and refresh their contents.
+
+    Each set is (re)declared, flushed and refilled by the same script so 'nft -f' applies the update as one atomic
+    transaction: rules referencing the set never see it empty and the rest of the ruleset is not reloaded.
+    Scripts are written one per set, or with 'combined', one per address family covering every set, eg. all.ipv4.
+    """
+
+    def __init__(self, batch_dir: Path, combined: bool):
+        self.batch_dir = batch_dir
+        self.combined = combined
+        self.started = set()  # address families whose combined script has been started
+
+    def directory(self, addr_fam: str):
+        # staged set directories replace the published sets, so create them even if no set is written
+        path = self.batch_dir / addr_fam
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def write(self, set_name: str, elements: list, addr_fam: str):
+        if self.combined:
+            # the first set truncates the script, the others are appended to it
+            mode = 'a' if addr_fam in self.started else 'w'
+            self.started.add(addr_fam)
+            batch_path = self.directory(addr_fam) / ('all.' + addr_fam)
+        else:
+            mode = 'w'
+            batch_path = self.directory(addr_fam) / set_name
+
+        with open(batch_path, mode) as batch_file:
+            if mode == 'w':
+                batch_file.write("add table " + TABLE + "\n")
+            write_set(batch_file, set_name, elements, addr_fam)
+
+
+def write_set(batch_file, set_name: str, elements: list, addr_fam: str):
+    """
+    Writes the statements that declare the named set 'set_name', if it does not exist, and replace its elements.
+    """
+    batch_file.write("add set {0} {1} {{ type {2}_addr; flags interval; }}\n".format(TABLE, set_name, addr_fam))
+    batch_file.write("flush set {0} {1}\n".format(TABLE, set_name))
+    if elements:  # an empty element list is a syntax error
+        batch_file.write("add element {0} {1} {{\n".format(TABLE, set_name))
+        for element in elements:
+            batch_file.write(element + ",\n")
+        batch_file.write("}\n")
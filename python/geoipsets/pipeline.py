@@ -0,0 +1,137 @@
+# pipeline.py
+
+import threading
+from collections import deque
+from queue import Empty, Full, Queue
+from time import perf_counter
+
+# number of items queued between two stages, by default, before the stage feeding the queue waits
+DEPTH = 4
+# how often, in seconds, a stage waiting on a queue checks whether the pipeline was stopped
+POLL_INTERVAL = 0.1
+
+# marks the end of the items passed between stages
+_DONE = object()
+
+
+def run(stages: list, depths=DEPTH):
+    """
+    Runs 'stages', a list of (name, work) pairs, as a pipeline. Returns the time each stage was busy, keyed by name,
+    and the time the pipeline took: a stage busy for most of it is the bottleneck.
+
+    The 'work' of the first stage is an iterable, eg. of blocks read from a decompressing file, and that of each of the
+    others a function called with every item produced by the stage before it. Except for the last, the sink, which
+    runs on the calling thread, each stage runs on its own thread and passes its results on through a bounded queue,
+    so that work that releases the GIL (zlib, hashlib, file I/O) overlaps with the rest. Items are handled in order.
+
+    'depths' is the size of the queue in front of each stage, either a number or a dict keyed by stage name. If it is
+    0 all the stages run, one item at a time, on the calling thread.
+    """
+    started = perf_counter()
+    names = [name for name, _ in stages]
+    busy = dict.fromkeys(names, 0.0)
+    if not isinstance(depths, dict):
+        depths = dict.fromkeys(names[1:], depths)
+    if not any(depths.get(name, DEPTH) for name in names[1:]):
+        run_sequentially(stages, busy)
+        return busy, perf_counter() - started
+
+    stop = threading.Event()
+    errors = []
+    queues = [Queue(maxsize=max(1, depths.get(name, DEPTH))) for name in names[1:]]
+
+    def put(queue: Queue, item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def items(queue: Queue):
+        while not stop.is_set():
+            try:
+                item = queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def timed(name: str, iterator):
+        # the time taken to produce each item is that stage's busy time
+        while True:
+            start = perf_counter()
+            item = next(iterator, _DONE)
+            busy[name] += perf_counter() - start
+            if item is _DONE:
+                return
+            yield item
+
+    def stage_thread(name: str, inputs, function, output: Queue):
+        try:
+            for item in inputs:
+                if function is not None:
+                    start = perf_counter()
+                    item = function(item)
+                    busy[name] += perf_counter() - start
+                if not put(output, item):
+                    return
+        except BaseException as e:  # re-raised on the calling thread
+            errors.append(e)
+        finally:
+            put(output, _DONE)
+
+    (source_name, source), *middle, (sink_name, sink) = stages
+    threads = [threading.Thread(target=stage_thread, args=(source_name, timed(source_name, iter(source)), None,
+                                                           queues[0]), name=source_name, daemon=True)]
+    for i, (name, function) in enumerate(middle):
+        threads.append(threading.Thread(target=stage_thread, args=(name, items(queues[i]), function, queues[i + 1]),
+                                        name=name, daemon=True))
+
+    for thread in threads:
+        thread.start()
+    try:
+        for item in items(queues[-1]):
+            start = perf_counter()
+            sink(item)
+            busy[sink_name] += perf_counter() - start
+    finally:
+        # upstream stages stop, rather than wait forever, if the sink fails
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return busy, perf_counter() - started
+
+
+def run_sequentially(stages: list, busy: dict):
+    (source_name, source), *functions = stages
+    iterator = iter(source)
+    while True:
+        start = perf_counter()
+        item = next(iterator, _DONE)
+        busy[source_name] += perf_counter() - start
+        if item is _DONE:
+            return
+        for name, function in functions:
+            start = perf_counter()
+            item = function(item)
+            busy[name] += perf_counter() - start
+
+
+def submitted(executor, function, items, ahead: int, *args):
+    """
+    Yields, in order, the futures of function(item, *args) run by 'executor', eg. a process pool, for each of 'items',
+    submitting up to 'ahead' items beyond the one yielded so that the workers stay busy while its result is awaited.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item, *args))
+        if len(pending) > ahead:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
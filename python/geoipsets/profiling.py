@@ -0,0 +1,88 @@
+# profiling.py
+
+import io
+from contextlib import contextmanager
+from pathlib import Path
+
+PROFILERS = ('cpu', 'memory', 'all')
+# number of functions, and allocation sites, listed in the text reports
+TOP = 40
+
+# (label, snapshot) of each checkpoint() while memory is being profiled, otherwise None
+_snapshots = None
+
+
+def checkpoint(label: str):
+    """
+    Records the allocations held at this point, eg. at the end of a stage, if memory is being profiled.
+    """
+    if _snapshots is not None:
+        import tracemalloc
+        _snapshots.append((label, tracemalloc.take_snapshot()))
+
+
+@contextmanager
+def profile(profile_dir: str, name: str, profiler: str = 'cpu'):
+    """
+    Profiles the enclosed code, eg. the generate() of provider 'name', if 'profile_dir' is set.
+
+    With 'cpu' (or 'all') a cProfile dump is written to <profile_dir>/<name>.prof, for pstats or a viewer such as
+    snakeviz, with the TOP functions by cumulative time in <name>.cpu.txt. With 'memory' (or 'all') the peak traced
+    memory, and the TOP allocation sites holding memory at the end of each stage (see checkpoint()) and of the run,
+    are written to <name>.memory.txt. Only this process is profiled, not the worker processes started with --jobs.
+    """
+    global _snapshots
+    if not profile_dir:
+        yield
+        return
+
+    # imported on use, as profiling is rare
+    import cProfile
+    import tracemalloc
+
+    profile_dir = Path(profile_dir)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    cpu = profiler in ('cpu', 'all')
+    memory = profiler in ('memory', 'all')
+
+    cpu_profiler = cProfile.Profile() if cpu else None
+    if memory:
+        _snapshots = []
+        tracemalloc.start()
+    if cpu:
+        cpu_profiler.enable()
+    try:
+        yield
+    finally:
+        # reports are written even if the run fails, that may be why it is being profiled
+        if cpu:
+            cpu_profiler.disable()
+            write_cpu_reports(cpu_profiler, profile_dir, name)
+        if memory:
+            checkpoint('the run')
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            snapshots, _snapshots = _snapshots, None
+            write_memory_report(snapshots, peak, profile_dir / (name + '.memory.txt'))
+
+
+def write_cpu_reports(profiler, profile_dir: Path, name: str):
+    import pstats
+    profiler.dump_stats(profile_dir / (name + '.prof'))
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP)
+    (profile_dir / (name + '.cpu.txt')).write_text(report.getvalue())
+
+
+def write_memory_report(snapshots: list, peak: int, path: Path):
+    import tracemalloc
+    # the profiler's own allocations are left out
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    with open(path, 'w') as report:
+        report.write("peak traced memory: {0:.1f} MiB\n".format(peak / (1024 * 1024)))
+        for label, snapshot in snapshots:
+            statistics = snapshot.filter_traces(filters).statistics('lineno')
+            report.write("\nafter {0}: {1:.1f} MiB held by {2} allocation sites, the top {3} by size:\n".format(
+                label, sum(s.size for s in statistics) / (1024 * 1024), len(statistics), TOP))
+            for statistic in statistics[:TOP]:
+                report.write("{0}\n".format(statistic))
@@ -0,0 +1,167 @@
+# publish.py
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+from . import delta, utils
+
+
+class Publisher:
+    """
+    Publishes a provider's generated sets without exposing readers to empty or half-written directories.
+
+    Sets are generated into a staging directory inside the provider directory. On commit, each staged file whose
+    content differs from the published copy is moved into place with an atomic rename; unchanged files are left alone
+    and keep their inode and mtime. Files no longer generated are removed from the directories that were regenerated,
+    and the directories of optional outputs that were not generated, eg. index/ without --index, are removed.
+    A manifest records the content hash of every published file, and which files changed in the last run, so that
+    downstream reloads can target only those sets. It also records the files each index was published with, see
+    index_is_current().
+    """
+
+    def __init__(self, provider_dir: Path):
+        self.provider_dir = provider_dir
+        self.staging_dir = provider_dir / '.staging'
+        self.manifest_path = provider_dir / 'manifest.json'
+
+    def __enter__(self):
+        # discard anything left behind by an interrupted run
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        self.staging_dir.mkdir(parents=True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # nothing is published unless commit() was called
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return dict()
+
+    def commit(self, disabled=()):
+        """
+        Publishes the staged sets. Returns the relative paths of the files that were replaced and removed.
+        The top-level directories in 'disabled', those of outputs not generated by this run, are removed.
+        """
+        manifest = self.load_manifest()
+        digests = manifest.get('files', dict())
+        changed = []
+        removed = []
+        staged = []
+
+        for staged_dir, sub_dirs, file_names in os.walk(self.staging_dir):
+            sub_dirs.sort()  # publish, and report, in a stable order
+            if sub_dirs or staged_dir == str(self.staging_dir):  # only leaf directories hold sets
+                continue
+
+            relative_dir = Path(staged_dir).relative_to(self.staging_dir)
+            published_dir = self.provider_dir / relative_dir
+            published_dir.mkdir(parents=True, exist_ok=True)
+
+            for file_name in sorted(file_names):
+                relative_path = (relative_dir / file_name).as_posix()
+                staged.append(relative_path)
+                published_path = published_dir / file_name
+                digest = file_digest(Path(staged_dir) / file_name)
+                if published_path.is_file():
+                    # trust the manifest, unless the file was published by a version that did not write one
+                    published_digest = digests.get(relative_path) or file_digest(published_path)
+                    if published_digest == digest:
+                        digests[relative_path] = digest
+                        continue
+
+                os.replace(Path(staged_dir) / file_name, published_path)
+                digests[relative_path] = digest
+                changed.append(relative_path)
+
+            for published_path in sorted(published_dir.iterdir()):
+                if published_path.is_file() and published_path.name not in file_names:
+                    relative_path = (relative_dir / published_path.name).as_posix()
+                    published_path.unlink()
+                    digests.pop(relative_path, None)
+                    removed.append(relative_path)
+
+        for name in disabled:
+            if (disabled_dir := self.provider_dir / name).is_dir():
+                for published_path in sorted(p for p in disabled_dir.rglob('*') if p.is_file()):
+                    relative_path = published_path.relative_to(self.provider_dir).as_posix()
+                    digests.pop(relative_path, None)
+                    removed.append(relative_path)
+                shutil.rmtree(disabled_dir)
+
+        # the indexes published by this run were built from the files it published
+        indexes = {p: d for p, d in manifest.get('indexes', dict()).items() if p in digests}
+        for relative_path in staged:
+            if relative_path.startswith('index/'):
+                indexes[relative_path] = files_digest(digests, relative_path.split('/')[1])
+
+        self.save_manifest(dict(files=digests, changed=changed, removed=removed, indexes=indexes))
+        return changed, removed
+
+    def empty_deltas(self):
+        """
+        Empties the published deltas, when the sets are left as they were published, so that applying them again after
+        a run that skipped unchanged data does nothing. Returns the relative paths of the files emptied.
+        """
+        manifest = self.load_manifest()
+        digests = manifest.get('files', dict())
+        changed = []
+        for published_path in sorted(self.provider_dir.rglob('*' + delta.SUFFIX)):
+            if self.staging_dir in published_path.parents or published_path.stat().st_size == 0:
+                continue
+
+            relative_path = published_path.relative_to(self.provider_dir).as_posix()
+            temporary_path = published_path.with_name('.' + published_path.name + '.tmp')
+            temporary_path.touch()
+            os.replace(temporary_path, published_path)
+            digests[relative_path] = file_digest(published_path)
+            changed.append(relative_path)
+
+        if changed:
+            self.save_manifest(dict(manifest, files=digests, changed=changed, removed=[]))
+        return changed
+
+    def save_manifest(self, manifest: dict):
+        temporary_path = self.manifest_path.with_suffix('.tmp')
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.manifest_path)
+
+
+def file_digest(path: Path):
+    sha256_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(utils.CHUNK_SIZE):
+            sha256_hash.update(chunk)
+
+    return sha256_hash.hexdigest()
+
+
+def files_digest(digests: dict, addr_fam: str):
+    """
+    Returns a digest of the published sets of an address family, eg. ipset/ipv4/CA.ipv4, from their digests in a
+    manifest. Its index, and the deltas, emptied by runs that leave the sets as they were, are left out.
+    """
+    sha256_hash = hashlib.sha256()
+    for relative_path in sorted(digests):
+        parts = relative_path.split('/')
+        if len(parts) > 2 and parts[0] != 'index' and parts[1] == addr_fam and not relative_path.endswith(delta.SUFFIX):
+            sha256_hash.update("{0} {1}\n".format(relative_path, digests[relative_path]).encode())
+
+    return sha256_hash.hexdigest()
+
+
+def index_is_current(provider_dir: Path, index_path: Path, addr_fam: str):
+    """
+    Returns whether the index at 'index_path' was published with the provider's current files of 'addr_fam'. An index
+    left behind by an earlier run, or published by a version that did not record it, is not.
+    """
+    manifest = Publisher(provider_dir).load_manifest()
+    recorded = manifest.get('indexes', dict()).get(index_path.relative_to(provider_dir).as_posix())
+    return recorded is not None and recorded == files_digest(manifest.get('files', dict()), addr_fam)
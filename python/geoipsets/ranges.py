@@ -0,0 +1,358 @@
+# ranges.py
+
+from array import array
+from ipaddress import IPv6Address
+from socket import AF_INET, AF_INET6, inet_ntoa, inet_pton
+
+IPV4_BITS = 32
+IPV6_BITS = 128
+
+# Python >= 3.13 renders IPv4-mapped IPv6 addresses in dotted form (eg. ::ffff:1.2.3.4), older versions use hextets.
+# Match whichever the running interpreter does so output is identical to that of the ipaddress module.
+DOTTED_IPV4_MAPPED = str(IPv6Address('::ffff:1.2.3.4')) == '::ffff:1.2.3.4'
+
+
+def parse_ipv4(text: str):
+    return int.from_bytes(inet_pton(AF_INET, text), 'big')
+
+
+def parse_ipv6(text: str):
+    return int.from_bytes(inet_pton(AF_INET6, text), 'big')
+
+
+def parse_address(text: str):
+    """
+    Returns the IP version and integer value of a dotted (IPv4) or colon (IPv6) separated address.
+    """
+    if ':' in text:
+        return 6, parse_ipv6(text)
+
+    return 4, parse_ipv4(text)
+
+
+def format_ipv4(ip: int):
+    return inet_ntoa(ip.to_bytes(4, 'big'))
+
+
+def format_ipv6(ip: int):
+    """
+    Renders an IPv6 address exactly as str(ipaddress.IPv6Address(ip)) would.
+    """
+    if DOTTED_IPV4_MAPPED and ip >> 32 == 0xffff:
+        return '::ffff:' + format_ipv4(ip & 0xffffffff)
+
+    hextets = ['%x' % ((ip >> shift) & 0xffff) for shift in range(112, -16, -16)]
+
+    # find the longest run of zero hextets, the first one wins a tie
+    best_start, best_len, run_start, run_len = -1, 0, -1, 0
+    for i, hextet in enumerate(hextets):
+        if hextet == '0':
+            if run_len == 0:
+                run_start = i
+            run_len += 1
+            if run_len > best_len:
+                best_start, best_len = run_start, run_len
+        else:
+            run_len = 0
+
+    # a single zero hextet is not compressed
+    if best_len > 1:
+        best_end = best_start + best_len
+        if best_end == len(hextets):
+            hextets += ['']
+        hextets[best_start:best_end] = ['']
+        if best_start == 0:
+            hextets = [''] + hextets
+
+    return ':'.join(hextets)
+
+
+def range_to_cidrs(first: int, last: int, bits: int):
+    """
+    Yields the (network, prefix length) pairs of the smallest list of CIDRs exactly covering first..last (inclusive),
+    in ascending order. This is ipaddress.summarize_address_range() using plain integers.
+    """
+    all_ones = (1 << bits) - 1
+    while first <= last:
+        # the block size is limited by both the alignment of 'first' and the number of addresses remaining
+        if first == 0:
+            nbits = bits
+        else:
+            nbits = (first & -first).bit_length() - 1
+        nbits = min(nbits, (last - first + 1).bit_length() - 1)
+        yield first, bits - nbits
+        if first + (1 << nbits) - 1 == all_ones:
+            break
+        first += 1 << nbits
+
+
+def summarize(first: int, last: int, version: int):
+    """
+    Returns the CIDRs exactly covering first..last (inclusive) as 'network/prefixlen' strings.
+    """
+    if version == 4:
+        return [format_ipv4(net) + '/' + str(prefix) for net, prefix in range_to_cidrs(first, last, IPV4_BITS)]
+
+    return [format_ipv6(net) + '/' + str(prefix) for net, prefix in range_to_cidrs(first, last, IPV6_BITS)]
+
+
+def summarize_batch(firsts, lasts, version: int):
+    """
+    Vectorised range_to_cidrs() for many ranges at once, using NumPy.
+
+    'firsts' and 'lasts' are equal length sequences of range boundaries: integers for IPv4, or (high, low) pairs of
+    64 bit halves for IPv6. Returns three arrays (row, network, prefix length) ordered by row and then by network,
+    where 'row' indexes the input range each CIDR belongs to. For IPv6 'network' is a (high, low) pair of arrays.
+    """
+    import numpy as np
+
+    if version == 4:
+        return _summarize_batch_ipv4(np, np.asarray(firsts, dtype=np.uint64), np.asarray(lasts, dtype=np.uint64))
+
+    firsts = np.asarray(firsts, dtype=np.uint64).reshape(-1, 2)
+    lasts = np.asarray(lasts, dtype=np.uint64).reshape(-1, 2)
+    return _summarize_batch_ipv6(np, firsts[:, 0], firsts[:, 1], lasts[:, 0], lasts[:, 1])
+
+
+def _bit_length(np, x):
+    # exact bit_length() of each element of a uint64 array (float log2 loses precision above 2**53)
+    length = np.zeros(x.shape, dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        shifted = x >> np.uint64(shift)
+        mask = shifted != 0
+        length += np.where(mask, shift, 0)
+        x = np.where(mask, shifted, x)
+    return length + (x != 0)
+
+
+def _trailing_zeros(np, x, width):
+    # number of trailing zero bits of each element of a uint64 array, 'width' where the element is 0
+    lowest_bit = x & (~x + np.uint64(1))
+    return np.where(x == 0, width, _bit_length(np, lowest_bit) - 1)
+
+
+def _order_by_row(np, rows, *columns):
+    rows = np.concatenate(rows)
+    order = np.argsort(rows, kind='stable')  # CIDRs of each row were emitted in ascending order
+    return (rows[order],) + tuple(np.concatenate(c)[order] for c in columns)
+
+
+def _summarize_batch_ipv4(np, first, last):
+    rows = np.arange(first.size)
+    out_rows, out_nets, out_prefixes = [], [], []
+    while first.size:
+        nbits = np.minimum(_trailing_zeros(np, first, IPV4_BITS), _bit_length(np, last - first + np.uint64(1)) - 1)
+        out_rows.append(rows)
+        out_nets.append(first)
+        out_prefixes.append(IPV4_BITS - nbits)
+
+        # 64 bit arithmetic cannot overflow past the end of the IPv4 address space
+        first = first + (np.uint64(1) << nbits.astype(np.uint64))
+        remaining = first <= last
+        rows, first, last = rows[remaining], first[remaining], last[remaining]
+
+    rows, nets, prefixes = _order_by_row(np, out_rows, out_nets, out_prefixes)
+    return rows, nets, prefixes
+
+
+def _summarize_batch_ipv6(np, first_hi, first_lo, last_hi, last_lo):
+    one = np.uint64(1)
+    rows = np.arange(first_hi.size)
+    out_rows, out_hi, out_lo, out_prefixes = [], [], [], []
+    while rows.size:
+        # alignment of 'first'
+        tz = np.where(first_lo != 0, _trailing_zeros(np, first_lo, 64), 64 + _trailing_zeros(np, first_hi, 64))
+
+        # floor(log2(last - first + 1)), with 2**128 (the whole address space) as the special case
+        size_lo = last_lo - first_lo
+        size_hi = last_hi - first_hi - (last_lo < first_lo)
+        size_lo = size_lo + one
+        size_hi = size_hi + (size_lo == 0)
+        whole = (size_hi == 0) & (size_lo == 0)
+        log_size = np.where(size_hi != 0, 64 + _bit_length(np, size_hi), _bit_length(np, size_lo)) - 1
+        log_size = np.where(whole, IPV6_BITS, log_size)
+
+        nbits = np.minimum(tz, log_size)
+        out_rows.append(rows)
+        out_hi.append(first_hi)
+        out_lo.append(first_lo)
+        out_prefixes.append(IPV6_BITS - nbits)
+
+        # first += 2**nbits, as 128 bit arithmetic over the two halves
+        high_step = nbits >= 64
+        step_lo = np.where(high_step, np.uint64(0), one << np.where(high_step, 0, nbits).astype(np.uint64))
+        step_hi = np.where(high_step, one << np.where(high_step, nbits - 64, 0).astype(np.uint64), np.uint64(0))
+        step_hi = np.where(nbits == IPV6_BITS, np.uint64(0), step_hi)
+        new_lo = first_lo + step_lo
+        new_hi = first_hi + step_hi + (new_lo < first_lo)
+
+        # the range ended at the top of the address space if the addition wrapped around
+        wrapped = (nbits == IPV6_BITS) | (new_hi < first_hi)
+        remaining = ~wrapped & ((new_hi < last_hi) | ((new_hi == last_hi) & (new_lo <= last_lo)))
+        rows = rows[remaining]
+        first_hi, first_lo = new_hi[remaining], new_lo[remaining]
+        last_hi, last_lo = last_hi[remaining], last_lo[remaining]
+
+    rows, nets_hi, nets_lo, prefixes = _order_by_row(np, out_rows, out_hi, out_lo, out_prefixes)
+    return rows, (nets_hi, nets_lo), prefixes
+
+
+def parse_element(text: str, version: int):
+    """
+    Returns the (first, last) interval of a set element: a single address, a CIDR, or a 'first-last' range.
+    """
+    parse_address = parse_ipv4 if version == 4 else parse_ipv6
+    if '/' in text:
+        network, prefix = text.split('/')
+        first = parse_address(network)
+        return first, first + (1 << ((IPV4_BITS if version == 4 else IPV6_BITS) - int(prefix))) - 1
+
+    if '-' in text:
+        first, last = text.split('-')
+        return parse_address(first), parse_address(last)
+
+    ip = parse_address(text)
+    return ip, ip
+
+
+def merge_intervals(intervals):
+    """
+    Sorts (first, last) intervals and merges those that overlap or are adjacent in a single sweep.
+    Returns the minimal list of disjoint, non-adjacent intervals covering the same addresses.
+    """
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+
+    return merged
+
+
+def intervals_to_cidrs(intervals, version: int):
+    """
+    Renders intervals as the minimal list of 'network/prefixlen' strings.
+    """
+    cidrs = []
+    for first, last in intervals:
+        cidrs.extend(summarize(first, last, version))
+
+    return cidrs
+
+
+def intervals_to_ranges(intervals, version: int):
+    """
+    Renders intervals as 'first-last' strings, or a single address where first and last are the same.
+    """
+    format_address = format_ipv4 if version == 4 else format_ipv6
+    return [format_address(first) if first == last else format_address(first) + '-' + format_address(last)
+            for first, last in intervals]
+
+
+def diff_intervals(old, new):
+    """
+    Compares two lists of (first, last, ...) elements, each sorted by interval, in a single merge sweep.
+    Returns the elements only in 'old' (removed) and those only in 'new' (added), in ascending order.
+    Elements are matched by their exact interval, any items after 'last' are carried along unchanged.
+    """
+    removed, added = [], []
+    i = j = 0
+    while i < len(old) and j < len(new):
+        old_interval, new_interval = old[i][:2], new[j][:2]
+        if old_interval == new_interval:
+            i += 1
+            j += 1
+        elif old_interval < new_interval:
+            removed.append(old[i])
+            i += 1
+        else:
+            added.append(new[j])
+            j += 1
+
+    removed.extend(old[i:])
+    added.extend(new[j:])
+
+    return removed, added
+
+
+class Networks:
+    """
+    Compact list of the elements of one set: CIDRs (network, prefix length) or, with 'cidrs' False, ranges
+    (first, last).
+
+    Addresses are held in arrays of machine integers, 32 bits for IPv4 and (high, low) pairs of 64 bit halves for IPv6,
+    instead of one Python string per element, and are only rendered as text when the set is written.
+    """
+
+    def __init__(self, version: int, cidrs: bool = True):
+        self.version = version
+        self.cidrs = cidrs
+        self.firsts = array('I' if version == 4 else 'Q')
+        # prefix lengths of CIDRs, last addresses of ranges
+        self.seconds = array('B') if cidrs else array(self.firsts.typecode)
+
+    def __len__(self):
+        return len(self.firsts) if self.version == 4 else len(self.firsts) // 2
+
+    def append_address(self, addresses: array, ip: int):
+        if self.version == 4:
+            addresses.append(ip)
+        else:
+            addresses.append(ip >> 64)
+            addresses.append(ip & 0xffffffffffffffff)
+
+    def add_cidr(self, network: int, prefix: int):
+        self.append_address(self.firsts, network)
+        self.seconds.append(prefix)
+
+    def add_cidrs(self, cidrs):
+        # eg. those yielded by range_to_cidrs()
+        for network, prefix in cidrs:
+            self.add_cidr(network, prefix)
+
+    def add_range(self, first: int, last: int):
+        self.append_address(self.firsts, first)
+        self.append_address(self.seconds, last)
+
+    def extend(self, other):
+        """
+        Appends the elements of 'other', Networks of the same version and kind, eg. those parsed from one block.
+        """
+        self.firsts.extend(other.firsts)
+        self.seconds.extend(other.seconds)
+
+    def addresses(self, addresses: array):
+        if self.version == 4:
+            return addresses
+        return (high << 64 | low for high, low in zip(addresses[::2], addresses[1::2]))
+
+    def elements(self):
+        """
+        Yields the (network, prefix length) of each CIDR, or the (first, last) of each range.
+        """
+        seconds = self.seconds if self.cidrs or self.version == 4 else self.addresses(self.seconds)
+        return zip(self.addresses(self.firsts), seconds)
+
+    def intervals(self):
+        """
+        Yields the (first, last) interval of each element.
+        """
+        if not self.cidrs:
+            return self.elements()
+
+        bits = IPV4_BITS if self.version == 4 else IPV6_BITS
+        return ((network, network + (1 << (bits - prefix)) - 1) for network, prefix in self.elements())
+
+    def render(self):
+        """
+        Returns the elements as text: 'network/prefixlen' strings, or 'first-last' strings and single addresses.
+        """
+        format_address = format_ipv4 if self.version == 4 else format_ipv6
+        if self.cidrs:
+            return [format_address(network) + '/' + str(prefix) for network, prefix in self.elements()]
+
+        # nftables disallows intervals with the same start & end
+        return [format_address(first) if first == last else format_address(first) + '-' + format_address(last)
+                for first, last in self.elements()]
@@ -0,0 +1,52 @@
+# registry.py
+
+from functools import lru_cache
+from importlib import import_module
+
+# built-in providers, in the order they are run
+BUILTIN = {'maxmind': 'geoipsets.maxmind:MaxMindProvider',
+           'dbip': 'geoipsets.dbip:DbIpProvider'}
+# other packages register providers as entry points in this group, eg. in setup.py:
+#   entry_points={"geoipsets.providers": ["example = example_geoipsets:ExampleProvider"]}
+# the class is constructed like the built-in ones, see build_provider() in __main__.py
+ENTRY_POINT_GROUP = 'geoipsets.providers'
+
+
+@lru_cache(maxsize=None)
+def entry_points():
+    """
+    Returns the provider entry points of installed packages, keyed by provider name. Built-in names take precedence.
+    """
+    from importlib.metadata import entry_points as installed_entry_points  # scans installed packages, only if needed
+    return {ep.name: ep for ep in installed_entry_points(group=ENTRY_POINT_GROUP) if ep.name not in BUILTIN}
+
+
+def names():
+    """
+    Returns the names of all providers: the built-in ones, in their order, then the others alphabetically.
+    """
+    return list(BUILTIN) + sorted(entry_points())
+
+
+def load(name: str):
+    """
+    Returns the class of provider 'name', importing its module, and its dependencies, on first use.
+    """
+    if name in BUILTIN:
+        module_name, class_name = BUILTIN[name].split(':')
+        return getattr(import_module(module_name), class_name)
+
+    return entry_points()[name].load()
+
+
+class Names:
+    """
+    The provider names as argparse 'choices', looked up only when an option is validated or usage is printed, so
+    that no entry points are scanned for commands such as --version.
+    """
+
+    def __iter__(self):
+        return iter(names())
+
+    def __contains__(self, name):
+        return name in BUILTIN or name in names()
@@ -0,0 +1,173 @@
+# spool.py
+
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+from . import ranges
+
+# most spool files kept open at once, well below the usual limit of 1024 file descriptors per process
+MAX_OPEN_FILES = 64
+
+
+class FilePool:
+    """
+    Appends to any number of files while keeping at most 'max_open' of them open, closing the least recently used.
+    A file is truncated the first time it is written to and appended to when it is reopened.
+    """
+
+    def __init__(self, max_open: int = MAX_OPEN_FILES):
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.created = set()
+
+    def write(self, path: Path, text: str):
+        if (file := self.files.get(path)) is not None:
+            self.files.move_to_end(path)
+        else:
+            if len(self.files) >= self.max_open:
+                self.files.popitem(last=False)[1].close()
+            file = open(path, 'a' if path in self.created else 'w')
+            self.created.add(path)
+            self.files[path] = file
+
+        file.write(text)
+
+    def close_file(self, path: Path):
+        if (file := self.files.pop(path, None)) is not None:
+            file.close()
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files.clear()
+
+
+class Spool:
+    """
+    Temporary files that the elements of each set are appended to as they are parsed (--low-memory), so that memory
+    use does not grow with the size of the dataset. The spool directory is created below 'parent_dir', on the same
+    file system as the sets rather than in a temporary directory that may be held in memory.
+    """
+
+    def __init__(self, parent_dir: Path, aggregate: bool, ip_tables: bool, nf_tables: bool,
+                 max_open: int = MAX_OPEN_FILES):
+        parent_dir.mkdir(parents=True, exist_ok=True)
+        self.directory = tempfile.TemporaryDirectory(prefix='.spool-', dir=parent_dir)
+        self.pool = FilePool(max_open)
+        self.aggregate = aggregate
+        self.ip_tables = ip_tables
+        self.nf_tables = nf_tables
+
+    def networks(self, set_name: str, version: int, cidrs: bool = True):
+        """
+        Returns the SpooledNetworks of a set, used in place of ranges.Networks.
+        """
+        return SpooledNetworks(self, Path(self.directory.name) / set_name, version, cidrs)
+
+    def close(self):
+        self.pool.close()
+        self.directory.cleanup()
+
+
+class SpooledNetworks:
+    """
+    Counterpart of ranges.Networks whose elements are rendered as text when added and appended to spool files.
+
+    With aggregation each element is merged with the previous one if they overlap or are adjacent, and written once
+    the next one is not. As providers list networks in ascending order this gives the same minimal lists as
+    aggregating the whole set; unsorted data would still be covered exactly, only less compactly.
+    """
+
+    def __init__(self, spool: Spool, path: Path, version: int, cidrs: bool):
+        self.pool = spool.pool
+        self.version = version
+        self.cidrs = cidrs
+        self.bits = ranges.IPV4_BITS if version == 4 else ranges.IPV6_BITS
+        self.format_address = ranges.format_ipv4 if version == 4 else ranges.format_ipv6
+        self.aggregate = spool.aggregate
+        self.pending = None  # interval being merged
+        if self.aggregate:
+            self.ipset_path = path.with_name(path.name + '.ipset') if spool.ip_tables else None
+            self.nftset_path = path.with_name(path.name + '.nftset') if spool.nf_tables else None
+        else:  # both firewalls take the same elements
+            self.ipset_path = self.nftset_path = path
+        self.counts = dict()
+
+    def write(self, path: Path, elements: list):
+        self.pool.write(path, ''.join(e + '\n' for e in elements))
+        self.counts[path] = self.counts.get(path, 0) + len(elements)
+
+    def add_interval(self, first: int, last: int):
+        if self.pending is not None:
+            pending_first, pending_last = self.pending
+            if first <= pending_last + 1 and last >= pending_first - 1:
+                self.pending = (min(first, pending_first), max(last, pending_last))
+                return
+            self.write_interval(*self.pending)
+        self.pending = (first, last)
+
+    def write_interval(self, first: int, last: int):
+        if self.ipset_path:
+            self.write(self.ipset_path, ranges.intervals_to_cidrs([(first, last)], self.version))
+        if self.nftset_path:
+            self.write(self.nftset_path, ranges.intervals_to_ranges([(first, last)], self.version))
+
+    def add_cidr(self, network: int, prefix: int):
+        if self.aggregate:
+            self.add_interval(network, network + (1 << (self.bits - prefix)) - 1)
+        else:
+            self.write(self.ipset_path, [self.format_address(network) + '/' + str(prefix)])
+
+    def add_cidrs(self, cidrs):
+        for network, prefix in cidrs:
+            self.add_cidr(network, prefix)
+
+    def extend(self, networks):
+        # the elements of a ranges.Networks, eg. those parsed from one block
+        add = self.add_cidr if networks.cidrs else self.add_range
+        for first, second in networks.elements():
+            add(first, second)
+
+    def add_range(self, first: int, last: int):
+        if self.aggregate:
+            self.add_interval(first, last)
+        elif first == last:  # nftables disallows intervals with the same start & end
+            self.write(self.nftset_path, [self.format_address(first)])
+        else:
+            self.write(self.nftset_path, [self.format_address(first) + '-' + self.format_address(last)])
+
+    def finish(self):
+        """
+        Writes any pending element and returns the (ipset, nftables) elements of the set, see
+        AbstractProvider.aggregate_subnets().
+        """
+        if self.pending is not None:
+            self.write_interval(*self.pending)
+            self.pending = None
+
+        elements = []
+        for path in (self.ipset_path, self.nftset_path):
+            self.pool.close_file(path)
+            elements.append(SpooledElements(path, self.counts.get(path, 0)) if path else [])
+
+        return tuple(elements)
+
+
+class SpooledElements:
+    """
+    The elements of a spool file, one per line. Each iteration reads the file again.
+    """
+
+    def __init__(self, path: Path, count: int):
+        self.path = path
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        if self.count:
+            with open(self.path, 'r') as spool_file:
+                for line in spool_file:
+                    yield line[:-1]
@@ -1,9 +1,26 @@
 # utils.py
 
+import csv
+import os
+import shutil
+import time
 from abc import ABC, abstractmethod
 from enum import Enum
+from operator import itemgetter
 from pathlib import Path
 
+from . import cache, index, metrics, pipeline, ranges, spool
+
+# size of the blocks read from, and written to, downloads and archives
+CHUNK_SIZE = 64 * 1024
+# (connect, read) timeouts of HTTP requests, in seconds, so that a stalled connection never hangs a run
+HTTP_TIMEOUT = (15, 60)
+# retries of a failed HTTP request, or of a download interrupted part way, waiting HTTP_BACKOFF * 2^n seconds between
+HTTP_RETRIES = 5
+HTTP_BACKOFF = 1.0
+# size of the blocks of CSV data parsed at once
+BLOCK_SIZE = 1024 * 1024
+
 
 class Firewall(Enum):
     IP_TABLES = 'iptables'
@@ -18,7 +35,15 @@ class AddressFamily(Enum):
 class AbstractProvider(ABC):
     """Abstract base class providing common functionality for all Provider types."""
 
-    def __init__(self, firewall: set, address_family: set, checksum: bool, countries: set, output_dir: str):
+    # name of the provider's archive, and suffix of its checksum file, in a mirror directory (see archive_source())
+    archive_name = None
+    checksum_suffix = None
+
+    def __init__(self, firewall: set, address_family: set, checksum: bool, countries: set, output_dir: str,
+                 use_cache: bool = True, aggregate: bool = False, jobs: int = 1, delta: bool = False,
+                 nft_batch: str = None, ipset_swap: bool = False, write_index: bool = False, low_memory: bool = False,
+                 input_file: str = None, mirror_dir: str = None, fetch_only: bool = False,
+                 queue_depth: int = pipeline.DEPTH):
         self.ipv4 = AddressFamily.IPV4.value in address_family
         self.ipv6 = AddressFamily.IPV6.value in address_family
         self.nf_tables = Firewall.NF_TABLES.value in firewall
@@ -26,7 +51,408 @@ class AbstractProvider(ABC):
         self.checksum = checksum
         self.countries = countries
         self.base_dir = Path(output_dir) / 'geoipsets'
+        self.use_cache = use_cache
+        self.aggregate = aggregate
+        self.jobs = jobs
+        self.delta = delta
+        self.nft_batch = nft_batch
+        self.ipset_swap = ipset_swap
+        self.write_index = write_index
+        self.low_memory = low_memory
+        self.input_file = input_file
+        self.mirror_dir = mirror_dir
+        self.fetch_only = fetch_only
+        self.queue_depth = queue_depth
+        # stage durations, counters and set sizes of this run, see metrics.py
+        self.metrics = metrics.Metrics()
+
+        if low_memory and (delta or write_index):
+            # both need every element of a set, or of an address family, in memory
+            raise SystemExit("ERROR: --low-memory cannot be combined with --delta or --index")
 
     @abstractmethod
     def generate(self):
         pass
+
+    def fetch(self):
+        """
+        Downloads the provider's archive, and its checksum, into the mirror directory without generating any sets.
+        """
+        raise SystemExit("ERROR: {0} does not support --fetch-only".format(type(self).__name__))
+
+    def archive_source(self, provider: str):
+        """
+        Returns where the archive is read from instead of its upstream URL: the --input-file, or the provider's copy in
+        the --mirror-dir, a directory or an http(s) URL. Its checksum is in the file of the same name followed by
+        'checksum_suffix', eg. dbip-country-lite.csv.gz.sha1. Returns None if the archive is downloaded from upstream,
+        as it always is when populating the mirror with --fetch-only.
+        """
+        if self.fetch_only or not (self.input_file or self.mirror_dir):
+            return None
+
+        if self.input_file:
+            source = self.input_file
+        elif is_url(self.mirror_dir):
+            source = self.mirror_dir.rstrip('/') + '/' + provider + '/' + self.archive_name
+        else:
+            source = str(Path(self.mirror_dir) / provider / self.archive_name)
+
+        if not is_url(source) and not Path(source).is_file():
+            raise SystemExit("ERROR: Input file '{0}' does not exist".format(source))
+        return source
+
+    def publish_archive(self, provider: str, archive_path: str, hexdigest: str):
+        """
+        Moves a downloaded archive into the mirror directory, with a checksum file in the format of sha1sum/sha256sum,
+        for other hosts to generate their sets from (see archive_source()). Each file replaces the previous copy
+        atomically, a host that reads the new archive with the old checksum fails its checksum and retries on its
+        next run.
+        """
+        mirror_dir = Path(self.mirror_dir) / provider
+        mirror_dir.mkdir(parents=True, exist_ok=True)
+        archive = mirror_dir / self.archive_name
+        # the download may be on another file system, it is moved next to the archive before replacing it
+        temporary_path = archive.with_name('.' + archive.name + '.tmp')
+        shutil.move(archive_path, temporary_path)
+        os.replace(temporary_path, archive)
+        metrics.write_atomically(archive.with_name(archive.name + self.checksum_suffix),
+                                 "{0}  {1}\n".format(hexdigest, archive.name))
+        return archive
+
+    def fingerprint(self):
+        """
+        The options that determine the generated sets. Unchanged data is only re-parsed if these differ.
+        """
+        return dict(ipv4=self.ipv4, ipv6=self.ipv6, nf_tables=self.nf_tables, ip_tables=self.ip_tables,
+                    countries=self.countries if self.countries == 'all' else sorted(self.countries),
+                    aggregate=self.aggregate, delta=self.delta, nft_batch=self.nft_batch,
+                    ipset_swap=self.ipset_swap, write_index=self.write_index)
+
+    def disabled_outputs(self):
+        """
+        The directories, below the provider's, of the optional outputs this run does not write. They are removed when
+        the sets are published, so that eg. an index left by an earlier run with --index does not go stale.
+        """
+        disabled = []
+        if not self.nft_batch:
+            disabled.append('nftbatch')
+        if not self.write_index:
+            disabled.append('index')
+        return disabled
+
+    def aggregate_subnets(self, networks: ranges.Networks):
+        """
+        Returns the (ipset, nftables) elements to write for a set, as text.
+        If aggregation is enabled, overlapping and adjacent elements are merged and rendered as minimal CIDRs for
+        ipset, which only accepts networks, and as minimal ranges for nftables. Otherwise both are 'networks' as is.
+        """
+        if isinstance(networks, spool.SpooledNetworks):
+            # rendered, and aggregated, as they were spooled
+            return networks.finish()
+
+        if not self.aggregate:
+            subnets = networks.render()
+            return subnets, subnets
+
+        ip_version = networks.version
+        intervals = ranges.merge_intervals(networks.intervals())
+        ipset_subnets = ranges.intervals_to_cidrs(intervals, ip_version) if self.ip_tables else []
+        nftset_subnets = ranges.intervals_to_ranges(intervals, ip_version) if self.nf_tables else []
+
+        return ipset_subnets, nftset_subnets
+
+    def run_pipeline(self, stages: list, run_metrics: metrics.Metrics):
+        """
+        Runs the stages of parsing a CSV file, eg. decompress, parse and collect, on threads connected by queues of
+        --queue-depth blocks (see pipeline.run()), and records how busy each stage was in 'run_metrics'.
+        """
+        run_metrics.record_pipeline(*pipeline.run(stages, self.queue_depth))
+
+    def open_spool(self, provider: str):
+        """
+        Returns the spool.Spool that elements are written to as they are parsed with --low-memory, otherwise None.
+        """
+        if not self.low_memory:
+            return None
+
+        return spool.Spool(self.base_dir / provider, self.aggregate, self.ip_tables, self.nf_tables)
+
+    def build_index(self, staging_dir: Path, addr_fam: str, country_subnets: dict):
+        """
+        Writes the binary interval index (see index.py) of one address family from the elements of its sets,
+        'country_subnets' being keyed by set name, eg. CA.ipv4.
+        """
+        ip_version = 4 if addr_fam == AddressFamily.IPV4.value else 6
+        country_intervals = {set_name.split('.')[0]: list(networks.intervals())
+                             for set_name, networks in country_subnets.items() if set_name.endswith('.' + addr_fam)}
+        index.write_index(index.index_path(staging_dir, addr_fam), ip_version, country_intervals)
+
+    def cache_entry(self, provider: str, url: str, suffix: str):
+        """
+        Returns the download cache entry for 'url', or None if caching is disabled.
+        """
+        cache_dir = self.base_dir / '.cache' / provider
+        if not self.use_cache:
+            # the sets generated by this run may not match those recorded in the cache, so discard it
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            return None
+
+        return cache.CacheEntry(cache_dir, url, suffix, self.checksum)
+
+    def is_up_to_date(self, provider: str, cache_entry):
+        """
+        Were this provider's sets already generated, with the same options, from the current upstream data?
+        """
+        return cache_entry.is_generated(self.fingerprint()) and (self.base_dir / provider).is_dir()
+
+
+class DigestReader:
+    """
+    Binary file wrapper that updates 'digest' with every block read through it, eg. the decompressed CSV as it is
+    parsed, so that a checksum is verified without reading, or decompressing, the file a second time.
+    """
+
+    def __init__(self, binary_file, digest):
+        self.binary_file = binary_file
+        self.digest = digest
+
+    def read(self, size: int = -1):
+        data = self.binary_file.read(size)
+        self.digest.update(data)
+        return data
+
+
+def is_url(location: str):
+    return location.startswith(('http://', 'https://'))
+
+
+# the requests.Session of this process, see http_session()
+_session = None
+_session_pid = None
+
+
+def http_session():
+    """
+    Returns the requests.Session shared by all the HTTP requests of this process, so that connections to a host, eg. for
+    an archive and then its checksum, are reused. Requests that fail to connect, or get a 429 or 5xx response, are
+    retried with exponential backoff.
+    """
+    global _session, _session_pid
+    # a worker process does not share the connections of its parent
+    if _session is None or _session_pid != os.getpid():
+        # imported on use, like the providers that depend on it (see registry.py)
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF, status_forcelist=(429, 500, 502, 503, 504),
+                      raise_on_status=False)
+        _session = requests.Session()
+        _session.mount('https://', HTTPAdapter(max_retries=retry))
+        _session.mount('http://', HTTPAdapter(max_retries=retry))
+        _session_pid = os.getpid()
+
+    return _session
+
+
+def http_get(url: str, **kwargs):
+    """
+    Returns the response to a GET of 'url' through the shared session (see http_session()), with HTTP_TIMEOUT.
+    Exits with an error message if the request fails, or the response is an error, once retries are exhausted.
+    """
+    import requests
+
+    try:
+        http_response = http_session().get(url, timeout=HTTP_TIMEOUT, **kwargs)
+        http_response.raise_for_status()
+    except requests.RequestException as e:
+        raise SystemExit("ERROR: Cannot download '{0}': {1}".format(url, e))
+
+    return http_response
+
+
+def read_checksum(location: str):
+    """
+    Returns the digest in the checksum file at 'location', a path or an http(s) URL, eg. the output of sha1sum.
+    """
+    try:
+        if is_url(location):
+            return http_get(location).text.split()[0]
+
+        return Path(location).read_text().split()[0]
+    except (OSError, IndexError) as e:
+        raise SystemExit("ERROR: Cannot read checksum file '{0}' ({1}), use --no-checksum to skip validation".format(
+            location, e))
+
+
+def file_digest(path, digest):
+    """
+    Updates 'digest' with the contents of the file at 'path', read in blocks, and returns it.
+    """
+    with open(path, 'rb') as binary_file:
+        while chunk := binary_file.read(CHUNK_SIZE):
+            digest.update(chunk)
+
+    return digest
+
+
+def write_response(http_response, file, digest=None):
+    """
+    Write a streamed HTTP response to 'file' chunk by chunk, updating 'digest' (if any) as each chunk arrives.
+    The response must have been requested with 'stream=True' so that the body is never held in memory.
+    If the transfer is interrupted, the rest of the body is requested with an HTTP Range request and appended, up to
+    HTTP_RETRIES times, so that a flaky link does not restart a large download.
+    Returns the number of bytes written.
+    """
+    import requests
+
+    size = 0
+    response, skip = http_response, 0
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if skip:  # already written, the server sent the whole body again
+                    chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+                file.write(chunk)
+                size += len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+
+            if (length := response_length(http_response)) is None or size >= length:
+                return size
+            error = "connection closed after {0} of {1} bytes".format(size, length)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error = e
+        finally:
+            if response is not http_response:
+                response.close()
+
+        if attempt == HTTP_RETRIES or not resumable(http_response):
+            break
+        time.sleep(HTTP_BACKOFF * 2 ** attempt)
+        response, skip = resume_response(http_response, size)
+
+    raise SystemExit("ERROR: Download of '{0}' interrupted: {1}".format(http_response.url, error))
+
+
+def response_length(http_response):
+    """
+    Returns the length of the body of 'http_response' as sent, or None if it is unknown.
+    """
+    if 'Content-Length' in http_response.headers and 'Content-Encoding' not in http_response.headers:
+        return int(http_response.headers['Content-Length'])
+    return None
+
+
+def resumable(http_response):
+    # the body is written as decoded, so byte offsets only match those of the server if it was not encoded
+    return http_response.headers.get('Content-Encoding', 'identity') == 'identity'
+
+
+def resume_response(http_response, offset: int):
+    """
+    Returns the response to a request for the body of 'http_response' from 'offset', and the number of bytes at the
+    start of the new response that were already written. The request is conditional (If-Range) on the body being
+    unchanged, so that parts of two versions of a file are never joined.
+    """
+    validator = http_response.headers.get('ETag') or http_response.headers.get('Last-Modified')
+    headers = {'Range': 'bytes={0}-'.format(offset)}
+    if validator:
+        headers['If-Range'] = validator
+
+    # the final URL, after any redirect: eg. MaxMind redirects to a pre-signed URL that needs no credentials
+    response = http_get(http_response.url, headers=headers, stream=True)
+    content_range = response.headers.get('Content-Range', '')
+    if response.status_code == 206 and content_range.startswith('bytes {0}-'.format(offset)):
+        return response, 0
+
+    # ranges are not supported, or the file changed: the whole body is sent again
+    unchanged = validator and validator in (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    if response.status_code == 200 and unchanged:
+        return response, offset
+
+    response.close()
+    raise SystemExit("ERROR: Download of '{0}' cannot be resumed, the file changed".format(http_response.url))
+
+
+def iter_line_blocks(binary_file, block_size: int = BLOCK_SIZE):
+    """
+    Yields large blocks of bytes read from 'binary_file', each ending on a line boundary.
+    """
+    remainder = b''
+    while block := binary_file.read(block_size):
+        block = remainder + block
+        end = block.rfind(b'\n') + 1
+        remainder = block[end:]
+        if end:
+            yield block[:end]
+
+    if remainder:  # no trailing new line
+        yield remainder
+
+
+class CsvColumns:
+    """
+    Extracts a few columns, by position, from blocks of CSV lines.
+    Rows are returned as tuples of the requested column values, in the requested order, without building a dict
+    per row. Lines containing quotes are handed to the csv module; quoted fields spanning lines are not supported.
+    """
+
+    def __init__(self, columns: tuple, fieldnames: tuple = None):
+        # if 'fieldnames' is not given the first line parsed is the header
+        self.columns = columns
+        self.getter = None
+        self.width = 0
+        if fieldnames is not None:
+            self.set_fieldnames(fieldnames)
+
+    def set_fieldnames(self, fieldnames):
+        if missing := [c for c in self.columns if c not in fieldnames]:
+            raise SystemExit("ERROR: CSV file is missing expected column(s): {0}".format(', '.join(missing)))
+
+        indices = [fieldnames.index(c) for c in self.columns]
+        self.width = max(indices) + 1
+        if len(indices) == 1:
+            index = indices[0]
+            self.getter = lambda fields: (fields[index],)
+        else:
+            self.getter = itemgetter(*indices)
+
+    def parse(self, block: bytes):
+        """
+        Returns the rows of a block of complete lines as a list of tuples.
+        """
+        text = block.decode('utf-8')
+        if '\r' in text:
+            text = text.replace('\r\n', '\n')
+        lines = text.split('\n')
+        if self.getter is None:
+            self.set_fieldnames(next(csv.reader([lines.pop(0)])))
+
+        getter = self.getter
+        if '"' not in text:
+            try:  # fast path: no quoting and no short rows
+                return [getter(line.split(',')) for line in lines if line]
+            except IndexError:
+                pass
+
+        rows = []
+        for line in lines:
+            if not line:
+                continue
+            fields = next(csv.reader([line])) if '"' in line else line.split(',')
+            if len(fields) < self.width:  # missing trailing values are empty, as with csv.DictReader
+                fields.extend([''] * (self.width - len(fields)))
+            rows.append(getter(fields))
+
+        return rows
+
+
+def read_csv_rows(binary_file, columns: tuple, fieldnames: tuple = None):
+    """
+    Yields lists of rows, one list per block read from 'binary_file', containing only 'columns' (see CsvColumns).
+    The first line is the header unless 'fieldnames' is given.
+    """
+    parser = CsvColumns(columns, fieldnames)
+    for block in iter_line_blocks(binary_file):
+        yield parser.parse(block)
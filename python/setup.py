@@ -35,6 +35,7 @@ setup(
     packages=find_packages(exclude=("tests",)),
     include_package_data=True,
     install_requires=["requests", "beautifulsoup4"],
+    extras_require={"numpy": ["numpy"]},
     entry_points={
         "console_scripts": [
             "geoipsets=geoipsets.__main__:main",
@@ -0,0 +1,81 @@
+# cache_test.py
+
+import pytest
+
+from geoipsets import cache
+
+URL = 'https://download.db-ip.com/free/dbip-country-lite-2020-10.csv.gz'
+
+
+class FakeResponse:
+    """Minimal stand-in for a requests.Response, only the status and headers are inspected."""
+
+    def __init__(self, status_code=200, **headers):
+        self.status_code = status_code
+        self.headers = {k.replace('_', '-'): v for k, v in headers.items()}
+
+
+def cached_entry(tmp_path, response, verified=True):
+    entry = cache.CacheEntry(tmp_path, URL, '.csv.gz', False)
+    assert not entry.is_current(response)  # nothing cached yet
+    with entry.temporary_file() as f:
+        f.write(b'data')
+    entry.store(f.name, verified)
+    return entry
+
+
+def test_store_and_reload(tmp_path):
+    """
+    Is a stored download, and its validators, found again by a later run?
+    """
+    cached_entry(tmp_path, FakeResponse(ETag='"abc"', Last_Modified='Tue, 01 Dec 2020 00:00:00 GMT'))
+
+    entry = cache.CacheEntry(tmp_path, URL, '.csv.gz', True)
+    assert entry.path.read_bytes() == b'data'
+    assert entry.request_headers() == {'If-None-Match': '"abc"', 'If-Modified-Since': 'Tue, 01 Dec 2020 00:00:00 GMT'}
+    assert entry.is_current(FakeResponse(304))
+
+
+@pytest.mark.parametrize("cached, response, expected",
+                         [({'ETag': '"abc"'}, {'ETag': '"abc"'}, True),
+                          ({'ETag': '"abc"'}, {'ETag': '"def"'}, False),
+                          # etag takes precedence over the other validators
+                          ({'ETag': '"abc"', 'Last_Modified': 'x'}, {'ETag': '"def"', 'Last_Modified': 'x'}, False),
+                          ({'Content_Disposition': 'attachment; filename=GeoLite2-Country-CSV_20200922.zip'},
+                           {'Content_Disposition': 'attachment; filename=GeoLite2-Country-CSV_20200922.zip'}, True),
+                          ({'Content_Disposition': 'attachment; filename=GeoLite2-Country-CSV_20200922.zip'},
+                           {'Content_Disposition': 'attachment; filename="GeoLite2-Country-CSV_20200929.zip"'}, False),
+                          ({'Last_Modified': 'x'}, {'Last_Modified': 'x'}, True),
+                          ({}, {}, False)])
+def test_is_current(cached, response, expected, tmp_path):
+    """
+    Is a full (non-304) response compared against the cached validators correctly?
+    """
+    cached_entry(tmp_path, FakeResponse(**cached))
+    entry = cache.CacheEntry(tmp_path, URL, '.csv.gz', False)
+    assert entry.is_current(FakeResponse(**response)) == expected
+
+
+def test_unverified_entry_ignored(tmp_path):
+    """
+    Is a download that was never checked against a checksum ignored once checksums are required?
+    """
+    cached_entry(tmp_path, FakeResponse(ETag='"abc"'), verified=False)
+    assert cache.CacheEntry(tmp_path, URL, '.csv.gz', False).metadata
+    assert not cache.CacheEntry(tmp_path, URL, '.csv.gz', True).metadata
+
+
+def test_generated_and_eviction(tmp_path):
+    """
+    Are generation options recorded, and are entries for other URLs evicted?
+    """
+    entry = cached_entry(tmp_path, FakeResponse(ETag='"abc"'))
+    entry.set_generated({'ipv4': True})
+    assert cache.CacheEntry(tmp_path, URL, '.csv.gz', False).is_generated({'ipv4': True})
+    assert not cache.CacheEntry(tmp_path, URL, '.csv.gz', False).is_generated({'ipv4': False})
+
+    other = cache.CacheEntry(tmp_path, URL.replace('2020-10', '2020-11'), '.csv.gz', False)
+    with other.temporary_file() as f:
+        f.write(b'new data')
+    other.store(f.name, True)
+    assert sorted(tmp_path.iterdir()) == sorted([other.path, other.metadata_path])
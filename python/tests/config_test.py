@@ -35,7 +35,7 @@ def test_runas_module_invalid_option():
 
 
 @pytest.mark.parametrize("option", ['--provider', '--firewall', '--address-family',
-                                    '--countries', '--output-dir', '--config-file'])
+                                    '--countries', '--output-dir', '--config-file', '--jobs'])
 def test_valid_option_no_value(option):
     """
     Does the script exit if a valid option that requires a value doesn't have one?
@@ -44,7 +44,7 @@ def test_valid_option_no_value(option):
     assert out.returncode == 2
 
 
-@pytest.mark.parametrize("option", ['--provider', '--firewall', '--address-family'])
+@pytest.mark.parametrize("option", ['--provider', '--firewall', '--address-family', '--jobs', '--queue-depth'])
 def test_valid_option_invalid_value(option):
     """
     Does the script exit if an invalid value is passed to a valid option
@@ -118,6 +118,22 @@ def test_cli_repeated_option_duplicate_value(option, value):
                           ('firewall', {utils.Firewall.NF_TABLES.value}),
                           ('address-family', {utils.AddressFamily.IPV4.value}),
                           ('checksum', True),
+                          ('cache', True),
+                          ('aggregate', False),
+                          ('jobs', 1),
+                          ('queue-depth', 4),
+                          ('delta', False),
+                          ('nft-batch', None),
+                          ('ipset-swap', False),
+                          ('index', False),
+                          ('low-memory', False),
+                          ('input-file', None),
+                          ('mirror-dir', None),
+                          ('fetch-only', False),
+                          ('metrics', None),
+                          ('prometheus', None),
+                          ('profile', None),
+                          ('profiler', 'cpu'),
                           ('countries', 'all'),
                           ('output-dir', '/tmp')])
 def test_no_cli_opts_no_config_file(option, expected):
@@ -134,7 +150,10 @@ def test_no_cli_opts_no_config_file(option, expected):
                           ('address-family', utils.AddressFamily.IPV6.value, {utils.AddressFamily.IPV6.value}),
                           ('no-checksum', 'unused', False),
                           ('countries', 'RU,CN', {'ru', 'cn'}),
-                          ('output-dir', '/var/local', '/var/local')])
+                          ('output-dir', '/var/local', '/var/local'),
+                          ('jobs', '4', 4),
+                          ('queue-depth', '0', 0),
+                          ('nft-batch', 'combined', 'combined')])
 def test_single_cli_opts_no_config_file(option, value, expected):
     """
     Do single value CLI options correctly override defaults?
@@ -269,3 +288,32 @@ def test_config_file_provider_options(provider, monkeypatch):
 
     config = __main__.get_config(['-c', '/tmp/dummy.conf'])
     assert config.get(provider) == {'license-key': 'abcdefg', 'custom-option': 'custom-value'}
+
+
+@pytest.mark.parametrize("cli_args",
+                         [['--input-file', '/tmp/archive.zip', '-p', 'dbip', 'maxmind'],
+                          ['--fetch-only'],
+                          ['--fetch-only', '--mirror-dir', 'https://mirror.example.com/geoipsets']])
+def test_invalid_archive_sources(cli_args):
+    """
+    Are an input file for several providers, and fetching without a local mirror directory, rejected?
+    """
+    with pytest.raises(SystemExit):
+        __main__.get_config(cli_args + ['-c', '/tmp/dummy.conf'])
+
+
+def test_lookup_config(tmp_path):
+    """
+    Are lookup addresses and providers captured, with the output directory taken from the config file?
+    """
+    config_path = tmp_path / 'geoipsets.conf'
+    config_path.write_text("[general]\noutput-dir=/var/local\n")
+    config = __main__.get_lookup_config(['-c', str(config_path), '1.2.3.4', '::1', '-p', 'dbip'])
+    assert config == dict(address=['1.2.3.4', '::1'], stdin=False, provider=['dbip'], output_dir='/var/local')
+
+    config = __main__.get_lookup_config(['-c', str(config_path), '-o', '/tmp', '1.2.3.4'])
+    assert config == dict(address=['1.2.3.4'], stdin=False, provider=['maxmind', 'dbip'], output_dir='/tmp')
+
+    assert __main__.get_lookup_config(['--stdin']).get('stdin')
+    with pytest.raises(SystemExit):  # nothing to look up
+        __main__.get_lookup_config([])
@@ -0,0 +1,135 @@
+# dbip_test.py
+
+import gzip
+import hashlib
+import random
+from tempfile import NamedTemporaryFile
+
+import pytest
+
+from geoipsets import dbip, pipeline, ranges, utils
+
+CSV = b'1.0.0.0,1.0.0.255,CA\n1.0.1.0,1.0.1.255,ZZ\n1.0.2.0,1.0.3.255,CA\n2001::,2001::ffff,US\n'
+
+
+@pytest.fixture
+def provider(tmp_path, monkeypatch):
+    """
+    A checksum-enabled provider whose download, of CSV, and published digest are local.
+    """
+    # compressed before GzipFile is patched below, gzip.compress() uses it on some Python versions
+    csv_gz = gzip.compress(CSV)
+
+    def download(url, cache_entry=None):
+        with (cache_entry.temporary_file() if cache_entry else
+              NamedTemporaryFile(dir=tmp_path, suffix='.csv.gz', delete=False)) as gzip_file:
+            gzip_file.write(csv_gz)
+        return gzip_file.name
+
+    provider = dbip.DbIpProvider({'nftables'}, {'ipv4', 'ipv6'}, True, 'all', str(tmp_path))
+    provider.download_url = lambda: 'https://download.db-ip.com/free/dbip-country-lite-2020-10.csv.gz'
+    provider.download = download
+    provider.download_checksum = lambda: hashlib.sha1(CSV).hexdigest()
+
+    # count how many times the download is decompressed
+    provider.decompressed = 0
+    gzip_file = gzip.GzipFile
+
+    def counting_gzip_file(*args, **kwargs):
+        provider.decompressed += 1
+        return gzip_file(*args, **kwargs)
+
+    monkeypatch.setattr(gzip, 'GzipFile', counting_gzip_file)
+    return provider
+
+
+def test_checksum_verified_while_parsing(provider):
+    """
+    Is the CSV file decompressed only once, to be both hashed and parsed, and are the sets cached and published?
+    """
+    provider.generate()
+
+    assert provider.decompressed == 1
+    assert list(provider.metrics.stages) == ['download', 'parse', 'checksum', 'write', 'publish']
+    assert (provider.base_dir / 'dbip/nftset/ipv4/CA.ipv4').read_text() == \
+        "define CA.ipv4 = {\n1.0.0.0-1.0.0.255,\n1.0.2.0-1.0.3.255,\n}\n"
+    cache_entry = provider.cache_entry('dbip', provider.download_url(), '.csv.gz')
+    assert cache_entry.path.is_file() and cache_entry.metadata['verified']
+
+
+def test_checksum_mismatch(provider):
+    """
+    Is nothing published or cached, and the download discarded, if the CSV file does not match its checksum?
+    """
+    provider.download_checksum = lambda: hashlib.sha1(b'another release').hexdigest()
+    with pytest.raises(SystemExit, match='does not match'):
+        provider.generate()
+
+    assert not (provider.base_dir / 'dbip').exists()
+    assert list((provider.base_dir / '.cache/dbip').iterdir()) == []
+
+
+def test_fetch_only_then_generate_from_mirror(provider, tmp_path):
+    """
+    Does --fetch-only populate the mirror, and can another host generate the same sets from it without downloading?
+    """
+    mirror_dir = tmp_path / 'mirror'
+    provider.mirror_dir, provider.fetch_only = str(mirror_dir), True
+    provider.fetch()
+
+    assert sorted(p.name for p in (mirror_dir / 'dbip').iterdir()) == ['dbip-country-lite.csv.gz',
+                                                                       'dbip-country-lite.csv.gz.sha1']
+    assert (mirror_dir / 'dbip/dbip-country-lite.csv.gz.sha1').read_text() == \
+        hashlib.sha1(CSV).hexdigest() + "  dbip-country-lite.csv.gz\n"
+    assert not (provider.base_dir / 'dbip').exists()
+
+    host = dbip.DbIpProvider({'nftables'}, {'ipv4', 'ipv6'}, True, 'all', str(tmp_path / 'host'),
+                             mirror_dir=str(mirror_dir))
+    host.download = None  # nothing is downloaded
+    host.generate()
+
+    assert (host.base_dir / 'dbip/nftset/ipv6/US.ipv6').read_text() == "define US.ipv6 = {\n2001::-2001::ffff,\n}\n"
+    assert (mirror_dir / 'dbip/dbip-country-lite.csv.gz').is_file()  # read in place, not removed
+
+
+def test_input_file(tmp_path):
+    gzip_path = tmp_path / 'dbip.csv.gz'
+    gzip_path.write_bytes(gzip.compress(CSV))
+    with pytest.raises(SystemExit, match='Cannot read checksum file'):
+        dbip.DbIpProvider({'nftables'}, {'ipv4'}, True, 'all', str(tmp_path), input_file=str(gzip_path)).generate()
+
+    (tmp_path / 'dbip.csv.gz.sha1').write_text(hashlib.sha1(CSV).hexdigest() + "  dbip-country-lite.csv\n")
+    dbip.DbIpProvider({'nftables'}, {'ipv4'}, True, 'all', str(tmp_path), input_file=str(gzip_path)).generate()
+    assert (tmp_path / 'geoipsets/dbip/nftset/ipv4/CA.ipv4').is_file()
+
+    with pytest.raises(SystemExit, match='does not exist'):
+        dbip.DbIpProvider({'nftables'}, {'ipv4'}, True, 'all', str(tmp_path),
+                          input_file=str(tmp_path / 'missing.csv.gz')).generate()
+
+
+@pytest.mark.parametrize("firewall, queue_depth", [({'nftables'}, pipeline.DEPTH), ({'iptables'}, 0)])
+def test_parallel_parse_matches_sequential(tmp_path, firewall, queue_depth):
+    """
+    Are the sets parsed by worker processes, a few blocks at a time, those parsed in this process, in the same order?
+    With --queue-depth 0 the blocks are still parsed by the workers, but decompressed and collected on this thread.
+    """
+    rng = random.Random(3)
+    lines = []
+    for i in range(80000):
+        first = (1 << 24) + i * 1024 + rng.randrange(8)
+        lines.append('{0},{1},{2}\n'.format(ranges.format_ipv4(first), ranges.format_ipv4(first + rng.randrange(256)),
+                                            rng.choice(['CA', 'US', 'ZZ'])))
+    lines.append('2001::,2001::ffff,US\n')
+    gzip_path = tmp_path / 'dbip.csv.gz'
+    gzip_path.write_bytes(gzip.compress(''.join(lines).encode()))
+    assert len(list(utils.iter_line_blocks(gzip.open(gzip_path)))) > 2
+
+    expected = dbip.DbIpProvider(firewall, {'ipv4', 'ipv6'}, True, 'all', str(tmp_path)).parse_csv(gzip_path)
+    provider = dbip.DbIpProvider(firewall, {'ipv4', 'ipv6'}, True, 'all', str(tmp_path), jobs=2,
+                                 queue_depth=queue_depth)
+    parsed = provider.parse_csv(gzip_path)
+
+    assert list(parsed) == list(expected)
+    assert all(list(parsed[key].intervals()) == list(expected[key].intervals()) for key in expected)
+    assert provider.metrics.counters['rows_parsed'] == len(lines)
+    assert list(provider.metrics.pipeline) == ['decompress', 'collect']  # the blocks are parsed by the workers
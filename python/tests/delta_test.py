@@ -0,0 +1,114 @@
+# delta_test.py
+
+import gzip
+
+import pytest
+
+from geoipsets import dbip, delta, index, publish
+
+
+def write_ipset(path, subnets):
+    path.write_text("create CA.ipv4 hash:net family inet maxelem 131072 comment\n" +
+                    "".join("add CA.ipv4 " + s + " comment CA\n" for s in subnets))
+
+
+def write_nftset(path, subnets):
+    path.write_text("define CA.ipv4 = {\n" + "".join(s + ",\n" for s in subnets) + "}\n")
+
+
+def test_read_elements(tmp_path):
+    subnets = ['1.0.0.0/24', '2.0.0.0/8']
+    write_ipset(tmp_path / 'ipset', subnets)
+    write_nftset(tmp_path / 'nftset', subnets)
+    assert delta.read_ipset_elements(tmp_path / 'ipset') == subnets
+    assert delta.read_nftset_elements(tmp_path / 'nftset') == subnets
+
+
+def test_diff_elements_ignores_order():
+    removed, added = delta.diff_elements(['3.0.0.0/8', '1.0.0.0/24', '2.0.0.0/8'],
+                                         ['2.0.0.0/8', '1.0.0.0/25', '1.0.0.128/25'], 4)
+    assert removed == ['1.0.0.0/24', '3.0.0.0/8']
+    assert added == ['1.0.0.0/25', '1.0.0.128/25']
+
+
+def test_ipset_delta(tmp_path):
+    previous = tmp_path / 'previous'
+    write_ipset(previous, ['1.0.0.0/24', '3.0.0.0/8'])
+    current = tmp_path / 'CA.ipv4'
+
+    delta.write_ipset_delta(current, previous, 'CA.ipv4', 'CA', ['1.0.0.0/24', '4.0.0.0/8'], 4)
+    assert (tmp_path / 'CA.ipv4.delta').read_text() == ("del CA.ipv4 3.0.0.0/8\n"
+                                                        "add CA.ipv4 4.0.0.0/8 comment CA\n")
+
+
+def test_nftset_delta(tmp_path):
+    previous = tmp_path / 'previous'
+    write_nftset(previous, ['2001:db8::1', '2001:db8::10-2001:db8::19'])
+    current = tmp_path / 'CA.ipv6'
+
+    delta.write_nftset_delta(current, previous, 'CA.ipv6', ['2001:db8::1', '2001:db8::/127'], 6)
+    assert (tmp_path / 'CA.ipv6.delta').read_text() == ("delete element inet geoipsets CA.ipv6 {\n"
+                                                        "2001:db8::10-2001:db8::19,\n"
+                                                        "}\n"
+                                                        "add element inet geoipsets CA.ipv6 {\n"
+                                                        "2001:db8::/127,\n"
+                                                        "}\n")
+
+    # unchanged sets get an empty delta
+    write_nftset(previous, ['2001:db8::1'])
+    delta.write_nftset_delta(current, previous, 'CA.ipv6', ['2001:db8::1'], 6)
+    assert (tmp_path / 'CA.ipv6.delta').read_text() == ""
+
+
+def test_no_delta_without_previous_set(tmp_path):
+    delta.write_ipset_delta(tmp_path / 'CA.ipv4', tmp_path / 'missing', 'CA.ipv4', 'CA', ['1.0.0.0/24'], 4)
+    assert not (tmp_path / 'CA.ipv4.delta').exists()
+
+
+@pytest.mark.parametrize("nft_batch", [None, 'per-set'])
+def test_nftset_deltas_need_nft_batch(tmp_path, nft_batch):
+    """
+    Are nftables deltas, which update the named sets of the nft batch scripts, only written with --nft-batch?
+    """
+    csv_path = tmp_path / 'dbip.csv.gz'
+    for csv in (b'1.0.0.0,1.0.0.255,CA\n', b'1.0.0.0,1.0.0.255,CA\n1.0.2.0,1.0.3.255,CA\n'):
+        csv_path.write_bytes(gzip.compress(csv))
+        provider = dbip.DbIpProvider({'iptables', 'nftables'}, {'ipv4'}, False, 'all', str(tmp_path), use_cache=False,
+                                     delta=True, nft_batch=nft_batch)
+        provider.download = lambda url, cache_entry=None: str(csv_path)
+        provider.generate()
+
+    sets_dir = provider.base_dir / 'dbip'
+    assert (sets_dir / 'ipset/ipv4/CA.ipv4.delta').read_text() == "add CA.ipv4 1.0.2.0/23 comment CA\n"
+    assert (sets_dir / 'nftset/ipv4/CA.ipv4.delta').exists() == bool(nft_batch)
+
+
+def test_deltas_emptied_when_unchanged(tmp_path):
+    """
+    Are the deltas of the previous run emptied, so that applying them again does nothing, when the upstream data is
+    unchanged and the sets are not regenerated?
+    """
+    def download(url, cache_entry=None):
+        if csv is None:  # the cached copy is current
+            return None
+        with cache_entry.temporary_file() as gzip_file:
+            gzip_file.write(gzip.compress(csv))
+        return gzip_file.name
+
+    for csv in (b'1.0.0.0,1.0.0.255,CA\n', b'1.0.0.0,1.0.0.255,CA\n1.0.2.0,1.0.3.255,CA\n', None):
+        provider = dbip.DbIpProvider({'iptables', 'nftables'}, {'ipv4'}, False, 'all', str(tmp_path), delta=True,
+                                     nft_batch='per-set', write_index=True)
+        provider.download = download
+        provider.generate()
+
+    sets_dir = provider.base_dir / 'dbip'
+    assert provider.metrics.status == 'unchanged'
+    assert (sets_dir / 'ipset/ipv4/CA.ipv4.delta').read_text() == ""
+    assert (sets_dir / 'nftset/ipv4/CA.ipv4.delta').read_text() == ""
+    assert (sets_dir / 'ipset/ipv4/CA.ipv4').read_text().endswith("add CA.ipv4 1.0.2.0/23 comment CA\n")
+
+    manifest = publish.Publisher(sets_dir).load_manifest()
+    assert manifest['changed'] == ['ipset/ipv4/CA.ipv4.delta', 'nftset/ipv4/CA.ipv4.delta']
+    assert manifest['files']['ipset/ipv4/CA.ipv4.delta'] == publish.file_digest(sets_dir / 'ipset/ipv4/CA.ipv4.delta')
+    # the index still matches the sets
+    assert publish.index_is_current(sets_dir, index.index_path(sets_dir, 'ipv4'), 'ipv4')
@@ -0,0 +1,92 @@
+# index_test.py
+
+import gzip
+import random
+
+import pytest
+
+from geoipsets import dbip, index, ranges
+
+
+def random_countries(bits, seed=1):
+    """
+    Disjoint intervals spread over the address space, each assigned a random country.
+    """
+    rng = random.Random(seed)
+    bounds = sorted(rng.sample(range(1 << bits) if bits == 32 else [rng.getrandbits(bits) for _ in range(4000)], 2000))
+    country_intervals = dict()
+    for first, last in zip(bounds[::2], bounds[1::2]):
+        country_intervals.setdefault(rng.choice(['CA', 'US', 'RU', 'CN', 'DE']), []).append((first, last))
+    return country_intervals
+
+
+@pytest.mark.parametrize("version, bits", [(4, 32), (6, 128)])
+def test_write_and_lookup(version, bits, tmp_path):
+    """
+    Is every address inside, at the edges of, and between intervals attributed to the right country?
+    """
+    country_intervals = random_countries(bits)
+    path = index.index_path(tmp_path, 'ipv' + str(version))
+    index.write_index(path, version, country_intervals)
+
+    expected = sorted((first, last, cc) for cc, intervals in country_intervals.items() for first, last in intervals)
+    with index.IntervalIndex(path) as idx:
+        assert idx.ip_version == version
+        assert len(idx) == len(expected)
+        assert [idx.interval(i) for i in range(len(idx))] == expected
+
+        for (first, last, cc), (next_first, _, _) in zip(expected, expected[1:] + [((1 << bits), 0, '')]):
+            assert idx.lookup(first) == cc
+            assert idx.lookup(last) == cc
+            assert idx.lookup((first + last) // 2) == cc
+            if last + 1 < next_first:
+                assert idx.lookup(last + 1) is None
+
+
+def test_country_intervals_are_merged(tmp_path):
+    path = tmp_path / 'geoipsets.idx'
+    elements = ['10.0.0.0/25', '10.0.0.128/25', '10.0.2.0-10.0.2.9', '10.0.0.0/24']
+    index.write_index(path, 4, {'CA': [ranges.parse_element(e, 4) for e in elements], 'US': [(1, 1)]})
+    with index.IntervalIndex(path) as idx:
+        assert idx.countries == ['CA', 'US']
+        assert [idx.interval(i) for i in range(len(idx))] == [(1, 1, 'US'), (0x0a000000, 0x0a0000ff, 'CA'),
+                                                              (0x0a000200, 0x0a000209, 'CA')]
+
+
+def test_empty_index(tmp_path):
+    path = tmp_path / 'geoipsets.idx'
+    index.write_index(path, 6, dict())
+    with index.IntervalIndex(path) as idx:
+        assert len(idx) == 0
+        assert idx.lookup(1) is None
+
+
+def test_invalid_files(tmp_path):
+    path = tmp_path / 'geoipsets.idx'
+    path.write_bytes(b'not an index' * 4)
+    with pytest.raises(ValueError):
+        index.IntervalIndex(path)
+
+    index.write_index(path, 4, {'CA': [(1, 2), (5, 6)]})
+    path.write_bytes(path.read_bytes()[:-4])
+    with pytest.raises(ValueError):
+        index.IntervalIndex(path)
+
+
+def test_index_removed_without_option(tmp_path):
+    """
+    Is the index of an earlier run with --index, and its nft batch scripts, removed by a run without those options?
+    """
+    csv_path = tmp_path / 'dbip.csv.gz'
+    for csv, options in ((b'1.0.0.0,1.0.0.255,AA\n', dict(write_index=True, nft_batch='combined')),
+                         (b'1.0.0.0,1.0.0.255,UD\n', dict())):
+        csv_path.write_bytes(gzip.compress(csv))
+        provider = dbip.DbIpProvider({'nftables'}, {'ipv4'}, False, 'all', str(tmp_path), use_cache=False, **options)
+        provider.download = lambda url, cache_entry=None: str(csv_path)
+        provider.generate()
+        if options:
+            assert index.index_path(provider.base_dir / 'dbip', 'ipv4').is_file()
+
+    assert not (provider.base_dir / 'dbip/index').exists()
+    assert not (provider.base_dir / 'dbip/nftbatch').exists()
+    assert (provider.base_dir / 'dbip/nftset/ipv4/UD.ipv4').is_file()
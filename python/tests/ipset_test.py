@@ -0,0 +1,115 @@
+# ipset_test.py
+
+import io
+
+import pytest
+
+from geoipsets import ipset
+
+
+def restore(script: str, sets: dict):
+    """
+    Applies an 'ipset restore' script to 'sets', a dict of set name -> (create options, set of elements), the way
+    ipset would, without a kernel. Raises ValueError on the first command ipset would reject.
+    """
+    for line in script.splitlines():
+        command, name, *args = line.split()
+        if command == 'create':
+            exist = args[-1] == '-exist'
+            options = tuple(args[:-1] if exist else args)
+            if name in sets:
+                if not exist or sets[name][0] != options:
+                    raise ValueError("set already exists: " + line)
+            else:
+                sets[name] = (options, set())
+        elif name not in sets:
+            raise ValueError("set does not exist: " + line)
+        elif command == 'add':
+            if args[0] in sets[name][1]:
+                raise ValueError("element already added: " + line)
+            sets[name][1].add(args[0])
+        elif command == 'flush':
+            sets[name][1].clear()
+        elif command == 'swap':
+            if args[0] not in sets:
+                raise ValueError("set does not exist: " + line)
+            sets[name], sets[args[0]] = sets[args[0]], sets[name]
+        elif command == 'destroy':
+            del sets[name]
+        else:
+            raise ValueError("unknown command: " + line)
+
+    return sets
+
+
+def restore_script(subnets: list, swap: bool, maxelem: int = 131072):
+    ipset_file = io.StringIO()
+    restore_name = ipset.write_header(ipset_file, 'CA.ipv4', 'family inet', maxelem, swap)
+    for subnet in subnets:
+        ipset_file.write("add " + restore_name + " " + subnet + " comment CA\n")
+    ipset.write_footer(ipset_file, 'CA.ipv4', swap)
+    return ipset_file.getvalue()
+
+
+def test_plain_script():
+    script = restore_script(['1.0.0.0/24'], False)
+    assert script == ("create CA.ipv4 hash:net family inet maxelem 131072 comment\n"
+                      "add CA.ipv4 1.0.0.0/24 comment CA\n")
+    sets = restore(script, dict())
+    assert sets['CA.ipv4'][1] == {'1.0.0.0/24'}
+
+    with pytest.raises(ValueError):  # cannot be restored over the existing set
+        restore(script, sets)
+
+
+def test_swap_script():
+    script = restore_script(['1.0.0.0/24', '2.0.0.0/24'], True)
+    assert script == ("create CA.ipv4 hash:net family inet maxelem 16777216 comment -exist\n"
+                      "create CA.ipv4-tmp hash:net family inet maxelem 16777216 comment -exist\n"
+                      "flush CA.ipv4-tmp\n"
+                      "add CA.ipv4-tmp 1.0.0.0/24 comment CA\n"
+                      "add CA.ipv4-tmp 2.0.0.0/24 comment CA\n"
+                      "swap CA.ipv4-tmp CA.ipv4\n"
+                      "destroy CA.ipv4-tmp\n")
+
+
+def test_swap_script_replaces_existing_set():
+    """
+    Can the script be restored on a fresh host, then again over the live set, and after an interrupted restore?
+    """
+    sets = restore(restore_script(['1.0.0.0/24', '2.0.0.0/24'], True), dict())
+    assert sets == {'CA.ipv4': (('hash:net', 'family', 'inet', 'maxelem', '16777216', 'comment'),
+                                {'1.0.0.0/24', '2.0.0.0/24'})}
+
+    sets = restore(restore_script(['2.0.0.0/24', '3.0.0.0/24'], True), sets)
+    assert set(sets) == {'CA.ipv4'}
+    assert sets['CA.ipv4'][1] == {'2.0.0.0/24', '3.0.0.0/24'}
+
+    # a temporary set left behind, with stale elements, is reused
+    sets['CA.ipv4-tmp'] = (sets['CA.ipv4'][0], {'9.0.0.0/24'})
+    sets = restore(restore_script(['4.0.0.0/24'], True), sets)
+    assert sets['CA.ipv4'][1] == {'4.0.0.0/24'}
+    assert 'CA.ipv4-tmp' not in sets
+
+
+def test_swap_script_maxelem_changes():
+    """
+    Is the live set replaced when the size of the set crosses a power of two between runs?
+    """
+    sets = restore(restore_script(['1.0.0.0/24'], True, 131072), dict())
+    sets = restore(restore_script(['2.0.0.0/24'], True, 262144), sets)
+    assert set(sets) == {'CA.ipv4'}
+    assert sets['CA.ipv4'][1] == {'2.0.0.0/24'}
+
+    sets = restore(restore_script(['3.0.0.0/24'], True, 131072), sets)
+    assert sets['CA.ipv4'][1] == {'3.0.0.0/24'}
+
+    # only a set larger than SWAP_MAXELEM needs a larger maxelem
+    script = restore_script(['4.0.0.0/24'], True, 2 * ipset.SWAP_MAXELEM)
+    assert "maxelem {0} ".format(2 * ipset.SWAP_MAXELEM) in script
+
+
+def test_swap_script_empty_set():
+    sets = restore(restore_script([], True), {'CA.ipv4': (('hash:net', 'family', 'inet', 'maxelem', '16777216',
+                                                          'comment'), {'1.0.0.0/24'})})
+    assert sets['CA.ipv4'][1] == set()
@@ -0,0 +1,115 @@
+# lookup_test.py
+
+import io
+import random
+import sys
+
+import pytest
+
+from geoipsets import index, lookup, publish, ranges
+
+
+def write_sets(provider_dir, addr_fam, sets: dict):
+    nftset_dir = provider_dir / 'nftset' / addr_fam
+    nftset_dir.mkdir(parents=True)
+    for set_name, elements in sets.items():
+        (nftset_dir / set_name).write_text("define " + set_name + " = {\n" + "".join(e + ",\n" for e in elements) +
+                                           "}\n")
+
+
+@pytest.fixture
+def base_dir(tmp_path):
+    write_sets(tmp_path / 'dbip', 'ipv4', {'CA.ipv4': ['1.0.0.0-1.0.0.255', '3.0.0.0/8'], 'US.ipv4': ['2.0.0.0/8']})
+    write_sets(tmp_path / 'dbip', 'ipv6', {'DE.ipv6': ['2001:db8::/32']})
+    # the maxmind sets are superseded by the binary index published with them
+    with publish.Publisher(tmp_path / 'maxmind') as publisher:
+        write_sets(publisher.staging_dir, 'ipv4', {'US.ipv4': ['1.0.0.0/24']})
+        index.write_index(index.index_path(publisher.staging_dir, 'ipv4'), 4,
+                          {'RU': [ranges.parse_element('1.0.0.0/24', 4)]})
+        publisher.commit()
+    return tmp_path
+
+
+def test_lookup(base_dir):
+    with lookup.Lookup(base_dir) as resolver:
+        assert resolver.lookup('1.0.0.7') == [('maxmind', 'RU', []),
+                                              ('dbip', 'CA', [base_dir / 'dbip/nftset/ipv4/CA.ipv4'])]
+        assert resolver.lookup('2.255.255.255') == [('maxmind', None, []),
+                                                    ('dbip', 'US', [base_dir / 'dbip/nftset/ipv4/US.ipv4'])]
+        assert resolver.lookup('4.0.0.0') == [('maxmind', None, []), ('dbip', None, [])]
+
+        # maxmind has no IPv6 sets
+        assert resolver.lookup('2001:db8::1') == [('dbip', 'DE', [base_dir / 'dbip/nftset/ipv6/DE.ipv6'])]
+
+
+def test_stale_index_is_ignored(base_dir):
+    """
+    Are the set files read instead of an index that was not published with them, eg. left by an earlier run?
+    """
+    with publish.Publisher(base_dir / 'maxmind') as publisher:
+        write_sets(publisher.staging_dir, 'ipv4', {'US.ipv4': ['1.0.0.0/24'], 'CA.ipv4': ['3.0.0.0/8']})
+        publisher.commit()
+
+    assert index.index_path(base_dir / 'maxmind', 'ipv4').is_file()
+    with lookup.Lookup(base_dir, ['maxmind']) as resolver:
+        assert resolver.lookup('1.0.0.7') == [('maxmind', 'US', [base_dir / 'maxmind/nftset/ipv4/US.ipv4'])]
+        assert resolver.lookup('3.0.0.1')[0][1] == 'CA'
+
+    (base_dir / 'maxmind/manifest.json').unlink()  # published by a version without a manifest
+    with lookup.Lookup(base_dir, ['maxmind']) as resolver:
+        assert resolver.lookup('1.0.0.7')[0][1] == 'US'
+
+
+def test_lookup_selected_providers(base_dir):
+    with lookup.Lookup(base_dir, ['dbip']) as resolver:
+        assert [provider for provider, _, _ in resolver.lookup('1.0.0.7')] == ['dbip']
+
+
+def test_lookup_invalid_address(base_dir):
+    with lookup.Lookup(base_dir) as resolver:
+        with pytest.raises(ValueError):
+            resolver.lookup('1.0.0.256')
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_lookup_many(use_numpy, tmp_path, monkeypatch):
+    """
+    Does the batch lookup agree with one lookup per address, with and without NumPy?
+    """
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setitem(sys.modules, 'numpy', None)  # import fails
+
+    rng = random.Random(3)
+    with publish.Publisher(tmp_path / 'dbip') as publisher:
+        for version, bits in ((4, 32), (6, 128)):
+            bounds = {rng.getrandbits(bits) for _ in range(2000)}
+            if version == 6:  # sibling intervals sharing the high half of their start
+                bounds.update((1 << 127) + i for i in range(40))
+            bounds = sorted(bounds)
+            country_intervals = dict()
+            for first, last in zip(bounds[::2], bounds[1::2]):
+                country_intervals.setdefault(rng.choice(['CA', 'US', 'RU']), []).append((first, last))
+            index.write_index(index.index_path(publisher.staging_dir, 'ipv' + str(version)), version,
+                              country_intervals)
+        publisher.commit()
+
+    addresses = [ranges.format_ipv4(rng.getrandbits(32)) for _ in range(3000)]
+    addresses += [ranges.format_ipv6(rng.getrandbits(128)) for _ in range(3000)]
+    addresses += [ranges.format_ipv6((1 << 127) + i) for i in range(45)]
+    rng.shuffle(addresses)
+
+    with lookup.Lookup(tmp_path) as resolver:
+        expected = [resolver.lookup(a)[0][1] for a in addresses]
+        assert resolver.lookup_many(addresses + ['bad', '1.2.3.4.5'], 'dbip') == expected + [None, None]
+        assert any(expected)
+
+
+def test_lookup_stream(base_dir, monkeypatch):
+    monkeypatch.setattr(lookup, 'BATCH_SIZE', 2)
+    in_file = io.StringIO("1.0.0.7\n\n2001:db8::1\n9.9.9.9\nbad\n2.0.0.1\n")
+    out_file = io.StringIO()
+    with lookup.Lookup(base_dir) as resolver:
+        resolver.lookup_stream(in_file, out_file, 'dbip')
+    assert out_file.getvalue() == "1.0.0.7,CA\n2001:db8::1,DE\n9.9.9.9,\nbad,\n2.0.0.1,US\n"
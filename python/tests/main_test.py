@@ -0,0 +1,57 @@
+# main_test.py
+
+import concurrent.futures
+import io
+
+import pytest
+
+from geoipsets import __main__
+
+
+def fake_generate(name, opts):
+    if name == 'maxmind':
+        raise SystemExit("MaxMind license key required")
+    if name == 'broken':
+        raise ValueError("unexpected archive contents")
+    if name == 'exit-code':
+        raise SystemExit(3)
+    return dict(provider=name, status='ok')
+
+
+@pytest.fixture
+def concurrent_generate(monkeypatch):
+    """
+    Runs fake_generate() in threads, which share the patched module, unlike worker processes. Returns what is printed
+    to stderr.
+    """
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', concurrent.futures.ThreadPoolExecutor)
+    monkeypatch.setattr(__main__, 'generate', fake_generate)
+    monkeypatch.setattr(__main__, 'stderr', io.StringIO())
+    return __main__.stderr
+
+
+def test_one_provider_exits(concurrent_generate, capsys):
+    """
+    Does a provider exiting with a message fail the run, without stopping the other provider or losing its report?
+    """
+    exit_code, reports = __main__.generate_concurrently(['maxmind', 'dbip'], dict(jobs=2))
+
+    assert capsys.readouterr().out.splitlines() == ["maxmind: failed (exit code 1)", "dbip: done"]
+    assert concurrent_generate.getvalue() == "MaxMind license key required\n"
+    assert exit_code == 1
+    assert [(report['provider'], report['status']) for report in reports] == [('dbip', 'ok'), ('maxmind', 'failed')]
+
+
+def test_one_provider_raises(concurrent_generate, capsys):
+    """
+    Is an unexpected exception printed and reported as a failure, and an explicit exit code passed on?
+    """
+    exit_code, reports = __main__.generate_concurrently(['dbip', 'broken', 'exit-code'], dict(jobs=2))
+
+    out, err = capsys.readouterr()  # tracebacks are printed to sys.stderr
+    assert out.splitlines() == ["dbip: done", "broken: failed (exit code 1)", "exit-code: failed (exit code 3)"]
+    assert "ValueError: unexpected archive contents" in err
+    assert exit_code == 3
+    assert [(report['provider'], report['status']) for report in reports] == [('dbip', 'ok'),
+                                                                              ('broken', 'failed'),
+                                                                              ('exit-code', 'failed')]
@@ -0,0 +1,130 @@
+# maxmind_test.py
+
+import hashlib
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from types import SimpleNamespace
+from zipfile import ZipFile
+
+import pytest
+
+from geoipsets import maxmind
+
+PREFIX = 'GeoLite2-Country-CSV_20240101/'
+LOCATIONS = ('geoname_id,locale_code,continent_code,continent_name,country_iso_code,country_name,'
+             'is_in_european_union\n6251999,en,NA,"North America",CA,Canada,0\n')
+BLOCKS = ('network,geoname_id,registered_country_geoname_id,represented_country_geoname_id,is_anonymous_proxy,'
+          'is_satellite_provider\n')
+CREDENTIALS = {'account-id': '123456', 'license-key': 'abcdefg'}
+
+
+@pytest.fixture
+def mirror_dir(tmp_path):
+    """
+    A mirror directory holding a small GeoLite2 Country CSV zip and its sha256sum, as written by --fetch-only.
+    """
+    zip_path = tmp_path / 'mirror/maxmind/GeoLite2-Country-CSV.zip'
+    zip_path.parent.mkdir(parents=True)
+    with ZipFile(zip_path, 'w') as zip_file:
+        zip_file.writestr(PREFIX + 'LICENSE.txt', 'test data\n')
+        zip_file.writestr(PREFIX + 'GeoLite2-Country-Locations-en.csv', LOCATIONS)
+        zip_file.writestr(PREFIX + 'GeoLite2-Country-Blocks-IPv4.csv', BLOCKS + '1.0.0.0/24,6251999,6251999,,0,0\n')
+        zip_file.writestr(PREFIX + 'GeoLite2-Country-Blocks-IPv6.csv', BLOCKS + '2001::/32,,6251999,,0,0\n')
+    sha256sum = hashlib.sha256(zip_path.read_bytes()).hexdigest()
+    (tmp_path / 'mirror/maxmind/GeoLite2-Country-CSV.zip.sha256').write_text(sha256sum + "  " + zip_path.name + "\n")
+    return tmp_path / 'mirror'
+
+
+def test_credentials_required():
+    with pytest.raises(SystemExit, match='Account ID'):
+        maxmind.MaxMindProvider({'nftables'}, {'ipv4'}, True, 'all', '/tmp', None)
+
+
+def test_generate_from_mirror(mirror_dir, tmp_path):
+    """
+    Are the sets generated from the mirror, without credentials, and is the mirror's archive left in place?
+    """
+    provider = maxmind.MaxMindProvider({'nftables'}, {'ipv4', 'ipv6'}, True, 'all', str(tmp_path), None,
+                                       mirror_dir=str(mirror_dir))
+    provider.download = None  # nothing is downloaded
+    provider.generate()
+
+    assert (provider.base_dir / 'maxmind/nftset/ipv4/CA.ipv4').read_text() == "define CA.ipv4 = {\n1.0.0.0/24,\n}\n"
+    assert (provider.base_dir / 'maxmind/nftset/ipv6/CA.ipv6').read_text() == "define CA.ipv6 = {\n2001::/32,\n}\n"
+    assert list(provider.metrics.stages) == ['checksum', 'parse', 'write', 'publish']
+    assert (mirror_dir / 'maxmind/GeoLite2-Country-CSV.zip').is_file()
+
+
+def test_mirror_checksum_mismatch(mirror_dir, tmp_path):
+    (mirror_dir / 'maxmind/GeoLite2-Country-CSV.zip.sha256').write_text(hashlib.sha256(b'').hexdigest() + "\n")
+    provider = maxmind.MaxMindProvider({'nftables'}, {'ipv4'}, True, 'all', str(tmp_path), None,
+                                       mirror_dir=str(mirror_dir))
+    with pytest.raises(SystemExit, match='does not match'):
+        provider.generate()
+    assert not (provider.base_dir / 'maxmind').exists()
+
+
+def test_parallel_build_matches_sequential(mirror_dir, tmp_path, monkeypatch, capsys):
+    """
+    Are the same sets built, and the same metrics recorded, when both address-families are built in worker processes?
+    """
+    zip_path = mirror_dir / 'maxmind/GeoLite2-Country-CSV.zip'
+
+    def download(self, zip_url, cache_entry=None):
+        # a copy of the archive, which is removed once the sets are built
+        download_path = tmp_path / 'download.zip'
+        download_path.write_bytes(zip_path.read_bytes())
+        return SimpleNamespace(name=str(download_path)), None
+
+    # patched on the class, the provider remains picklable for the worker processes
+    monkeypatch.setattr(maxmind.MaxMindProvider, 'download', download)
+
+    providers = []
+    for jobs in (1, 2):
+        provider = maxmind.MaxMindProvider({'iptables', 'nftables'}, {'ipv4', 'ipv6'}, False, 'all',
+                                           str(tmp_path / 'jobs-{0}'.format(jobs)), CREDENTIALS, use_cache=False,
+                                           jobs=jobs)
+        provider.generate()
+        providers.append(provider)
+
+        out = capsys.readouterr().out
+        assert "MaxMind ipv4 sets built in" in out and "MaxMind ipv6 sets built in" in out
+
+    sequential, parallel = ({path.relative_to(provider.base_dir): path.read_bytes()
+                             for path in provider.base_dir.rglob('*') if path.is_file()}
+                            for provider in providers)
+    assert parallel == sequential
+    assert sequential[Path('maxmind/ipset/ipv6/CA.ipv6')].endswith(b"add CA.ipv6 2001::/32 comment CA\n")
+
+    # the measurements taken in the workers are merged into the provider's
+    sequential, parallel = (provider.metrics for provider in providers)
+    assert list(parallel.stages) == list(sequential.stages) == ['download', 'parse', 'write', 'publish']
+    assert parallel.counters == sequential.counters and parallel.counters['rows_parsed'] > 0
+    assert parallel.sets == sequential.sets == {'ipset': {'CA.ipv4': 1, 'CA.ipv6': 1},
+                                                'nftset': {'CA.ipv4': 1, 'CA.ipv6': 1}}
+
+
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_download_checksum_mismatch(mirror_dir, tmp_path, use_cache):
+    """
+    Is a download that does not match its checksum removed, from the cache directory too, so that the next run fetches
+    it again?
+    """
+    provider = maxmind.MaxMindProvider({'nftables'}, {'ipv4'}, True, 'all', str(tmp_path / 'output'), CREDENTIALS,
+                                       use_cache=use_cache)
+
+    def download(zip_url, cache_entry=None):
+        with (cache_entry.temporary_file() if cache_entry else
+              NamedTemporaryFile(dir=tmp_path, suffix='.zip', delete=False)) as zip_file:
+            zip_file.write((mirror_dir / 'maxmind/GeoLite2-Country-CSV.zip').read_bytes())
+        downloads.append(Path(zip_file.name))
+        return zip_file, hashlib.sha256(Path(zip_file.name).read_bytes())
+
+    downloads = []
+    provider.download = download
+    provider.download_checksum = lambda: hashlib.sha256(b'').hexdigest()
+    with pytest.raises(SystemExit, match='does not match'):
+        provider.generate()
+
+    assert len(downloads) == 1 and not downloads[0].exists()
+    assert not (provider.base_dir / 'maxmind').exists()
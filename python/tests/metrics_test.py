@@ -0,0 +1,73 @@
+# metrics_test.py
+
+import gzip
+import json
+
+from geoipsets import dbip, metrics
+
+
+def test_stages_accumulate_and_merge():
+    build_metrics = metrics.Metrics()
+    with build_metrics.stage('parse'):
+        pass
+    build_metrics.count('rows_parsed', 10)
+    build_metrics.count_set('ipset', 'CA.ipv4', 3)
+
+    run_metrics = metrics.Metrics()
+    with run_metrics.stage('parse'):
+        pass
+    run_metrics.count('rows_parsed', 5)
+    run_metrics.merge(build_metrics)
+
+    assert run_metrics.stages['parse'] >= build_metrics.stages['parse']
+    report = run_metrics.report('dbip')
+    assert report['rows_parsed'] == 15
+    assert report['sets'] == {'ipset': {'CA.ipv4': 3}}
+    assert report['status'] == 'generated'
+    assert report['peak_rss_bytes'] > 0
+    assert 'rows_per_second' in report
+
+
+def test_prometheus_lines():
+    reports = [dict(provider='dbip', status='generated', timestamp=1.5, stages={'parse': 2.0}, download_bytes=7,
+                    sets={'nftset': {'CA.ipv4': 4}}),
+               metrics.failed('maxmind')]
+    lines = list(metrics.prometheus_lines(reports))
+
+    assert '# TYPE geoipsets_stage_duration_seconds gauge' in lines
+    assert 'geoipsets_stage_duration_seconds{provider="dbip",stage="parse"} 2.0' in lines
+    assert 'geoipsets_download_bytes{provider="dbip"} 7' in lines
+    assert 'geoipsets_set_elements{provider="dbip",type="nftset",set="CA.ipv4"} 4' in lines
+    assert 'geoipsets_last_run_success{provider="dbip"} 1' in lines
+    assert 'geoipsets_last_run_success{provider="maxmind"} 0' in lines
+    # metrics without samples are left out
+    assert not any(line.startswith('# HELP geoipsets_rows_parsed') for line in lines)
+
+
+def test_write_files(tmp_path):
+    reports = [metrics.failed('dbip')]
+    metrics.write_json(str(tmp_path / 'metrics.json'), reports)
+    metrics.write_prometheus(str(tmp_path / 'geoipsets.prom'), reports)
+
+    assert json.loads((tmp_path / 'metrics.json').read_text()) == dict(providers=reports)
+    assert (tmp_path / 'geoipsets.prom').read_text().endswith('geoipsets_up_to_date{provider="dbip"} 0\n')
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['geoipsets.prom', 'metrics.json']
+
+
+def test_provider_run_is_measured(tmp_path):
+    """
+    Does a provider run record its stages, rows and set sizes?
+    """
+    csv_path = tmp_path / 'dbip.csv.gz'
+    csv_path.write_bytes(gzip.compress(b'1.0.0.0,1.0.0.255,CA\n1.0.1.0,1.0.1.255,ZZ\n1.0.2.0,1.0.3.255,CA\n'
+                                       b'2001::,2001::ffff,US\n'))
+    provider = dbip.DbIpProvider({'iptables', 'nftables'}, {'ipv4', 'ipv6'}, False, 'all', str(tmp_path),
+                                 use_cache=False)
+    provider.download = lambda url, cache_entry=None: str(csv_path)
+    provider.generate()
+
+    report = provider.metrics.report('dbip')
+    assert list(report['stages']) == ['download', 'parse', 'write', 'publish']
+    assert report['rows_parsed'] == 4
+    assert list(report['pipeline']) == ['decompress', 'parse', 'collect']
+    assert report['sets'] == {'ipset': {'CA.ipv4': 2, 'US.ipv6': 1}, 'nftset': {'CA.ipv4': 2, 'US.ipv6': 1}}
@@ -0,0 +1,47 @@
+# nft_test.py
+
+from geoipsets import nft
+
+
+def test_per_set_script(tmp_path):
+    """
+    Does each script declare its set and replace the elements in one transaction?
+    """
+    batch = nft.BatchWriter(tmp_path, False)
+    batch.write('CA.ipv4', ['1.0.0.0/24', '2.0.0.0-2.0.0.9'], 'ipv4')
+    assert (tmp_path / 'ipv4' / 'CA.ipv4').read_text() == ("add table inet geoipsets\n"
+                                                           "add set inet geoipsets CA.ipv4 "
+                                                           "{ type ipv4_addr; flags interval; }\n"
+                                                           "flush set inet geoipsets CA.ipv4\n"
+                                                           "add element inet geoipsets CA.ipv4 {\n"
+                                                           "1.0.0.0/24,\n"
+                                                           "2.0.0.0-2.0.0.9,\n"
+                                                           "}\n")
+
+
+def test_empty_set(tmp_path):
+    batch = nft.BatchWriter(tmp_path, False)
+    batch.write('CA.ipv6', [], 'ipv6')
+    script = (tmp_path / 'ipv6' / 'CA.ipv6').read_text()
+    assert 'type ipv6_addr' in script
+    assert script.endswith("flush set inet geoipsets CA.ipv6\n")
+
+
+def test_combined_script(tmp_path):
+    """
+    Are all sets of an address family written to one script, replacing that of a previous run?
+    """
+    (tmp_path / 'ipv4').mkdir()
+    (tmp_path / 'ipv4' / 'all.ipv4').write_text('stale\n')
+
+    batch = nft.BatchWriter(tmp_path, True)
+    batch.write('CA.ipv4', ['1.0.0.0/24'], 'ipv4')
+    batch.write('CA.ipv6', ['::1'], 'ipv6')
+    batch.write('US.ipv4', ['2.0.0.0/24'], 'ipv4')
+
+    assert sorted(p.name for p in tmp_path.rglob('*.*')) == ['all.ipv4', 'all.ipv6']
+    script = (tmp_path / 'ipv4' / 'all.ipv4').read_text()
+    assert script.startswith("add table inet geoipsets\n")
+    assert script.count("add table") == 1
+    assert 'stale' not in script
+    assert script.index("flush set inet geoipsets CA.ipv4") < script.index("flush set inet geoipsets US.ipv4")
@@ -0,0 +1,101 @@
+# pipeline_test.py
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from geoipsets import metrics, pipeline
+
+
+@pytest.mark.parametrize("depths", [1, pipeline.DEPTH, {'parse': 2}, 0])
+def test_items_handled_in_order(depths):
+    """
+    Does each item go through every stage, in order, whether the stages run on threads or one after the other?
+    """
+    collected = []
+    busy, elapsed = pipeline.run([('decompress', range(100)),
+                                  ('parse', lambda i: i * 2),
+                                  ('format', str),
+                                  ('collect', collected.append)], depths)
+
+    assert collected == [str(i * 2) for i in range(100)]
+    assert list(busy) == ['decompress', 'parse', 'format', 'collect']
+    assert all(0 <= seconds <= elapsed for seconds in busy.values())
+
+
+def test_stages_run_on_threads():
+    threads = dict()
+
+    def record(name):
+        def work(item):
+            threads[name] = threading.current_thread()
+            return item
+        return work
+
+    pipeline.run([('decompress', range(3)), ('parse', record('parse')), ('collect', record('collect'))])
+    assert threads['collect'] is threading.current_thread()
+    assert threads['parse'] is not threading.current_thread()
+
+    pipeline.run([('decompress', range(3)), ('parse', record('parse')), ('collect', record('collect'))], 0)
+    assert threads['parse'] is threading.current_thread()
+
+
+def test_stage_error_is_raised():
+    """
+    Is an error raised on a stage's thread raised by run(), after the other stages have stopped?
+    """
+    def parse(item):
+        if item == 50:
+            raise ValueError('bad row')
+        return item
+
+    collected = []
+    with pytest.raises(ValueError, match='bad row'):
+        pipeline.run([('decompress', range(1000)), ('parse', parse), ('collect', collected.append)])
+    assert collected == list(range(50))
+    assert threading.active_count() == 1
+
+
+def test_sink_error_stops_the_pipeline():
+    """
+    Do the threads feeding a failed sink stop, rather than wait forever on a full queue?
+    """
+    def collect(item):
+        raise OSError('disk full')
+
+    with pytest.raises(OSError, match='disk full'):
+        pipeline.run([('decompress', iter(range(10 ** 9))), ('parse', abs), ('collect', collect)], 1)
+    assert threading.active_count() == 1
+
+
+def test_utilisation_is_reported():
+    run_metrics = metrics.Metrics()
+    for _ in range(2):
+        run_metrics.record_pipeline(*pipeline.run([('decompress', range(10)), ('collect', abs)]))
+
+    build_metrics = metrics.Metrics()
+    build_metrics.record_pipeline({'decompress': 1.0, 'collect': 0.5}, 2.0)
+    build_metrics.merge(run_metrics)
+
+    report = build_metrics.report('dbip')
+    assert list(report['pipeline']) == ['decompress', 'collect']
+    assert 1.0 <= report['pipeline']['decompress']['busy_seconds'] < 2.0
+    assert 0 < report['pipeline']['collect']['utilisation'] < 1
+    lines = list(metrics.prometheus_lines([report]))
+    assert any(line.startswith('geoipsets_pipeline_utilisation{provider="dbip",stage="collect"} ') for line in lines)
+
+
+def test_submitted_keeps_order_and_bounds_work_ahead():
+    started = []
+
+    def work(item, offset):
+        started.append(item)
+        return item + offset
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = []
+        for future in pipeline.submitted(executor, work, range(10), 3, 100):
+            assert len(started) <= len(results) + 4  # the one yielded and up to 3 ahead
+            results.append(future.result())
+    assert results == list(range(100, 110))
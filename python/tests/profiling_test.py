@@ -0,0 +1,54 @@
+# profiling_test.py
+
+import gzip
+import pstats
+
+import pytest
+
+from geoipsets import __main__, metrics, profiling
+
+
+def run(profile_dir, profiler):
+    run_metrics = metrics.Metrics()
+    with profiling.profile(str(profile_dir), 'dbip', profiler):
+        with run_metrics.stage('parse'):
+            data = [str(i) for i in range(10000)]
+    return data
+
+
+@pytest.mark.parametrize("profiler, files", [('cpu', ['dbip.cpu.txt', 'dbip.prof']),
+                                             ('memory', ['dbip.memory.txt']),
+                                             ('all', ['dbip.cpu.txt', 'dbip.memory.txt', 'dbip.prof'])])
+def test_reports_written(tmp_path, profiler, files):
+    run(tmp_path, profiler)
+    assert sorted(p.name for p in tmp_path.iterdir()) == files
+
+    if profiler != 'memory':
+        assert pstats.Stats(str(tmp_path / 'dbip.prof')).total_calls > 0
+    if profiler != 'cpu':
+        report = (tmp_path / 'dbip.memory.txt').read_text()
+        assert report.startswith('peak traced memory:')
+        assert '\nafter parse:' in report and '\nafter the run:' in report
+        assert 'profiling_test.py' in report  # the list comprehension above
+
+
+def test_disabled():
+    with profiling.profile(None, 'dbip'):
+        pass
+    profiling.checkpoint('parse')  # nothing recorded
+    assert profiling._snapshots is None
+
+
+def test_pipeline_stages_profiled(tmp_path):
+    """
+    Does --profile run the parsing stages on the profiled thread, so that the CSV parsing shows in the report?
+    """
+    csv_path = tmp_path / 'dbip.csv.gz'
+    csv_path.write_bytes(gzip.compress(b'1.0.0.0,1.0.0.255,CA\n2001::,2001::ffff,US\n'))
+    opts = __main__.get_config(['-p', 'dbip', '--profile', str(tmp_path / 'profile')])
+    assert opts.get('queue-depth') == 0
+
+    provider = __main__.build_provider('dbip', opts)
+    with profiling.profile(opts.get('profile'), 'dbip'):
+        provider.parse_csv(csv_path)
+    assert 'parse_block' in (tmp_path / 'profile/dbip.cpu.txt').read_text()
@@ -0,0 +1,83 @@
+# publish_test.py
+
+import json
+
+from geoipsets import publish
+
+
+def stage(publisher, files: dict):
+    for relative_path, content in files.items():
+        path = publisher.staging_dir / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+
+
+def publish_files(provider_dir, files: dict, empty_dirs=(), disabled=()):
+    with publish.Publisher(provider_dir) as publisher:
+        stage(publisher, files)
+        for d in empty_dirs:
+            (publisher.staging_dir / d).mkdir(parents=True, exist_ok=True)
+        return publisher.commit(disabled)
+
+
+def test_first_run_publishes_everything(tmp_path):
+    changed, removed = publish_files(tmp_path, {'ipset/ipv4/CA.ipv4': 'a', 'nftset/ipv4/CA.ipv4': 'b'})
+    assert changed == ['ipset/ipv4/CA.ipv4', 'nftset/ipv4/CA.ipv4']
+    assert removed == []
+    assert (tmp_path / 'ipset/ipv4/CA.ipv4').read_text() == 'a'
+    assert not (tmp_path / '.staging').exists()
+
+    manifest = json.loads((tmp_path / 'manifest.json').read_text())
+    assert sorted(manifest['files']) == ['ipset/ipv4/CA.ipv4', 'nftset/ipv4/CA.ipv4']
+    assert manifest['changed'] == changed
+
+
+def test_unchanged_files_are_left_alone(tmp_path):
+    """
+    Do unchanged sets keep their inode and mtime, while changed ones are replaced and stale ones removed?
+    """
+    publish_files(tmp_path, {'nftset/ipv4/CA.ipv4': 'a', 'nftset/ipv4/US.ipv4': 'b', 'nftset/ipv4/RU.ipv4': 'c'})
+    before = (tmp_path / 'nftset/ipv4/CA.ipv4').stat()
+
+    changed, removed = publish_files(tmp_path, {'nftset/ipv4/CA.ipv4': 'a', 'nftset/ipv4/US.ipv4': 'x'})
+    assert changed == ['nftset/ipv4/US.ipv4']
+    assert removed == ['nftset/ipv4/RU.ipv4']
+
+    after = (tmp_path / 'nftset/ipv4/CA.ipv4').stat()
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+    assert (tmp_path / 'nftset/ipv4/US.ipv4').read_text() == 'x'
+    assert json.loads((tmp_path / 'manifest.json').read_text())['removed'] == ['nftset/ipv4/RU.ipv4']
+
+
+def test_only_regenerated_directories_are_pruned(tmp_path):
+    """
+    Are the sets of address families and firewalls not built by this run kept, and emptied directories cleared?
+    """
+    publish_files(tmp_path, {'ipset/ipv4/CA.ipv4': 'a', 'ipset/ipv6/CA.ipv6': 'b'})
+
+    changed, removed = publish_files(tmp_path, {}, empty_dirs=['ipset/ipv4'])
+    assert changed == []
+    assert removed == ['ipset/ipv4/CA.ipv4']
+    assert (tmp_path / 'ipset/ipv6/CA.ipv6').is_file()
+
+
+def test_disabled_outputs_are_removed(tmp_path):
+    """
+    Are the files of an optional output no longer generated, eg. the index without --index, removed?
+    """
+    publish_files(tmp_path, {'nftset/ipv4/CA.ipv4': 'a', 'index/ipv4/geoipsets.idx': 'b',
+                             'index/ipv6/geoipsets.idx': 'c'})
+
+    changed, removed = publish_files(tmp_path, {'nftset/ipv4/CA.ipv4': 'x'}, disabled=['index', 'nftbatch'])
+    assert changed == ['nftset/ipv4/CA.ipv4']
+    assert removed == ['index/ipv4/geoipsets.idx', 'index/ipv6/geoipsets.idx']
+    assert not (tmp_path / 'index').exists()
+    assert sorted(json.loads((tmp_path / 'manifest.json').read_text())['files']) == ['nftset/ipv4/CA.ipv4']
+
+
+def test_nothing_published_without_commit(tmp_path):
+    with publish.Publisher(tmp_path) as publisher:
+        stage(publisher, {'ipset/ipv4/CA.ipv4': 'a'})
+
+    assert not (tmp_path / 'ipset').exists()
+    assert not (tmp_path / '.staging').exists()
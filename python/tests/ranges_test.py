@@ -0,0 +1,181 @@
+# ranges_test.py
+
+import random
+from ipaddress import IPv4Address, IPv6Address, summarize_address_range
+
+import pytest
+
+from geoipsets import ranges
+
+IPV4_MAX = (1 << 32) - 1
+IPV6_MAX = (1 << 128) - 1
+
+
+def random_ranges(bits, count, seed=1):
+    rng = random.Random(seed)
+    top = (1 << bits) - 1
+    cases = [(0, top), (0, 0), (top, top), (top - 5, top), (0, 5), (1, top), (0, top - 1)]
+    for _ in range(count):
+        first = rng.randrange(top + 1)
+        last = min(top, first + rng.choice([0, 1, 255, 1 << 20, 1 << (bits - 8)]) + rng.randrange(256))
+        cases.append((first, last))
+    return cases
+
+
+def expected_cidrs(first, last, version):
+    address = IPv4Address if version == 4 else IPv6Address
+    return [n.with_prefixlen for n in summarize_address_range(address(first), address(last))]
+
+
+@pytest.mark.parametrize("version, bits", [(4, 32), (6, 128)])
+def test_summarize_matches_ipaddress(version, bits):
+    """
+    Does the integer engine produce exactly the same CIDRs, and text, as the ipaddress module?
+    """
+    for first, last in random_ranges(bits, 2000):
+        assert ranges.summarize(first, last, version) == expected_cidrs(first, last, version)
+
+
+@pytest.mark.parametrize("text", ['0.0.0.0', '1.2.3.4', '255.255.255.255', '::', '::1', '1::', '2001:db8::1:0:0:1',
+                                  '2001:0:0:1::1', 'fe80::', '::ffff:1.2.3.4', '::ffff:102:304', '1:2:3:4:5:6:7:8'])
+def test_parse_and_format(text):
+    """
+    Are addresses parsed to the right integer, and rendered exactly as the ipaddress module does?
+    """
+    version, ip = ranges.parse_address(text)
+    if version == 4:
+        assert ip == int(IPv4Address(text))
+        assert ranges.format_ipv4(ip) == str(IPv4Address(ip))
+    else:
+        assert ip == int(IPv6Address(text))
+        assert ranges.format_ipv6(ip) == str(IPv6Address(ip))
+
+
+def test_format_ipv6_random():
+    rng = random.Random(2)
+    for _ in range(5000):
+        # sprinkle zero hextets so that runs of various lengths and positions are compressed
+        ip = rng.getrandbits(128) & ~(rng.getrandbits(128) & rng.getrandbits(128))
+        assert ranges.format_ipv6(ip) == str(IPv6Address(ip))
+
+
+@pytest.mark.parametrize("version, bits", [(4, 32), (6, 128)])
+def test_summarize_batch(version, bits):
+    """
+    Does the vectorised batch mode produce the same CIDRs, in the same order, as the scalar engine?
+    """
+    pytest.importorskip('numpy')
+    cases = random_ranges(bits, 500)
+    expected = [(i, net, prefix) for i, (first, last) in enumerate(cases)
+                for net, prefix in ranges.range_to_cidrs(first, last, bits)]
+
+    if version == 4:
+        rows, nets, prefixes = ranges.summarize_batch([f for f, _ in cases], [la for _, la in cases], 4)
+        actual = [(int(r), int(n), int(p)) for r, n, p in zip(rows, nets, prefixes)]
+    else:
+        mask = (1 << 64) - 1
+        rows, (nets_hi, nets_lo), prefixes = ranges.summarize_batch([(f >> 64, f & mask) for f, _ in cases],
+                                                                    [(la >> 64, la & mask) for _, la in cases], 6)
+        actual = [(int(r), int(h) << 64 | int(lo), int(p)) for r, h, lo, p in zip(rows, nets_hi, nets_lo, prefixes)]
+
+    assert actual == expected
+
+
+@pytest.mark.parametrize("text, version, expected",
+                         [('1.2.3.4', 4, (0x01020304, 0x01020304)),
+                          ('1.2.3.0/24', 4, (0x01020300, 0x010203ff)),
+                          ('1.2.3.0-1.2.4.7', 4, (0x01020300, 0x01020407)),
+                          ('0.0.0.0/0', 4, (0, IPV4_MAX)),
+                          ('2001:db8::/32', 6, (0x20010db8 << 96, (0x20010db8 << 96) | ((1 << 96) - 1))),
+                          ('::-::1', 6, (0, 1)),
+                          ('::/0', 6, (0, IPV6_MAX))])
+def test_parse_element(text, version, expected):
+    assert ranges.parse_element(text, version) == expected
+
+
+@pytest.mark.parametrize("intervals, expected",
+                         [([], []),
+                          ([(5, 9)], [(5, 9)]),
+                          ([(10, 19), (0, 9)], [(0, 19)]),  # adjacent, unsorted
+                          ([(0, 10), (5, 7)], [(0, 10)]),  # contained
+                          ([(0, 10), (5, 15), (17, 20)], [(0, 15), (17, 20)]),  # overlapping, then a gap
+                          ([(3, 3), (3, 3)], [(3, 3)])])  # duplicate
+def test_merge_intervals(intervals, expected):
+    assert ranges.merge_intervals(intervals) == expected
+
+
+def test_aggregate_siblings():
+    """
+    Are sibling CIDRs collapsed, and are merged intervals rendered as minimal CIDRs and ranges?
+    """
+    subnets = ['10.0.0.0/25', '10.0.0.128/25', '10.0.1.0/24', '10.0.3.0/24', '10.0.4.1']
+    intervals = ranges.merge_intervals(ranges.parse_element(s, 4) for s in subnets)
+    assert ranges.intervals_to_cidrs(intervals, 4) == ['10.0.0.0/23', '10.0.3.0/24', '10.0.4.1/32']
+    assert ranges.intervals_to_ranges(intervals, 4) == ['10.0.0.0-10.0.1.255', '10.0.3.0-10.0.3.255', '10.0.4.1']
+
+
+@pytest.mark.parametrize("old, new, removed, added",
+                         [([], [], [], []),
+                          ([(0, 9)], [], [(0, 9)], []),
+                          ([], [(0, 9)], [], [(0, 9)]),
+                          ([(0, 9), (20, 29)], [(0, 9), (20, 29)], [], []),
+                          ([(0, 9), (20, 29), (40, 49)], [(0, 9), (20, 24), (25, 29), (50, 59)],
+                           [(20, 29), (40, 49)], [(20, 24), (25, 29), (50, 59)]),
+                          ([(0, 9, 'a')], [(0, 9, 'b'), (10, 19, 'c')], [], [(10, 19, 'c')])])  # extra items carried
+def test_diff_intervals(old, new, removed, added):
+    assert ranges.diff_intervals(old, new) == (removed, added)
+
+
+@pytest.mark.parametrize("version, bits", [(4, 32), (6, 128)])
+def test_networks_cidrs(version, bits):
+    """
+    Do CIDRs held in a Networks container render as the strings they replace, and give the intervals they cover?
+    """
+    networks = ranges.Networks(version)
+    expected = []
+    intervals = []
+    for first, last in random_ranges(bits, 200):
+        networks.add_cidrs(ranges.range_to_cidrs(first, last, bits))
+        expected.extend(expected_cidrs(first, last, version))
+        intervals.extend(ranges.parse_element(c, version) for c in expected_cidrs(first, last, version))
+
+    assert len(networks) == len(expected)
+    assert networks.render() == expected
+    assert list(networks.intervals()) == intervals
+
+
+@pytest.mark.parametrize("version, first, last, expected", [
+    (4, 16777216, 16777471, '1.0.0.0-1.0.0.255'),
+    (4, 16777216, 16777216, '1.0.0.0'),
+    (6, 1 << 112, (1 << 112) + 255, '1::-1::ff'),
+    (6, IPV6_MAX, IPV6_MAX, 'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff'),
+])
+def test_networks_ranges(version, first, last, expected):
+    networks = ranges.Networks(version, cidrs=False)
+    networks.add_range(first, last)
+    assert len(networks) == 1
+    assert networks.render() == [expected]
+    assert list(networks.intervals()) == [(first, last)]
+
+
+@pytest.mark.parametrize("version, bits", [(4, 32), (6, 128)])
+@pytest.mark.parametrize("cidrs", [True, False])
+def test_networks_extend(version, bits, cidrs):
+    """
+    Does extending Networks with those parsed from each block give the Networks parsed from all the blocks at once?
+    """
+    whole = ranges.Networks(version, cidrs)
+    extended = ranges.Networks(version, cidrs)
+    intervals = random_ranges(bits, 200)
+    for start in range(0, len(intervals), 50):
+        block = ranges.Networks(version, cidrs)
+        for networks in (whole, block):
+            for first, last in intervals[start:start + 50]:
+                if cidrs:
+                    networks.add_cidrs(ranges.range_to_cidrs(first, last, bits))
+                else:
+                    networks.add_range(first, last)
+        extended.extend(block)
+
+    assert len(extended) == len(whole)
+    assert list(extended.intervals()) == list(whole.intervals())
@@ -0,0 +1,54 @@
+# registry_test.py
+
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from geoipsets import __main__, dbip, maxmind, registry
+
+
+class ExampleProvider:
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+
+
+@pytest.fixture
+def example_entry_point(monkeypatch):
+    monkeypatch.setattr(registry, 'entry_points', lambda: {'example': SimpleNamespace(load=lambda: ExampleProvider)})
+
+
+def test_builtin_providers():
+    assert registry.names()[:2] == ['maxmind', 'dbip']
+    assert registry.load('maxmind') is maxmind.MaxMindProvider
+    assert registry.load('dbip') is dbip.DbIpProvider
+
+
+def test_lightweight_commands_import_no_provider():
+    """
+    Are the provider modules, and their dependencies, left unimported by --version and by config validation?
+    """
+    code = ("import sys\n"
+            "from geoipsets import __main__\n"
+            "__main__.get_config(['-p', 'dbip'])\n"
+            "print(sorted(m for m in ('geoipsets.dbip', 'geoipsets.maxmind', 'requests', 'bs4',"
+            " 'importlib.metadata') if m in sys.modules))\n")
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert out.stdout == "[]\n"
+
+
+def test_entry_point_provider(example_entry_point):
+    assert registry.names() == ['maxmind', 'dbip', 'example']
+    assert 'example' in registry.Names()
+    assert __main__.get_config(['-p', 'example', 'dbip']).get('provider') == {'example', 'dbip'}
+
+    provider = __main__.build_provider('example', __main__.get_config(['-p', 'example']))
+    assert isinstance(provider, ExampleProvider)
+    assert provider.args[-1] is None  # no [example] section in the configuration file
+
+
+def test_unknown_provider(example_entry_point):
+    with pytest.raises(SystemExit):
+        __main__.get_config(['-p', 'unknown'])
@@ -0,0 +1,64 @@
+# spool_test.py
+
+import pytest
+
+from geoipsets import ranges, spool, utils
+
+
+class Provider(utils.AbstractProvider):
+    def generate(self):
+        pass
+
+
+def test_file_pool_reopens_evicted_files(tmp_path):
+    """
+    Are files closed beyond 'max_open', then appended to, not truncated, when written again?
+    """
+    pool = spool.FilePool(max_open=2)
+    paths = [tmp_path / name for name in ('a', 'b', 'c')]
+    for i in range(3):
+        for path in paths:
+            pool.write(path, path.name + str(i) + '\n')
+        assert len(pool.files) == 2
+    pool.close()
+
+    for path in paths:
+        assert path.read_text() == ''.join(path.name + str(i) + '\n' for i in range(3))
+
+
+@pytest.mark.parametrize("aggregate", [False, True])
+@pytest.mark.parametrize("firewall", [{'iptables', 'nftables'}, {'iptables'}, {'nftables'}])
+def test_spooled_networks_match_networks(tmp_path, aggregate, firewall):
+    """
+    Are the elements of a spooled set those of the same set held in memory?
+    """
+    provider = Provider(firewall, {'ipv4'}, False, 'all', str(tmp_path), aggregate=aggregate)
+    set_spool = spool.Spool(tmp_path / 'spool', aggregate, provider.ip_tables, provider.nf_tables, max_open=1)
+    cidrs = 'iptables' in firewall
+    intervals = [(16777216, 16777471), (16777472, 16777472), (16777473, 16778000), (16779000, 16779000),
+                 (16779002, 16779100)]
+
+    spooled = {cc: set_spool.networks(cc + '.ipv4', 4, cidrs) for cc in ('CA', 'US')}
+    in_memory = {cc: ranges.Networks(4, cidrs) for cc in ('CA', 'US')}
+    for first, last in intervals:
+        for networks in (spooled['CA'], in_memory['CA'], spooled['US'], in_memory['US']):
+            if cidrs:
+                networks.add_cidrs(ranges.range_to_cidrs(first, last, ranges.IPV4_BITS))
+            else:
+                networks.add_range(first, last)
+
+    for cc in ('CA', 'US'):
+        expected = provider.aggregate_subnets(in_memory[cc])
+        elements = provider.aggregate_subnets(spooled[cc])
+        assert [len(e) for e in elements] == [len(e) for e in expected]
+        assert [list(e) for e in elements] == [list(e) for e in expected]
+
+    set_spool.close()
+    assert list((tmp_path / 'spool').iterdir()) == []
+
+
+def test_low_memory_excludes_delta_and_index(tmp_path):
+    with pytest.raises(SystemExit):
+        Provider({'nftables'}, {'ipv4'}, False, 'all', str(tmp_path), delta=True, low_memory=True)
+    with pytest.raises(SystemExit):
+        Provider({'nftables'}, {'ipv4'}, False, 'all', str(tmp_path), write_index=True, low_memory=True)
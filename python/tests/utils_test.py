@@ -0,0 +1,184 @@
+# utils_test.py
+
+import gzip
+import hashlib
+import io
+
+import pytest
+import requests
+
+from geoipsets import utils
+
+
+class FakeResponse:
+    """Minimal stand-in for a streamed requests.Response, whose connection may drop after 'fail_after' bytes."""
+
+    def __init__(self, content: bytes, status_code: int = 200, headers: dict = None, fail_after: int = None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or dict()
+        self.fail_after = fail_after
+        self.url = 'https://example.com/archive.zip'
+
+    def iter_content(self, chunk_size=1):
+        end = len(self.content) if self.fail_after is None else self.fail_after
+        for i in range(0, end, chunk_size):
+            yield self.content[i:min(i + chunk_size, end)]
+        if self.fail_after is not None:
+            raise requests.exceptions.ChunkedEncodingError("connection broken")
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize("size", [0, 1, utils.CHUNK_SIZE - 1, utils.CHUNK_SIZE, 5 * utils.CHUNK_SIZE + 3])
+def test_write_response_digest(size):
+    """
+    Is a streamed response written to disk intact and hashed as it is written?
+    """
+    content = bytes(i % 251 for i in range(size))
+    out = io.BytesIO()
+    digest = hashlib.sha256()
+    utils.write_response(FakeResponse(content), out, digest)
+    assert out.getvalue() == content
+    assert digest.hexdigest() == hashlib.sha256(content).hexdigest()
+
+
+@pytest.mark.parametrize("members", [1, 3])
+def test_digest_reader(members):
+    """
+    Does DigestReader hash the decompressed contents of a (multi-member) gzip file as they are read in blocks?
+    """
+    csv = b"1.0.0.0,1.0.0.255,AU\n" * 50000
+    compressed = b''.join(gzip.compress(csv) for _ in range(members))
+    with gzip.GzipFile(fileobj=io.BytesIO(compressed)) as gzip_file:
+        digest = hashlib.sha1()
+        blocks = list(utils.iter_line_blocks(utils.DigestReader(gzip_file, digest), 1000))
+    assert b''.join(blocks) == csv * members
+    assert digest.hexdigest() == hashlib.sha1(csv * members).hexdigest()
+
+
+@pytest.fixture
+def resume(monkeypatch):
+    """
+    Replaces the HTTP requests that resume a download with the responses in 'resume.responses', recording their headers.
+    """
+    def http_get(url, headers=None, stream=False):
+        resume.requests.append(headers)
+        return resume.responses.pop(0)
+
+    resume.requests, resume.responses = [], []
+    monkeypatch.setattr(utils, 'http_get', http_get)
+    monkeypatch.setattr(utils, 'HTTP_BACKOFF', 0)
+    return resume
+
+
+def test_write_response_resumed(resume):
+    """
+    Is an interrupted download resumed from where it stopped with a conditional Range request, and hashed once?
+    """
+    content = bytes(i % 251 for i in range(3 * utils.CHUNK_SIZE))
+    headers = {'ETag': '"abc"', 'Content-Length': str(len(content))}
+    resume.responses = [FakeResponse(content[100000:], 206, {'Content-Range': 'bytes 100000-196607/196608'},
+                                     fail_after=50000),
+                        FakeResponse(content[150000:], 206, {'Content-Range': 'bytes 150000-196607/196608'})]
+    out, digest = io.BytesIO(), hashlib.sha256()
+
+    assert utils.write_response(FakeResponse(content, headers=headers, fail_after=100000), out, digest) == len(content)
+    assert out.getvalue() == content
+    assert digest.hexdigest() == hashlib.sha256(content).hexdigest()
+    assert resume.requests == [{'Range': 'bytes=100000-', 'If-Range': '"abc"'},
+                               {'Range': 'bytes=150000-', 'If-Range': '"abc"'}]
+
+
+def test_write_response_short_body_resumed(resume):
+    """
+    Is a body that ends before its Content-Length, without an error, completed?
+    """
+    content = b'x' * 1000
+    resume.responses = [FakeResponse(content[600:], 206, {'Content-Range': 'bytes 600-999/1000'})]
+    out = io.BytesIO()
+    utils.write_response(FakeResponse(content[:600], headers={'Content-Length': '1000'}), out)
+    assert out.getvalue() == content
+
+
+@pytest.mark.parametrize("etag, resumed", [('"abc"', True), ('"def"', False)])
+def test_write_response_range_ignored(resume, etag, resumed):
+    """
+    If the server sends the whole body again, is the part already written skipped, unless the file has changed?
+    """
+    content = bytes(i % 251 for i in range(200000))
+    resume.responses = [FakeResponse(content, 200, {'ETag': etag})]
+    out = io.BytesIO()
+    response = FakeResponse(content, headers={'ETag': '"abc"'}, fail_after=70000)
+    if resumed:
+        utils.write_response(response, out)
+        assert out.getvalue() == content
+    else:
+        with pytest.raises(SystemExit, match='the file changed'):
+            utils.write_response(response, out)
+
+
+def test_write_response_retries_exhausted(resume, monkeypatch):
+    monkeypatch.setattr(utils, 'HTTP_RETRIES', 1)
+    resume.responses = [FakeResponse(b'', 206, {'Content-Range': 'bytes 10-19/20'}, fail_after=0)]
+    with pytest.raises(SystemExit, match='interrupted'):
+        utils.write_response(FakeResponse(b'x' * 20, fail_after=10), io.BytesIO())
+
+
+def test_http_get_error(monkeypatch):
+    """
+    Does a failed request exit with an error message, rather than a traceback or a hang?
+    """
+    monkeypatch.setattr(utils, 'HTTP_RETRIES', 0)
+    monkeypatch.setattr(utils, '_session', None)
+    with pytest.raises(SystemExit, match="Cannot download 'http://127.0.0.1:9/'"):
+        utils.http_get('http://127.0.0.1:9/')
+    assert utils.http_session() is utils.http_session()  # shared
+
+
+def test_iter_line_blocks():
+    """
+    Do blocks always end on a line boundary, without losing data, whatever the block size?
+    """
+    data = b''.join(b'line %d\n' % i for i in range(1000)) + b'no trailing newline'
+    for block_size in (1, 7, 64, 100000):
+        blocks = list(utils.iter_line_blocks(io.BytesIO(data), block_size))
+        assert b''.join(blocks) == data
+        assert all(b.endswith(b'\n') for b in blocks[:-1])
+
+
+@pytest.mark.parametrize("csv", [b'a,b,c\n1,2,3\n4,5,6\n',
+                                 b'a,b,c\r\n1,2,3\r\n4,5,6\r\n',  # windows line endings
+                                 b'a,b,c\n1,2,3\n\n4,5,6',  # blank line, no trailing newline
+                                 b'a,"b",c\n"1",2,3\n4,5,"6"\n'])  # quoting
+def test_csv_columns(csv):
+    """
+    Are the requested columns extracted in the requested order?
+    """
+    rows = [r for block in utils.read_csv_rows(io.BytesIO(csv), ('c', 'a')) for r in block]
+    assert rows == [('3', '1'), ('6', '4')]
+
+
+def test_csv_columns_quoted_commas_and_short_rows():
+    csv = b'geoname_id,continent_name,country_iso_code,extra\n1,"North, America",CA,x\n2,Europe\n'
+    rows = [r for block in utils.read_csv_rows(io.BytesIO(csv), ('geoname_id', 'country_iso_code')) for r in block]
+    assert rows == [('1', 'CA'), ('2', '')]
+
+
+def test_csv_columns_fieldnames():
+    """
+    Is a headerless file read using the given field names?
+    """
+    csv = b'1.0.0.0,1.0.0.255,AU\n1.0.1.0,1.0.3.255,CN\n'
+    rows = [r for block in utils.read_csv_rows(io.BytesIO(csv), ('country',), ('ip_start', 'ip_end', 'country'))
+            for r in block]
+    assert rows == [('AU',), ('CN',)]
+
+
+def test_csv_columns_missing_column():
+    """
+    Does an unexpected header abort the run?
+    """
+    with pytest.raises(SystemExit):
+        list(utils.read_csv_rows(io.BytesIO(b'network,geoname_id\n1.0.0.0/24,1\n'), ('network', 'country')))